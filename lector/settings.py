@@ -73,6 +73,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'lector_app.middleware.UserStateMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -156,9 +157,91 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# recordings are streamed by the app, unless AUDIO_OFFLOAD is 'x-accel-redirect' (nginx, with an
+# internal location AUDIO_OFFLOAD_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile' (Apache
+# mod_xsendfile), in which case the front proxy sends the files
+AUDIO_OFFLOAD = None
+AUDIO_OFFLOAD_PREFIX = '/protected-media/'
+
+# audio files are uploaded in chunks of UPLOAD_CHUNK_SIZE bytes, for files of up to
+# UPLOAD_MAX_SIZE bytes; the clean_uploads command deletes the uploads not finished within
+# UPLOAD_EXPIRY_HOURS hours. Stored files are addressed by the hash of their chunks' hashes, so
+# changing UPLOAD_CHUNK_SIZE stops new uploads from being deduplicated against existing files
+UPLOAD_CHUNK_SIZE = 4 * 2 ** 20
+UPLOAD_MAX_SIZE = 2 ** 31
+UPLOAD_EXPIRY_HOURS = 48
+
+# the waveform peaks of new audio files are computed by WAVEFORM_WORKERS processes per server
+# process (0 leaves them to the build_waveforms command, which also computes those of older or
+# failed files), which decode them with WAVEFORM_FFMPEG; responses with peaks may be cached for
+# WAVEFORM_CACHE_SECONDS
+WAVEFORM_WORKERS = 2
+WAVEFORM_FFMPEG = 'ffmpeg'
+WAVEFORM_CACHE_SECONDS = 24 * 3600
+
+# the cover art thumbnails of new audio files are made by COVER_WORKERS processes per server
+# process (0 leaves them to the build_covers command, which also makes those of older files);
+# they are never modified, so MEDIA_URL/covers/ can be served with far-future cache headers
+COVER_WORKERS = 1
+
+# Caches
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # search results are shared by all worker processes
+    'search': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'search'),
+    },
+    # cached libraries are invalidated by the process that changes them, so they must be shared
+    'users': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'users'),
+    },
+}
+
 # Search indexes
 
 SEARCH_INDEX_DIR = os.path.join(BASE_DIR, 'search-index')
+# index updates are written in batches: a batch is written as soon as it holds
+# SEARCH_INDEX_MAX_BATCH_SIZE updates or its oldest update is SEARCH_INDEX_MAX_LATENCY seconds old
+SEARCH_INDEX_MAX_LATENCY = 1.0
+SEARCH_INDEX_MAX_BATCH_SIZE = 256
+# at startup, rows modified up to SEARCH_INDEX_CATCH_UP_SLACK seconds before the most recently
+# indexed one are reindexed (see AbstractSearchEngine.catch_up)
+SEARCH_INDEX_CATCH_UP_SLACK = 60.0
+# each index is split across SEARCH_INDEX_SHARDS shards, which are searched in parallel
+SEARCH_INDEX_SHARDS = 1
+# if set, index updates are sent to the index writer service (manage.py run_index_writer) listening
+# on this unix socket, which applies the updates of all worker processes
+SEARCH_INDEX_WRITER_SOCKET = None
+# index segments are merged in the background to keep at most SEARCH_INDEX_MAX_SEGMENTS segments
+# per index and at most SEARCH_INDEX_MAX_DELETED_RATIO deleted documents per segment (checked every
+# SEARCH_INDEX_MAINTENANCE_INTERVAL seconds), and indexes are optimised once a day during the
+# SEARCH_INDEX_OPTIMIZE_HOURS (start, end) range of hours, if set
+SEARCH_INDEX_MAX_SEGMENTS = 10
+SEARCH_INDEX_MAX_DELETED_RATIO = 0.2
+SEARCH_INDEX_MAINTENANCE_INTERVAL = 60.0
+SEARCH_INDEX_OPTIMIZE_HOURS = (3, 5)
+# full rebuilds (manage.py rebuild_index) index with this many processes, each using up to
+# SEARCH_INDEX_REBUILD_LIMITMB megabytes of memory
+SEARCH_INDEX_REBUILD_PROCS = os.cpu_count() or 1
+SEARCH_INDEX_REBUILD_LIMITMB = 128
+# search results are cached in this cache (see CACHES) for SEARCH_CACHE_TIMEOUT seconds
+SEARCH_CACHE = 'search'
+SEARCH_CACHE_TIMEOUT = 300
+# the HTML of search hits is cached there for SEARCH_HIT_CACHE_TIMEOUT seconds (it is keyed by the
+# index generation, so it only needs to expire to free space; clear the cache after changing the
+# hit template)
+SEARCH_HIT_CACHE_TIMEOUT = 3600
+
+# the recordings in each user's library are cached in this cache (see CACHES) until the library
+# changes, or for LIBRARY_CACHE_TIMEOUT seconds
+LIBRARY_CACHE = 'users'
+LIBRARY_CACHE_TIMEOUT = 3600
 
 # #login with google
 #     #Django all auth settings
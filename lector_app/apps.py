@@ -1,4 +1,6 @@
 import logging
+import os
+import sys
 
 from django.apps import AppConfig
 from django.db.utils import DatabaseError
@@ -13,8 +15,17 @@ class LectorAppConfig(AppConfig):
     verbose_name = 'Lector App'
 
     def ready(self):
+        if _running_management_command():
+            return  # commands that need an up to date index bring it up to date themselves
         try:
-            from .models import Recording
-            Recording.search_engine.reindex_all()
+            from . import models, search  # the models module creates the search engines
+            for engine in search.engines.values():
+                engine.catch_up()
         except DatabaseError as error:
             logger.error(f"database error while loading {self.label} (MIGRATE ASAP): {error}")
+
+
+def _running_management_command() -> bool:
+    """Whether this process runs a manage.py command other than runserver"""
+    return os.path.basename(sys.argv[0]) == 'manage.py' and len(sys.argv) > 1 \
+        and sys.argv[1] != 'runserver'
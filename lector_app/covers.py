@@ -0,0 +1,154 @@
+"""
+Thumbnails of the cover art embedded in the recordings' audio files.
+
+The cover art of new audio files is read from their ID3v2 tag (see
+:func:`lector_app.mp3.cover_art`) in the background, by a pool of worker processes, which resize
+it with Pillow to each of the thumbnail ``SIZES``. Thumbnails are stored under
+``MEDIA_ROOT/covers``, named after the SHA-256 digest of the embedded image, so they never change
+once written, can be served with far-future cache headers, and are shared by recordings with the
+same cover art. Once the thumbnails are written, the digest is set as the ``cover`` of the
+recordings of the audio file, and of their books that have no cover yet (see
+:class:`HasCover`).
+"""
+import hashlib
+import io
+import logging
+import os
+import threading
+import typing as t
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections
+
+from . import mp3
+
+
+logger = logging.getLogger('lector-app covers')
+
+SIZES = {'small': 64, 'medium': 160, 'large': 320}  # maximum width and height, in pixels
+JPEG_QUALITY = 85
+
+
+def thumbnail_name(cover: str, size: int) -> str:
+    """Name of a thumbnail of a cover, relative to ``MEDIA_ROOT``
+
+    :param cover: the SHA-256 digest of the cover art
+    :param size: the maximum width and height of the thumbnail
+    """
+    return f'covers/{cover[:2]}/{cover}-{size}.jpg'
+
+
+class HasCover:
+    """Utilities for models which have a ``cover`` attribute (the SHA-256 digest of their cover
+    art, or an empty string)"""
+    cover: str
+
+    @property
+    def thumbnails(self) -> t.Dict[str, str]:
+        """URLs of the thumbnails of the cover, by size name (see ``SIZES``), e.g. for
+        ``{{ recording.thumbnails.small }}`` in templates (empty if there is no cover)"""
+        if not self.cover:
+            return {}
+        return {name: default_storage.url(thumbnail_name(self.cover, size))
+                for name, size in SIZES.items()}
+
+
+def submit(audio_name: str) -> t.Optional[Future]:
+    """Make the thumbnails of the cover art of an audio file in the background (unless they are
+    being made by this process, or ``COVER_WORKERS`` is 0), then set the cover of its recordings
+
+    :param audio_name: name of the audio file, relative to ``MEDIA_ROOT``
+    :return: the future of the cover's SHA-256 digest (empty if the file has no cover art), if
+        the thumbnails are made
+    """
+    if not audio_name or not getattr(settings, 'COVER_WORKERS', 1):
+        return None
+    with _pending_lock:
+        if _executor_pid != os.getpid():
+            _pending.clear()  # inherited from the parent process
+        if audio_name in _pending:
+            return None
+        _pending.add(audio_name)
+    future = _get_executor().submit(build_thumbnails, default_storage.path(audio_name),
+                                    settings.MEDIA_ROOT)
+    future.add_done_callback(lambda done: _built(audio_name, done))
+    return future
+
+
+def build_thumbnails(audio_path: str, media_root: str) -> str:
+    """Write the thumbnails of the cover art of an audio file that don't exist yet (in a worker
+    process).
+
+    :param audio_path: path of the audio file
+    :param media_root: the ``MEDIA_ROOT``
+    :return: the SHA-256 digest of the cover art, or an empty string if the file has none
+    """
+    from PIL import Image
+
+    with open(audio_path, 'rb') as file:
+        data = mp3.cover_art(file)
+    if not data:
+        return ''
+    cover = hashlib.sha256(data).hexdigest()
+    paths = {size: os.path.join(media_root, thumbnail_name(cover, size))
+             for size in sorted(SIZES.values(), reverse=True)}
+    if all(os.path.exists(path) for path in paths.values()):
+        return cover
+
+    image = Image.open(io.BytesIO(data))
+    largest = max(SIZES.values())
+    image.draft('RGB', (largest, largest))  # decodes JPEG images at a reduced scale
+    image = image.convert('RGB')
+    os.makedirs(os.path.dirname(paths[largest]), exist_ok=True)
+    for size, path in paths.items():  # from the largest, each resized from the one before
+        image.thumbnail((size, size), Image.LANCZOS)
+        tmp_path = f'{path}.{os.getpid()}'
+        image.save(tmp_path, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        os.replace(tmp_path, path)
+    return cover
+
+
+def set_cover(audio_name: str, cover: str):
+    """Set the cover of the recordings of an audio file, and of their books that have none
+
+    :param audio_name: name of the audio file, relative to ``MEDIA_ROOT``
+    :param cover: the SHA-256 digest of the file's cover art (see :func:`build_thumbnails`)
+    """
+    from .models import Book, Recording
+    # through the change tracking querysets, so that search hits show the cover
+    Recording.objects.filter(audio_file=audio_name).exclude(cover=cover).update(cover=cover)
+    Book.objects.filter(recording__audio_file=audio_name, cover='').update(cover=cover)
+    logger.debug(f"set the cover {cover} of {audio_name}")
+
+
+def _built(audio_name: str, future: Future):
+    with _pending_lock:
+        _pending.discard(audio_name)
+    if future.exception() is not None:
+        logger.error(f"failed to make the thumbnails of {audio_name}: {future.exception()}")
+        return
+    cover = future.result()
+    if not cover:
+        return
+    try:
+        set_cover(audio_name, cover)
+    finally:
+        connections.close_all()  # of this (executor management) thread
+
+
+_executor: t.Optional[ProcessPoolExecutor] = None
+_executor_pid: t.Optional[int] = None
+_pending: t.Set[str] = set()  # names of the audio files whose thumbnails this process is making
+_pending_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Process pool for making thumbnails (it doesn't survive forking)"""
+    global _executor, _executor_pid
+    with _pending_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(getattr(settings, 'COVER_WORKERS', 1))
+            _executor_pid = os.getpid()
+        return _executor
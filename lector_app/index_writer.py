@@ -0,0 +1,126 @@
+"""
+Index writer service: a process that owns the search indexes' write locks and applies the index
+updates of all worker processes, which send them over a unix socket.
+
+Messages are lines of JSON. Requests look like
+``{"index": <index name>, "updates": [[<pk>, <fields or null>], ...], "flush": <bool>}``, and
+responses like ``{"ok": true, "generation": <index generation or null>}`` or
+``{"ok": false, "error": <message>}``. Updates are queued and written in batches by the
+service's update queues; with ``"flush": true`` the service writes them before responding, and
+the response includes the resulting index generation.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import typing as t
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+logger = logging.getLogger('lector-app index writer')
+
+
+class IndexWriterClient:
+    """Sends index updates to the index writer service. Not thread-safe."""
+
+    def __init__(self, path: str, timeout: float = 10.0):
+        """
+        :param path: path of the service's unix socket
+        :param timeout: time in seconds to wait for the service to respond
+        """
+        self.path = path
+        self.timeout = timeout
+        self._socket: t.Optional[socket.socket] = None
+        self._file = None
+        self._pid: t.Optional[int] = None
+
+    def send(self, index_name: str, updates: t.Mapping[str, t.Optional[t.Dict]],
+             flush: bool = False) -> t.Optional[int]:
+        """Send updates to the service.
+
+        :param index_name: name of the index to update
+        :param updates: updates to apply, by primary key
+        :param flush: whether the service should write the updates before responding
+        :return: the index generation after writing the updates, if ``flush`` is true
+        :raises OSError: if the service can't be reached or fails to apply the updates
+        """
+        message = json.dumps({'index': index_name, 'updates': list(updates.items()),
+                              'flush': flush}, cls=DjangoJSONEncoder)
+        try:
+            file = self._connect()
+            file.write(message.encode('utf-8') + b'\n')
+            file.flush()
+            response = file.readline()
+        except OSError:
+            self.close()
+            raise
+        if not response:
+            self.close()
+            raise ConnectionError(f"index writer service at {self.path} closed the connection")
+        response = json.loads(response)
+        if not response['ok']:
+            raise OSError(f"index writer service failed to apply updates: {response['error']}")
+        return response['generation']
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+    def _connect(self):
+        if self._socket is None or self._pid != os.getpid():
+            # connections are not shared with forked processes
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(self.timeout)
+            self._socket.connect(self.path)
+            self._file = self._socket.makefile('rwb')
+            self._pid = os.getpid()
+        return self._file
+
+
+class IndexWriterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The index writer service. Applies the updates it receives to the given indexes, through
+    their update queues (which write in batches)."""
+    daemon_threads = True
+
+    def __init__(self, path: str, shards: t.Iterable):
+        """
+        :param path: path of the unix socket to listen on
+        :param shards: :class:`lector_app.search.IndexShard` objects whose indexes are updated
+            by the service
+        """
+        self.shards = {shard.index_name: shard for shard in shards}
+        for shard in self.shards.values():
+            shard.updates.client = None  # the service writes to the indexes itself
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, IndexWriterRequestHandler)
+
+    def apply(self, message: t.Mapping[str, t.Any]) -> t.Optional[int]:
+        """Apply the updates in a request message
+
+        :return: the index generation, if the message asks for a flush
+        """
+        shard = self.shards[message['index']]
+        shard.updates.put({pk: None if fields is None else shard.decode_fields(fields)
+                           for pk, fields in message['updates']})
+        if message['flush']:
+            shard.flush()
+            return shard.index.latest_generation()
+        return None
+
+
+class IndexWriterRequestHandler(socketserver.StreamRequestHandler):
+    server: IndexWriterServer
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {'ok': True, 'generation': self.server.apply(json.loads(line))}
+            except Exception as error:
+                logger.exception("failed to apply index updates")
+                response = {'ok': False, 'error': repr(error)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
@@ -0,0 +1,234 @@
+"""
+Write-side machinery for search indexes: buffering, coalescing and batching index updates
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+from functools import partial
+
+from django.db import transaction
+from django.db.models import QuerySet
+from django.dispatch import Signal
+from whoosh.index import LockError
+
+from .index_writer import IndexWriterClient
+
+
+logger = logging.getLogger('lector-app indexing')
+
+# sent by ChangeTrackingQuerySet after bulk operations, which don't send model signals; pks is
+# None if the primary keys of the affected rows are unknown (e.g. bulk creation with SQLite)
+bulk_changed = Signal(providing_args=['pks', 'fields', 'using'])
+
+# a pending update is either a dictionary of index field values (add/update the document) or
+# None (delete the document)
+PendingUpdate = t.Optional[t.Dict[str, str]]
+
+
+class IndexUpdateQueue:
+    """Buffers updates to a search index and applies them in batches.
+
+    Updates are only queued once the database transaction that produced them commits (they are
+    dropped if it rolls back), and are coalesced by primary key, so that only the latest update to
+    each document gets written. A background flusher thread writes the queued updates with a
+    single writer and commit per batch, as soon as either ``max_batch_size`` updates are queued or
+    the oldest queued update has waited for ``max_latency`` seconds.
+
+    If ``writer_socket`` is given, batches are sent to the index writer service listening on it
+    (see :mod:`lector_app.index_writer`) instead, so that worker processes don't compete for the
+    index's write lock; they are written locally while the service is unreachable.
+    """
+
+    def __init__(self, engine, max_latency: float = 1.0, max_batch_size: int = 256,
+                 writer_timeout: float = 5.0, writer_socket: t.Optional[str] = None):
+        """
+        :param engine: the :class:`lector_app.search.IndexShard` whose index is updated
+        :param max_latency: maximum time in seconds an update waits before being written
+        :param max_batch_size: maximum number of updates written with a single commit
+        :param writer_timeout: time in seconds to wait trying to acquire the index's write lock
+        :param writer_socket: path of the unix socket of the index writer service, if any
+        """
+        self.engine = engine
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+        self.writer_timeout = writer_timeout
+        self.client = IndexWriterClient(writer_socket) if writer_socket else None
+
+        self._pending: t.MutableMapping[str, PendingUpdate] = OrderedDict()
+        self._oldest: t.Optional[float] = None  # time at which the oldest pending update was put
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()  # serialises batches within this process
+        self._flusher: t.Optional[threading.Thread] = None
+        self._flusher_pid: t.Optional[int] = None
+        atexit.register(self.flush)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def update(self, pk: str, fields: t.Dict[str, str], using: t.Optional[str] = None):
+        """Queue an update of the document with primary key ``pk`` once the current transaction
+        commits.
+
+        :param pk: primary key of the document
+        :param fields: the document's index field values
+        :param using: alias of the database whose transaction the update is tied to
+        """
+        transaction.on_commit(partial(self.put, {pk: fields}), using=using)
+
+    def delete(self, pk: str, using: t.Optional[str] = None):
+        """Queue a deletion of the document with primary key ``pk`` once the current transaction
+        commits.
+
+        :param pk: primary key of the document
+        :param using: alias of the database whose transaction the deletion is tied to
+        """
+        transaction.on_commit(partial(self.put, {pk: None}), using=using)
+
+    def flush(self):
+        """Write all pending updates to the index now. Blocking operation."""
+        while self._flush_batch():
+            pass
+        if self.client is not None:
+            with self._write_lock:
+                self._send({}, flush=True)
+
+    def put(self, updates: t.Mapping[str, PendingUpdate]):
+        """Queue updates right away, regardless of any transaction.
+
+        :param updates: mapping of primary keys to pending updates
+        """
+        with self._lock:
+            for pk, fields in updates.items():
+                self._pending.pop(pk, None)
+                self._pending[pk] = fields
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._ensure_flusher()
+            self._wakeup.notify()
+
+    def _requeue(self, batch: t.Mapping[str, PendingUpdate]):
+        """Put back a batch that could not be written, without overriding newer updates"""
+        with self._lock:
+            for pk, fields in batch.items():
+                self._pending.setdefault(pk, fields)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._wakeup.notify()
+
+    def _pop_batch(self) -> t.Dict[str, PendingUpdate]:
+        batch = {}
+        while self._pending and len(batch) < self.max_batch_size:
+            pk, fields = self._pending.popitem(last=False)
+            batch[pk] = fields
+        self._oldest = time.monotonic() if self._pending else None
+        return batch
+
+    def _ensure_flusher(self):
+        """Start the flusher thread, unless it is already running in this process (it doesn't
+        survive forking, e.g. into gunicorn workers)."""
+        if self._flusher is not None and self._flusher_pid == os.getpid() \
+                and self._flusher.is_alive():
+            return
+        self._flusher_pid = os.getpid()
+        self._flusher = threading.Thread(target=self._run, daemon=True,
+                                         name=f'index-flusher-{self.engine.index_name}')
+        self._flusher.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+                # the pending updates may get flushed by another thread while waiting
+                while self._pending and len(self._pending) < self.max_batch_size:
+                    remaining = self._oldest + self.max_latency - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+            try:
+                self._flush_batch()
+            except LockError:
+                logger.warning(f"index {self.engine.index_name} is locked; retrying later")
+                time.sleep(self.max_latency)
+            except Exception:
+                logger.exception(f"failed to write updates to index {self.engine.index_name}")
+
+    def _flush_batch(self) -> int:
+        """Take a batch of pending updates and write it to the index. Batches are taken and
+        written while holding the write lock, so that they are applied in order.
+
+        :return: the number of updates written
+        """
+        with self._write_lock:
+            with self._lock:
+                batch = self._pop_batch()
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+            except LockError:
+                self._requeue(batch)
+                raise
+        return len(batch)
+
+    def _write(self, batch: t.Mapping[str, PendingUpdate]):
+        if self.client is not None and self._send(batch):
+            return
+        pk_name = self.engine.pk_name
+        self.engine.refresh_index()
+        writer = self.engine.index.writer(timeout=self.writer_timeout)
+        try:
+            for pk, fields in batch.items():
+                if fields is None:
+                    writer.delete_by_term(pk_name, pk)
+                else:
+                    writer.update_document(**fields)
+        except BaseException:
+            writer.cancel()
+            raise
+        # segments are merged in the background (see lector_app.maintenance)
+        writer.commit(merge=False)
+        self.engine.index_written(batch, writer.generation)
+        logger.debug(f"wrote {len(batch)} updates to index {self.engine.index_name}")
+
+    def _send(self, batch: t.Mapping[str, PendingUpdate], flush: bool = False) -> bool:
+        """Send a batch to the index writer service
+
+        :return: whether the service took the batch
+        """
+        try:
+            self.client.send(self.engine.index_name, batch, flush=flush)
+        except OSError as error:
+            logger.warning(f"index writer service unavailable ({error}); writing "
+                           f"{len(batch)} updates to index {self.engine.index_name} locally")
+            return False
+        logger.debug(f"sent {len(batch)} updates for index {self.engine.index_name} to the index "
+                     f"writer service")
+        return True
+
+
+class ChangeTrackingQuerySet(QuerySet):
+    """QuerySet that reports bulk updates and creations, which bypass the model signals, by
+    sending :data:`bulk_changed`. Models that search indexes depend on should use it as their
+    manager, so that the indexes don't miss changes."""
+
+    def update(self, **kwargs):
+        pks = list(self.values_list('pk', flat=True))
+        rows = super().update(**kwargs)
+        bulk_changed.send(sender=self.model, pks=pks, fields=set(kwargs), using=self.db)
+        return rows
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        pks = [obj.pk for obj in objs]
+        bulk_changed.send(sender=self.model, pks=None if None in pks else pks, fields=None,
+                          using=self.db)
+        return objs
@@ -0,0 +1,186 @@
+"""
+Search index maintenance: merging segments in the background, and index statistics
+"""
+import logging
+import os
+import threading
+import time
+import typing as t
+from datetime import date, datetime
+
+from whoosh.index import LockError
+from whoosh.reading import SegmentReader
+
+
+logger = logging.getLogger('lector-app maintenance')
+
+
+class IndexStats(t.NamedTuple):
+    """Statistics of the current generation of an index"""
+    name: str  # name of the index
+    generation: int  # index generation
+    segments: int  # number of segments
+    doc_count: int  # number of live documents
+    deleted: int  # number of deleted documents that still take up space in segments
+    size: int  # size of the segment files on disk, in bytes
+
+
+class TieredMergePolicy:
+    """Merge policy for whoosh writers (see the ``mergetype`` argument of
+    :method:`whoosh.writing.SegmentWriter.commit`) that bounds the number of segments and the
+    space taken up by deleted documents.
+
+    Segments in which more than ``max_deleted_ratio`` of the documents are deleted are rewritten.
+    If there are still more than ``max_segments`` segments, the smallest segments are merged into
+    one, leaving out segments with more than ``max_merged_docs`` documents (which are only ever
+    rewritten by optimising the index).
+    """
+
+    def __init__(self, max_segments: int = 10, max_deleted_ratio: float = 0.2,
+                 max_merged_docs: int = 500000):
+        """
+        :param max_segments: maximum number of segments to keep
+        :param max_deleted_ratio: maximum proportion of deleted documents in a segment
+        :param max_merged_docs: maximum number of documents of segments merged to reduce the
+            number of segments
+        """
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+        self.max_merged_docs = max_merged_docs
+
+    def select(self, segments: t.Sequence) -> t.List:
+        """Returns the segments that should be merged"""
+        selected = [segment for segment in segments
+                    if segment.deleted_count() > segment.doc_count_all() * self.max_deleted_ratio]
+        rest = sorted((segment for segment in segments if segment not in selected),
+                      key=lambda segment: segment.doc_count())
+        # the merged segment counts as one
+        excess = len(rest) + bool(selected) - self.max_segments
+        if excess > 0:
+            candidates = [segment for segment in rest
+                          if segment.doc_count() <= self.max_merged_docs]
+            selected += candidates[:excess + 1 - bool(selected)]
+        return selected if len(selected) > 1 or any(s.deleted_count() for s in selected) else []
+
+    def __call__(self, writer, segments: t.Sequence) -> t.List:
+        selected = self.select(segments)
+        for segment in selected:
+            reader = SegmentReader(writer.storage, writer.schema, segment)
+            writer.add_reader(reader)
+            reader.close()
+        return [segment for segment in segments if segment not in selected]
+
+
+class IndexMaintenance:
+    """Keeps the shards of a search engine's index compact.
+
+    Index updates are committed without merging segments, which keeps writes fast; instead, a
+    background thread checks the shards every ``interval`` seconds and merges segments according
+    to ``policy``, and optimises each shard (merges all its segments into one) once a day during
+    the off-peak hours. Merging doesn't block searches, which keep using the segments they read
+    until their searchers are refreshed; index writes wait for it (see
+    :class:`lector_app.indexing.IndexUpdateQueue`).
+
+    The thread is started by the first write to the index in a process, so maintenance runs in
+    the processes that write to the index (e.g. only in the index writer service, if there is
+    one).
+    """
+
+    def __init__(self, engine, policy: TieredMergePolicy, interval: float = 60.0,
+                 optimize_hours: t.Optional[t.Tuple[int, int]] = None):
+        """
+        :param engine: the :class:`lector_app.search.AbstractSearchEngine` whose index is
+            maintained
+        :param policy: the merge policy
+        :param interval: time in seconds between checks of the shards
+        :param optimize_hours: the off-peak hours, as a ``(start, end)`` range of hours of the day
+            (local time), or ``None`` to never optimise in the background
+        """
+        self.engine = engine
+        self.policy = policy
+        self.interval = interval
+        self.optimize_hours = optimize_hours
+
+        self._optimized: t.Dict[str, date] = {}  # day of the last optimisation, by shard name
+        self._thread: t.Optional[threading.Thread] = None
+        self._thread_pid: t.Optional[int] = None
+        self._lock = threading.Lock()
+
+    def stats(self) -> t.List[IndexStats]:
+        """Returns the statistics of all shards"""
+        stats = []
+        for shard in self.engine.shards:
+            shard.refresh_index()
+            segments = shard.index._segments()
+            size = sum(shard.index.storage.file_length(filename)
+                       for segment in segments
+                       for filename in segment.list_files(shard.index.storage))
+            stats.append(IndexStats(shard.active_name, shard.index.latest_generation(),
+                                    len(segments), sum(s.doc_count() for s in segments),
+                                    sum(s.deleted_count() for s in segments), size))
+        return stats
+
+    def compact(self, shard, optimize=False, timeout: float = 0.0) -> bool:
+        """Merge the segments of a shard that the merge policy selects, or all of them.
+        Blocking operation.
+
+        :param shard: the :class:`lector_app.search.IndexShard` to compact
+        :param optimize: whether to merge all segments into one
+        :param timeout: time in seconds to wait trying to acquire the shard's write lock
+        :return: whether any segments were merged
+        :raises whoosh.index.LockError: if the write lock couldn't be acquired
+        """
+        shard.refresh_index()
+        segments = shard.index._segments()
+        if optimize:
+            needed = len(segments) > 1 or any(s.deleted_count() for s in segments)
+        else:
+            needed = bool(self.policy.select(segments))
+        if not needed:
+            return False
+        started = time.monotonic()
+        writer = shard.index.writer(timeout=timeout)
+        try:
+            if optimize:
+                writer.commit(optimize=True)
+            else:
+                writer.commit(mergetype=self.policy)
+        except BaseException:
+            writer.cancel()
+            raise
+        logger.info(f"{'optimised' if optimize else 'merged segments of'} index "
+                    f"{shard.active_name} in {time.monotonic() - started:.2f}s")
+        return True
+
+    def index_written(self):
+        """Called after this process wrote to the index; starts the maintenance thread if it
+        isn't running in this process (it doesn't survive forking)"""
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid() \
+                    and self._thread.is_alive():
+                return
+            self._thread_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name=f'index-maintenance-{self.engine.index_name}')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            for shard in self.engine.shards:
+                optimize = self._optimize_due(shard)
+                try:
+                    self.compact(shard, optimize=optimize)
+                    if optimize:
+                        self._optimized[shard.index_name] = date.today()
+                except LockError:
+                    pass  # the shard is being written to; try again next time
+                except Exception:
+                    logger.exception(f"failed to compact index {shard.active_name}")
+
+    def _optimize_due(self, shard) -> bool:
+        if self.optimize_hours is None:
+            return False
+        now = datetime.now()
+        start, end = self.optimize_hours
+        return start <= now.hour < end and self._optimized.get(shard.index_name) != now.date()
@@ -0,0 +1,34 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from lector_app import covers
+from lector_app.models import Recording
+
+
+class Command(BaseCommand):
+    help = "Make the cover art thumbnails of the recordings' audio files that have no cover yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=max(getattr(settings, 'COVER_WORKERS', 1), 1),
+                            help="number of worker processes")
+
+    def handle(self, *args, workers=1, **options):
+        audio_names = Recording.objects.exclude(audio_file='').filter(cover='') \
+            .values_list('audio_file', flat=True).distinct()
+        made, failed = 0, 0
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(covers.build_thumbnails, default_storage.path(audio_name),
+                                       settings.MEDIA_ROOT): audio_name
+                       for audio_name in audio_names}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    self.stderr.write(f"{futures[future]}: {future.exception()}")
+                    failed += 1
+                elif future.result():
+                    covers.set_cover(futures[future], future.result())
+                    made += 1
+        self.stdout.write(f"Made the thumbnails of {made} audio files ({failed} failed)")
@@ -0,0 +1,39 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from lector_app import waveforms
+from lector_app.models import Recording
+
+
+class Command(BaseCommand):
+    help = "Compute the waveform peaks of the recordings' audio files that don't have them yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=max(getattr(settings, 'WAVEFORM_WORKERS', 2), 1),
+                            help="number of worker processes")
+        parser.add_argument('--rebuild', action='store_true',
+                            help="also recompute the peaks that already exist")
+
+    def handle(self, *args, workers=2, rebuild=False, **options):
+        audio_names = Recording.objects.exclude(audio_file='') \
+            .values_list('audio_file', flat=True).distinct()
+        ffmpeg = getattr(settings, 'WAVEFORM_FFMPEG', 'ffmpeg')
+        built, failed = 0, 0
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {}
+            for audio_name in audio_names:
+                name = waveforms.peaks_name(audio_name)
+                if rebuild or not default_storage.exists(name):
+                    futures[executor.submit(waveforms.build_peaks, default_storage.path(audio_name),
+                                            default_storage.path(name), ffmpeg)] = name
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    self.stderr.write(f"{futures[future]}: {future.exception()}")
+                    failed += 1
+                else:
+                    built += 1
+        self.stdout.write(f"Computed the peaks of {built} audio files ({failed} failed)")
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from lector_app.models import AudioFile, Upload
+
+
+class Command(BaseCommand):
+    help = "Delete the uploads that weren't finished within UPLOAD_EXPIRY_HOURS, and their files, " \
+           "and the audio files that no recording references"
+
+    def handle(self, *args, **options):
+        hours = getattr(settings, 'UPLOAD_EXPIRY_HOURS', 48)
+        expired = Upload.objects.filter(created__lt=timezone.now() - timedelta(hours=hours))
+        count = 0
+        for upload in expired:  # deleted one by one, so that their part files are deleted too
+            upload.delete()
+            count += 1
+        self.stdout.write(f"Deleted {count} expired uploads")
+        # left behind if their last recording's deletion was interrupted before they were deleted
+        count = AudioFile.delete_unreferenced()
+        self.stdout.write(f"Deleted {count} unreferenced audio files")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from lector_app import search
+
+
+class Command(BaseCommand):
+    help = "Report search index statistics, and merge index segments with --compact or --optimize"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compact', action='store_true',
+                            help="merge the segments selected by the merge policy")
+        parser.add_argument('--optimize', action='store_true',
+                            help="merge all segments of each index into one")
+        parser.add_argument('--timeout', type=float, default=10.0,
+                            help="time in seconds to wait for each index's write lock")
+
+    def handle(self, *args, compact=False, optimize=False, timeout=10.0, **options):
+        for engine in search.engines.values():
+            if compact or optimize:
+                for shard in engine.shards:
+                    if engine.maintenance.compact(shard, optimize=optimize, timeout=timeout):
+                        self.stdout.write(f"Compacted index {shard.active_name}")
+            for stats in engine.maintenance.stats():
+                self.stdout.write(f"{stats.name} (generation {stats.generation}): "
+                                  f"{stats.segments} segments, {stats.doc_count} documents, "
+                                  f"{stats.deleted} deleted, {stats.size / 2 ** 20:.1f} MiB")
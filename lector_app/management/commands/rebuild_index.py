@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from lector_app import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the search indexes from scratch, or bring it up to date with --incremental"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help="only reindex the rows that changed since they were last indexed")
+        parser.add_argument('--timeout', type=float, default=10.0,
+                            help="time in seconds to wait for the index's write lock")
+
+    def handle(self, *args, incremental=False, timeout=10.0, **options):
+        for engine in search.engines.values():
+            if incremental:
+                for shard in engine.shards:
+                    shard.updates.writer_timeout = timeout
+                count = engine.catch_up()
+                engine.flush()
+                self.stdout.write(f"Applied {count} updates to index {engine.index_name}")
+            else:
+                engine.reindex_all(timeout=timeout)
+                self.stdout.write(f"Rebuilt index {engine.index_name}")
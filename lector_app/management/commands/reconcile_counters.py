@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from lector_app.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = "Recompute the upload and library counters of all user profiles"
+
+    def handle(self, *args, **options):
+        count = UserProfile.objects.recount()
+        self.stdout.write(f"Recomputed the counters of {count} user profiles")
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lector_app import search
+from lector_app.index_writer import IndexWriterServer
+
+
+class Command(BaseCommand):
+    help = "Run the index writer service, which applies the search index updates of all workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket',
+                            default=getattr(settings, 'SEARCH_INDEX_WRITER_SOCKET', None),
+                            help="path of the unix socket to listen on "
+                                 "(default: SEARCH_INDEX_WRITER_SOCKET)")
+
+    def handle(self, *args, socket=None, **options):
+        if not socket:
+            raise CommandError("no socket path given and SEARCH_INDEX_WRITER_SOCKET is not set")
+        engines = list(search.engines.values())
+        shards = [shard for engine in engines for shard in engine.shards]
+        with IndexWriterServer(socket, shards) as server:
+            for engine in engines:
+                engine.catch_up()
+            self.stdout.write(f"Index writer service listening on {socket}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                for engine in engines:
+                    engine.flush()
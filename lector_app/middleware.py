@@ -0,0 +1,46 @@
+"""
+Request-scoped access to the profile and library of the logged in user
+"""
+import typing as t
+
+from django.utils.functional import cached_property
+
+from .models import UserProfile
+
+
+class UserState:
+    """The profile and library of a user, each loaded when first used, at most once"""
+
+    def __init__(self, user):
+        """
+        :param user: the user (maybe anonymous)
+        """
+        self.user = user
+
+    @cached_property
+    def profile(self) -> t.Optional[UserProfile]:
+        """The profile of the user (``None`` for anonymous users and users without a profile)"""
+        if not self.user.is_authenticated:
+            return None
+        return UserProfile.objects.select_related('user').filter(user=self.user).first()
+
+    @cached_property
+    def library(self) -> t.FrozenSet[int]:
+        """Primary keys of the recordings in the user's library (empty for anonymous users; see
+        :method:`lector_app.models.UserProfile.library_pks`), so that library membership of any
+        number of recordings can be checked without further queries"""
+        if self.profile is None:
+            return frozenset()
+        return self.profile.library_pks()
+
+
+class UserStateMiddleware:
+    """Adds the :class:`UserState` of the logged in user to each request as
+    ``request.user_state``. Should come after ``AuthenticationMiddleware``."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user_state = UserState(request.user)
+        return self.get_response(request)
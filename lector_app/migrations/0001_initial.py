@@ -0,0 +1,60 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import lector_app.utils
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Author',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_name', models.CharField(max_length=32)),
+                ('last_name', models.CharField(max_length=32)),
+            ],
+            bases=(lector_app.utils.HasHumanName, models.Model),
+        ),
+        migrations.CreateModel(
+            name='Book',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=128)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lector-app.Author')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Recording',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('duration', models.DurationField()),
+                ('audio_file', models.FileField(upload_to='audio_files/')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lector-app.Book')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('voice_type', models.CharField(max_length=64)),
+                ('library', models.ManyToManyField(blank=True, to='lector-app.Recording')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            bases=(models.Model, lector_app.utils.HasHumanName),
+        ),
+        migrations.AddField(
+            model_name='recording',
+            name='reader',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lector-app.UserProfile'),
+        ),
+    ]
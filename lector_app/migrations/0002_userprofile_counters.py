@@ -0,0 +1,51 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:50
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def count(apps, schema_editor):
+    """Compute the counters of the existing profiles, like UserProfileQuerySet.recount"""
+    UserProfile = apps.get_model('lector-app', 'UserProfile')
+    Recording = apps.get_model('lector-app', 'Recording')
+    db = schema_editor.connection.alias
+    uploads = {row['reader']: row for row in Recording.objects.using(db).order_by()
+               .values('reader').annotate(count=Count('pk'), duration=Sum('duration'))}
+    libraries = dict(UserProfile.library.through.objects.using(db).order_by()
+                     .values('userprofile').annotate(count=Count('pk'))
+                     .values_list('userprofile', 'count'))
+    profiles = list(UserProfile.objects.using(db).only('pk'))
+    for profile in profiles:
+        row = uploads.get(profile.pk, {'count': 0, 'duration': timedelta(0)})
+        profile.upload_count = row['count']
+        profile.narrated_seconds = int(row['duration'].total_seconds())
+        profile.library_count = libraries.get(profile.pk, 0)
+    UserProfile.objects.using(db).bulk_update(
+        profiles, ['upload_count', 'narrated_seconds', 'library_count'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lector-app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='library_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='narrated_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='upload_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lector-app', '0002_userprofile_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Upload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=128)),
+                ('author_first_name', models.CharField(max_length=32)),
+                ('author_last_name', models.CharField(max_length=32)),
+                ('duration', models.DurationField()),
+                ('filename', models.CharField(max_length=128)),
+                ('size', models.BigIntegerField()),
+                ('received', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('reader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lector-app.UserProfile')),
+            ],
+        ),
+    ]
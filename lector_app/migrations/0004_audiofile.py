@@ -0,0 +1,40 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lector-app', '0003_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AudioFile',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('duration', models.DurationField()),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='upload',
+            name='duration',
+        ),
+        # uploads started before chunks were checksummed can't be finished; they expire (see the
+        # clean_uploads command)
+        migrations.AddField(
+            model_name='upload',
+            name='chunk_size',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='digests',
+            field=models.TextField(default=''),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.3 on 2026-10-18 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lector-app', '0004_audiofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cover',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='recording',
+            name='cover',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
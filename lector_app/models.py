@@ -1,23 +1,35 @@
+import os
+import shutil
 import typing as t
+import uuid
+from datetime import timedelta
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import Count, F, Sum
 from django.db.models.base import ModelBase
+from django.db.models.functions import Greatest
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django_cleanup import cleanup
 
-from . import search
-from .utils import HasHumanName
+from . import covers, mp3, search, uploads, waveforms
+from .covers import HasCover
+from .indexing import ChangeTrackingQuerySet
+from .utils import HasHumanName, mkdir
 
 
 # ----- Abstract Models & metaclasses -----
 
 class IndexedModelMeta(ModelBase):
     """Metaclass for indexed Models.
-    Adds an overridden save() function to the class' definition that re-indexes the saved
-    instance after saving.
     Classes with this metaclass should define an inner class ``SearchEngine`` that is a subclass of
     :class:`lector_app.search.AbstractSearchEngine`.
-    Also adds a ``search_engine`` class field to the Model, which is an instance of the model's
-    ``SearchEngine`` inner class.
+    Adds a ``search_engine`` class field to the Model, which is an instance of the model's
+    ``SearchEngine`` inner class, and which keeps its index up to date as instances of the model
+    (or of the models it depends on) are saved and deleted.
 
     A metaclass is needed to intercept the model class creation before the django model metaclass
     gobbles up all class attributes.
@@ -33,21 +45,61 @@ class IndexedModelMeta(ModelBase):
         model = super().__new__(mcs, name, bases, attrs, **kwargs)
         search_engine_class.model = model
         search_engine = search_engine_class()
+        search_engine.track_changes()
 
-        def save(self, *args, **kwargs):
-            super(model, self).save(*args, **kwargs)
-            search_engine.reindex(self)
-
-        setattr(model, 'save', save)
         setattr(model, 'search_engine', search_engine)
         return model
 
 
+class UserProfileQuerySet(ChangeTrackingQuerySet):
+    def recount(self, uploads=True, library=True, batch_size=500) -> int:
+        """Recompute the denormalised counters of the profiles (see :class:`UserProfile`) from
+        their recordings and libraries, in batches.
+        :param uploads: whether to recompute the upload counters
+        :param library: whether to recompute the library counters
+        :param batch_size: number of profiles recomputed per query
+        :return: the number of updated profiles
+        """
+        fields = []
+        if uploads:
+            fields += ['upload_count', 'narrated_seconds']
+        if library:
+            fields += ['library_count']
+        profiles = list(self.only('pk'))
+        for start in range(0, len(profiles), batch_size):
+            batch = {profile.pk: profile for profile in profiles[start:start + batch_size]}
+            if uploads:
+                totals = {row['reader']: row for row in Recording.objects
+                          .filter(reader__in=batch).order_by().values('reader')
+                          .annotate(count=Count('pk'), duration=Sum('duration'))}
+                for pk, profile in batch.items():
+                    row = totals.get(pk, {'count': 0, 'duration': timedelta(0)})
+                    profile.upload_count = row['count']
+                    profile.narrated_seconds = int(row['duration'].total_seconds())
+            if library:
+                counts = dict(UserProfile.library.through.objects
+                              .filter(userprofile__in=batch).order_by().values('userprofile')
+                              .annotate(count=Count('pk')).values_list('userprofile', 'count'))
+                for pk, profile in batch.items():
+                    profile.library_count = counts.get(pk, 0)
+            UserProfile.objects.bulk_update(batch.values(), fields)
+        return len(profiles)
+
+    recount.alters_data = True
+
+
 # ----- Concrete Models -----
 class UserProfile(models.Model, HasHumanName):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     library = models.ManyToManyField('Recording', blank=True)
     voice_type = models.CharField(max_length=64)
+    # denormalised counters, kept up to date as recordings are saved and deleted and libraries
+    # change (bulk updates of recordings go unnoticed; see the reconcile_counters command)
+    upload_count = models.PositiveIntegerField(default=0)
+    library_count = models.PositiveIntegerField(default=0)
+    narrated_seconds = models.PositiveIntegerField(default=0)  # total duration of the uploads
+
+    objects = UserProfileQuerySet.as_manager()
 
     @property
     def first_name(self):
@@ -57,43 +109,337 @@ class UserProfile(models.Model, HasHumanName):
     def last_name(self):
         return self.user.last_name
 
+    @property
+    def narrated_duration(self) -> timedelta:
+        return timedelta(seconds=self.narrated_seconds)
+
+    def library_pks(self) -> t.FrozenSet[int]:
+        """Primary keys of the recordings in the user's library. They are cached in the
+        ``LIBRARY_CACHE`` cache (shared by all processes, if its backend allows) until the library
+        changes, or for ``LIBRARY_CACHE_TIMEOUT`` seconds."""
+        cache = caches[getattr(settings, 'LIBRARY_CACHE', 'default')]
+        key = _library_cache_key(self.pk)
+        pks = cache.get(key)
+        if pks is None:
+            pks = frozenset(self.library.values_list('pk', flat=True))
+            cache.set(key, pks, getattr(settings, 'LIBRARY_CACHE_TIMEOUT', 3600))
+        return pks
+
     def __str__(self):
         return f"{self.full_name} ({self.user})"
 
 
-class Author(HasHumanName, models.Model):
+class Author(HasHumanName, models.Model, metaclass=IndexedModelMeta):
     first_name = models.CharField(max_length=32)
     last_name = models.CharField(max_length=32)
 
+    objects = ChangeTrackingQuerySet.as_manager()
+
+    class SearchEngine(search.AbstractSearchEngine):
+        def __init__(self):
+            schema = search.Schema(author_name=search.fields.TEXT(spelling=True))
+            super().__init__(self.model, schema, index_name='lector-app.Author')
+
+        def extract_search_fields(self, author: 'Author') -> t.Dict[str, t.Any]:
+            return dict(author_name=author.full_name)
+
     def __str__(self):
         return self.full_name
 
 
-class Book(models.Model):
+class Book(models.Model, HasCover, metaclass=IndexedModelMeta):
     title = models.CharField(max_length=128)
     author = models.ForeignKey(Author, on_delete=models.CASCADE)
+    cover = models.CharField(max_length=64, blank=True, default='')  # see lector_app.covers
+
+    objects = ChangeTrackingQuerySet.as_manager()
+
+    class SearchEngine(search.AbstractSearchEngine):
+        select_related = ('author',)
+        annotations = {'recording_count': models.Count('recording')}
+        dependencies = {
+            Author: search.Dependency('author', fields={'first_name', 'last_name'}),
+            'lector-app.Recording': search.Dependency('recording', fields={'book'}),
+        }
+
+        def __init__(self):
+            schema = search.Schema(book_title=search.fields.TEXT(spelling=True),
+                                   author_name=search.fields.TEXT(spelling=True),
+                                   recording_count=search.fields.NUMERIC(sortable=True))
+            super().__init__(self.model, schema, index_name='lector-app.Book')
+
+        def extract_search_fields(self, book: 'Book') -> t.Dict[str, t.Any]:
+            recording_count = getattr(book, 'recording_count', None)
+            if recording_count is None:  # not fetched with self.annotations
+                recording_count = book.recording_set.count()
+            return dict(book_title=book.title, author_name=book.author.full_name,
+                        recording_count=recording_count)
 
     def __str__(self):
         return f"{self.title}, by {self.author}"
 
 
-class Recording(models.Model, metaclass=IndexedModelMeta):
+@cleanup.ignore  # audio files are shared, and deleted with their last recording (see AudioFile)
+class Recording(models.Model, HasCover, metaclass=IndexedModelMeta):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     reader = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
     duration = models.DurationField()
     audio_file = models.FileField(upload_to='audio_files/')
+    cover = models.CharField(max_length=64, blank=True, default='')  # see lector_app.covers
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = ChangeTrackingQuerySet.as_manager()
 
     class SearchEngine(search.AbstractSearchEngine):
+        modified_field = 'modified'
+        select_related = ('book__author', 'reader__user')
+        annotations = {'library_count': models.Count('userprofile')}
+        dependencies = {
+            Book: search.Dependency('book', fields={'title', 'author', 'cover'}),
+            Author: search.Dependency('book__author'),
+            UserProfile: search.Dependency('reader', fields={'user', 'voice_type'}),
+            User: search.Dependency('reader__user', fields={'username'}),
+        }
+        m2m_dependencies = (UserProfile.library,)
+        facets = {
+            'voice_type': search.sorting.FieldFacet('voice_type', maptype=search.sorting.Count),
+            'author': search.sorting.FieldFacet('author_id', maptype=search.sorting.Count),
+            'duration': search.sorting.RangeFacet('duration_seconds', 0, 4 * 3600,
+                                                  [30 * 60, 30 * 60, 60 * 60, 2 * 3600],
+                                                  hardend=True, maptype=search.sorting.Count),
+        }
+        # the fields shown by the cached rendered hits (see views._search_hits)
+        version_fields = ('book_title', 'author_name', 'reader_name', 'voice_type',
+                          'duration_seconds', 'cover')
+
         def __init__(self):
             schema = search.Schema(book_title=search.fields.TEXT(spelling=True),
                                    author_name=search.fields.TEXT(spelling=True),
-                                   reader_name=search.fields.TEXT(spelling=True))
+                                   reader_name=search.fields.TEXT(spelling=True),
+                                   duration_seconds=search.fields.NUMERIC(sortable=True),
+                                   popularity=search.fields.NUMERIC(sortable=True),
+                                   voice_type=search.fields.ID(sortable=True),
+                                   author_id=search.fields.ID(sortable=True),
+                                   cover=search.fields.STORED)
             super().__init__(self.model, schema, index_name='lector-app.Recording')
 
-        def extract_search_fields(self, recording: 'Recording') -> t.Dict[str, str]:
+        def extract_search_fields(self, recording: 'Recording') -> t.Dict[str, t.Any]:
             book, author, reader = recording.book, recording.book.author, recording.reader
+            popularity = getattr(recording, 'library_count', None)
+            if popularity is None:  # not fetched with self.annotations
+                popularity = recording.userprofile_set.count()
             return dict(book_title=book.title, author_name=author.full_name,
-                        reader_name=reader.user.username)
+                        reader_name=reader.user.username,
+                        duration_seconds=int(recording.duration.total_seconds()),
+                        popularity=popularity,
+                        voice_type=reader.voice_type, author_id=str(author.pk),
+                        cover=recording.cover or book.cover)
 
     def __str__(self):
         return f"{self.book.title}, by {self.book.author} – narrated by {self.reader}"
+
+
+class Upload(models.Model):
+    """A resumable upload of the audio file of a new recording, which is received in chunks (see
+    :mod:`lector_app.uploads`). The recording is only created once the whole file is received."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    reader = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
+    title = models.CharField(max_length=128)
+    author_first_name = models.CharField(max_length=32)
+    author_last_name = models.CharField(max_length=32)
+    filename = models.CharField(max_length=128)  # name of the file on the uploader's device
+    size = models.BigIntegerField()  # in bytes
+    chunk_size = models.PositiveIntegerField()  # size of all chunks but the last, in bytes
+    received = models.BigIntegerField(default=0)  # number of bytes received so far
+    digests = models.TextField(default='')  # hexadecimal SHA-256 digests of the received chunks
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes), by {self.reader}"
+
+
+class AudioFile(models.Model):
+    """A stored audio file, named after its content address (see
+    :func:`lector_app.uploads.content_address`), so that recordings of the same file share it.
+    ``references`` counts the recordings whose ``audio_file`` it is; the file is deleted with the
+    last of them."""
+    sha256 = models.CharField(max_length=64, primary_key=True)  # the content address
+    name = models.CharField(max_length=128, unique=True)  # path relative to MEDIA_ROOT
+    size = models.BigIntegerField()  # in bytes
+    duration = models.DurationField()
+    references = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} ({self.references} recordings)"
+
+    @classmethod
+    def store(cls, path: str, sha256: t.Optional[str] = None, move: bool = False) -> 'AudioFile':
+        """The stored audio file with the content of the given file, which is stored (after its
+        duration is read, see :func:`lector_app.mp3.duration`) unless it already was. It is
+        locked until the current transaction ends, so call this in the transaction that
+        references it, lest it is deleted meanwhile for having no references.
+
+        :param path: path of the file
+        :param sha256: the file's content address, if known (it is computed otherwise)
+        :param move: whether to move the file to the storage (or delete it, if its content is
+            already stored), rather than copying it
+        :raises lector_app.mp3.Mp3Error: if the file isn't an MP3 file
+        """
+        sha256 = sha256 or uploads.file_address(path)
+        with transaction.atomic():
+            audio_file = cls.objects.select_for_update().filter(sha256=sha256).first()
+            if audio_file is not None:
+                if move and os.path.exists(path):
+                    os.remove(path)
+                return audio_file
+
+            with open(path, 'rb') as file:
+                duration = mp3.duration(file)
+            name = f'audio_files/{sha256[:2]}/{sha256}.mp3'
+            stored_path = default_storage.path(name)
+            mkdir(settings.MEDIA_ROOT)
+            mkdir(os.path.dirname(os.path.dirname(stored_path)))
+            mkdir(os.path.dirname(stored_path))
+            # concurrent stores of the same content write the same file, and create one instance
+            if move:
+                os.replace(path, stored_path)
+            else:
+                shutil.copyfile(path, stored_path)
+            audio_file, _ = cls.objects.get_or_create(sha256=sha256, defaults=dict(
+                name=name, size=os.path.getsize(stored_path), duration=duration))
+            return audio_file
+
+    @classmethod
+    def delete_unreferenced(cls, names: t.Optional[t.Iterable[str]] = None,
+                            using: str = 'default') -> int:
+        """Delete the audio files that no recording references (and their waveform peaks).
+        They are locked while they are deleted, so that they can't be referenced again meanwhile
+        (see :method:`store`), and their files are deleted before the transaction commits, so
+        that a store that waited for them writes its file afterwards.
+
+        :param names: names of the audio files to consider (all of them by default)
+        :param using: alias of the database
+        :return: the number of deleted audio files
+        """
+        files = cls.objects.using(using).filter(references=0)
+        if names is not None:
+            files = files.filter(name__in=list(names))
+        with transaction.atomic(using=using):
+            deleted = list(files.select_for_update())
+            for audio_file in deleted:
+                audio_file.delete()
+                default_storage.delete(audio_file.name)
+                default_storage.delete(waveforms.peaks_name(audio_file.name))
+        return len(deleted)
+
+
+# ----- Library and upload bookkeeping -----
+def _library_cache_key(profile_pk) -> str:
+    return f'lector-app.library:{profile_pk}'
+
+
+def _invalidate_libraries(profile_pks: t.Iterable[t.Any], using: str):
+    """Drop the cached libraries of the given user profiles now, and again once the current
+    transaction commits, in case they were cached again from before the change meanwhile (see
+    :method:`UserProfile.library_pks`)"""
+    keys = [_library_cache_key(pk) for pk in profile_pks]
+    if keys:
+        cache = caches[getattr(settings, 'LIBRARY_CACHE', 'default')]
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+
+def _count_upload(reader_pk, duration: timedelta, sign: int, using: str):
+    """Add a recording to the upload counters of its reader (or subtract it, if ``sign`` is -1)"""
+    seconds = sign * int(duration.total_seconds())
+    # clamped, in case the counters were off (they are unsigned)
+    UserProfile.objects.using(using).filter(pk=reader_pk).update(
+        upload_count=Greatest(F('upload_count') + sign, 0),
+        narrated_seconds=Greatest(F('narrated_seconds') + seconds, 0))
+
+
+def _recording_unlinked(recording: 'Recording', using: str):
+    """Remove a recording from the libraries it is in, which are about to lose it"""
+    profile_pks = list(recording.userprofile_set.using(using).values_list('pk', flat=True))
+    if profile_pks:
+        UserProfile.objects.using(using).filter(pk__in=profile_pks) \
+            .update(library_count=Greatest(F('library_count') - 1, 0))
+    _invalidate_libraries(profile_pks, using)
+
+
+def _library_changed(sender, instance, action, reverse, pk_set, using, **kwargs):
+    if reverse and action == 'pre_clear':
+        _recording_unlinked(instance, using)
+    elif action in ('post_add', 'post_remove'):
+        # recounted, since pk_set may include recordings that weren't in the library
+        profile_pks = pk_set if reverse else [instance.pk]
+        UserProfile.objects.using(using).filter(pk__in=profile_pks).recount(uploads=False)
+        _invalidate_libraries(profile_pks, using)
+    elif not reverse and action == 'post_clear':
+        UserProfile.objects.using(using).filter(pk=instance.pk).update(library_count=0)
+        _invalidate_libraries([instance.pk], using)
+
+
+def _reference_audio_file(name: str, sign: int, using: str):
+    """Add a reference to the stored audio file with the given name, if it is one (or remove
+    one, if ``sign`` is -1, and delete the file once no recording references it)"""
+    AudioFile.objects.using(using).filter(name=name) \
+        .update(references=Greatest(F('references') + sign, 0))
+    if sign < 0:
+        # unless it is referenced again meanwhile
+        transaction.on_commit(lambda: AudioFile.delete_unreferenced([name], using), using=using)
+
+
+def _recording_saving(sender, instance, raw=False, update_fields=None, using=None, **kwargs):
+    if raw or instance._state.adding:
+        return
+    if update_fields is None or \
+            {'reader', 'reader_id', 'duration', 'audio_file'} & set(update_fields):
+        # the counted values, to be compared with the saved ones by _recording_saved
+        instance._counted = Recording.objects.using(using).filter(pk=instance.pk) \
+            .values_list('reader', 'duration', 'audio_file').first()
+
+
+def _recording_saved(sender, instance, created, raw=False, using=None, **kwargs):
+    counted = instance.__dict__.pop('_counted', None)
+    if raw:
+        return
+    audio_file = instance.audio_file.name
+    if created:
+        _count_upload(instance.reader_id, instance.duration, 1, using)
+        _reference_audio_file(audio_file, 1, using)
+    elif counted is not None:
+        reader_pk, duration, counted_audio_file = counted
+        if (reader_pk, duration) != (instance.reader_id, instance.duration):
+            _count_upload(reader_pk, duration, -1, using)
+            _count_upload(instance.reader_id, instance.duration, 1, using)
+        if counted_audio_file != audio_file:
+            _reference_audio_file(counted_audio_file, -1, using)
+            _reference_audio_file(audio_file, 1, using)
+    if created or (counted is not None and counted[2] != audio_file):
+        def process_audio_file():
+            waveforms.submit(audio_file)
+            covers.submit(audio_file)
+
+        transaction.on_commit(process_audio_file, using=using)
+
+
+def _recording_deleted(sender, instance, using, **kwargs):
+    # deleting a recording deletes its library links without sending m2m_changed
+    _count_upload(instance.reader_id, instance.duration, -1, using)
+    _recording_unlinked(instance, using)
+    _reference_audio_file(instance.audio_file.name, -1, using)
+
+
+m2m_changed.connect(_library_changed, sender=UserProfile.library.through,
+                    dispatch_uid='lector-app.library')
+pre_save.connect(_recording_saving, sender=Recording, dispatch_uid='lector-app.library')
+post_save.connect(_recording_saved, sender=Recording, dispatch_uid='lector-app.library')
+pre_delete.connect(_recording_deleted, sender=Recording, dispatch_uid='lector-app.library')
+
+
+def _upload_deleted(sender, instance, using, **kwargs):
+    transaction.on_commit(lambda: uploads.discard(instance), using=using)
+
+
+post_delete.connect(_upload_deleted, sender=Upload, dispatch_uid='lector-app.uploads')
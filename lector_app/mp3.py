@@ -0,0 +1,251 @@
+"""
+Reading the duration of MP3 files from their frame headers, without decoding them, and their
+cover art from their ID3v2 tag
+"""
+import struct
+import typing as t
+from datetime import timedelta
+
+
+BLOCK_SIZE = 64 * 1024  # bytes read at a time
+SYNC_LIMIT = 2 ** 20  # bytes of junk searched through for a frame
+MAX_TAG_SIZE = 16 * 2 ** 20  # bytes of ID3v2 tags read for cover art
+FRONT_COVER = 3  # ID3v2 picture type
+
+# bitrates in kbit/s, by (MPEG version 1 or not, layer) and bitrate index
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# sample rates in Hz, by version bits (0: MPEG 2.5, 2: MPEG 2, 3: MPEG 1) and sample rate index
+SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+
+class Mp3Error(ValueError):
+    """The file isn't a (supported) MP3 file"""
+
+
+class FrameHeader(t.NamedTuple):
+    """The fields of an MPEG audio frame header that determine the frame's size and duration"""
+    mpeg1: bool
+    layer: int
+    sample_rate: int  # in Hz
+    samples: int  # samples per frame
+    length: int  # length of the frame in bytes, including the header
+    mono: bool
+
+    @classmethod
+    def parse(cls, header: bytes) -> t.Optional['FrameHeader']:
+        """Parse the 4 bytes of a frame header, or return ``None`` if they aren't a valid one
+        (free format frames, whose length is unknown, aren't supported)"""
+        if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+            return None
+        version, layer = (header[1] >> 3) & 3, 4 - ((header[1] >> 1) & 3)
+        bitrate_index, sample_rate_index = header[2] >> 4, (header[2] >> 2) & 3
+        if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            return None
+        mpeg1 = version == 3
+        bitrate = BITRATES[mpeg1, layer][bitrate_index] * 1000
+        sample_rate = SAMPLE_RATES[version][sample_rate_index]
+        padding = (header[2] >> 1) & 1
+        if layer == 1:
+            samples = 384
+            length = (12 * bitrate // sample_rate + padding) * 4
+        else:
+            samples = 1152 if mpeg1 or layer == 2 else 576
+            length = samples // 8 * bitrate // sample_rate + padding
+        return cls(mpeg1, layer, sample_rate, samples, length, header[3] >> 6 == 3)
+
+
+def duration(file: t.BinaryIO) -> timedelta:
+    """The duration of an MP3 file. It is read from the Xing/Info or VBRI header of the first
+    frame if there is one (as encoders write for variable bitrate files), and otherwise
+    computed by walking through the frame headers, reading the file a block at a time.
+
+    :param file: the file, opened in binary mode
+    :raises Mp3Error: if the file has no MPEG audio frames
+    """
+    reader = _BlockReader(file)
+    position, first = _sync(reader, _skip_id3v2(reader))
+    if first is None:
+        raise Mp3Error("no MPEG audio frames found")
+
+    frames = _vbr_frame_count(reader.read(position, first.length), first)
+    if frames is None:
+        frames, header = 0, first
+        while header is not None:
+            frames += 1
+            position += header.length
+            header = FrameHeader.parse(reader.read(position, 4))
+            if header is None and reader.read(position, 3) not in (b'', b'TAG'):
+                position, header = _sync(reader, position)  # skip junk between frames
+    return timedelta(seconds=frames * first.samples / first.sample_rate)
+
+
+def cover_art(file: t.BinaryIO) -> t.Optional[bytes]:
+    """The image data of the cover art in the ID3v2 tag (versions 2.2 to 2.4) of an MP3 file:
+    the front cover, or else the first picture. Compressed and encrypted frames are skipped.
+
+    :param file: the file, opened in binary mode
+    :return: the image data, or ``None`` if the file has no (readable) picture
+    """
+    file.seek(0)
+    header = file.read(10)
+    if len(header) < 10 or header[:3] != b'ID3' or header[3] not in (2, 3, 4):
+        return None
+    version, flags = header[3], header[5]
+    size = _syncsafe(header[6:10])
+    if size > MAX_TAG_SIZE:
+        return None
+    tag = file.read(size)
+    if flags & 0x80 and version < 4:  # unsynchronised tag
+        tag = tag.replace(b'\xff\x00', b'\xff')
+    position = 0
+    if flags & 0x40 and version > 2:  # extended header
+        position = _syncsafe(tag[:4]) if version == 4 else 4 + int.from_bytes(tag[:4], 'big')
+
+    pictures = []
+    frame_header_size = 6 if version == 2 else 10
+    while position + frame_header_size <= len(tag):
+        if version == 2:
+            frame_id, frame_size = tag[position:position + 3], \
+                int.from_bytes(tag[position + 3:position + 6], 'big')
+            frame_flags = 0
+        else:
+            frame_id = tag[position:position + 4]
+            frame_size = _syncsafe(tag[position + 4:position + 8]) if version == 4 \
+                else int.from_bytes(tag[position + 4:position + 8], 'big')
+            frame_flags = tag[position + 9]
+        if not frame_id.strip(b'\x00'):
+            break  # padding
+        body = tag[position + frame_header_size:position + frame_header_size + frame_size]
+        position += frame_header_size + frame_size
+        if frame_id not in (b'APIC', b'PIC'):
+            continue
+        if version == 3 and frame_flags & 0xC0 or version == 4 and frame_flags & 0x0C:
+            continue  # compressed or encrypted
+        if version == 4:
+            if frame_flags & 0x02:  # unsynchronised frame
+                body = body.replace(b'\xff\x00', b'\xff')
+            if frame_flags & 0x01:  # data length indicator
+                body = body[4:]
+        picture = _picture(body, version)
+        if picture is not None:
+            pictures.append(picture)
+    covers = [data for picture_type, data in pictures if picture_type == FRONT_COVER]
+    return (covers or [data for _, data in pictures] or [None])[0]
+
+
+def _syncsafe(data: bytes) -> int:
+    """A syncsafe integer of ID3v2 (7 bits per byte)"""
+    value = 0
+    for byte in data:
+        value = value << 7 | byte & 0x7F
+    return value
+
+
+def _picture(body: bytes, version: int) -> t.Optional[t.Tuple[int, bytes]]:
+    """The picture type and image data of an APIC (or, in ID3v2.2, PIC) frame"""
+    if len(body) < 5:
+        return None
+    encoding = body[0]
+    if version == 2:  # 3 characters image format instead of a MIME type
+        position = 4
+    else:
+        position = body.find(b'\x00', 1) + 1
+        if not position:
+            return None
+    picture_type = body[position]
+    position += 1
+    # the description, terminated by a null character of its encoding
+    if encoding in (1, 2):  # UTF-16
+        end = position
+        while True:
+            end = body.find(b'\x00\x00', end)
+            if end == -1:
+                return None
+            if (end - position) % 2 == 0:
+                break
+            end += 1
+        position = end + 2
+    else:
+        end = body.find(b'\x00', position)
+        if end == -1:
+            return None
+        position = end + 1
+    data = body[position:]
+    return (picture_type, data) if data else None
+
+
+class _BlockReader:
+    """Random access to a file, through a window of at least ``BLOCK_SIZE`` bytes, so that
+    sequential reads of a few bytes at a time don't each cost a system call"""
+
+    def __init__(self, file: t.BinaryIO):
+        self.file = file
+        self.start = 0
+        self.data = b''
+
+    def read(self, position: int, size: int) -> bytes:
+        """Up to ``size`` bytes from ``position`` (fewer at the end of the file)"""
+        offset = position - self.start
+        if offset < 0 or offset + size > len(self.data):
+            self.file.seek(position)
+            self.data = self.file.read(max(size, BLOCK_SIZE))
+            self.start, offset = position, 0
+        return self.data[offset:offset + size]
+
+
+def _skip_id3v2(reader: _BlockReader) -> int:
+    """Position of the first byte after the ID3v2 tag at the start of the file, if any"""
+    tag = reader.read(0, 10)
+    if len(tag) < 10 or tag[:3] != b'ID3':
+        return 0
+    size = _syncsafe(tag[6:10])
+    footer = 10 if tag[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _sync(reader: _BlockReader, position: int) -> t.Tuple[int, t.Optional[FrameHeader]]:
+    """Find the next frame from ``position``: a valid frame header followed by the header of a
+    frame of the same stream (same version, layer and sample rate), to rule out byte sequences
+    that just look like a header"""
+    end = position + SYNC_LIMIT
+    while position < end:
+        block = reader.read(position, BLOCK_SIZE)
+        if not block:
+            break
+        index = block.find(b'\xff')
+        while index != -1:
+            header = FrameHeader.parse(reader.read(position + index, 4))
+            if header is not None:
+                following = FrameHeader.parse(reader.read(position + index + header.length, 4))
+                if following is not None and following[:3] == header[:3]:
+                    return position + index, header
+            index = block.find(b'\xff', index + 1)
+        position += len(block)
+    return position, None
+
+
+def _vbr_frame_count(frame: bytes, header: FrameHeader) -> t.Optional[int]:
+    """The number of frames of the file, according to the Xing/Info or VBRI header in its first
+    frame, if there is one"""
+    if header.layer != 3:
+        return None
+    if header.mpeg1:
+        side_info = 17 if header.mono else 32
+    else:
+        side_info = 9 if header.mono else 17
+    xing = 4 + side_info
+    if frame[xing:xing + 4] in (b'Xing', b'Info') and len(frame) >= xing + 12:
+        flags, frames = struct.unpack('>II', frame[xing + 4:xing + 12])
+        if flags & 1:  # the frame count is present
+            return frames
+    vbri = 4 + 32  # always after 32 bytes, whatever the version and channel mode
+    if frame[vbri:vbri + 4] == b'VBRI' and len(frame) >= vbri + 18:
+        return struct.unpack('>I', frame[vbri + 14:vbri + 18])[0]
+    return None
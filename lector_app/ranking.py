@@ -0,0 +1,42 @@
+"""
+Ranking search hits by text relevance blended with numeric index columns (e.g. popularity)
+"""
+import math
+import typing as t
+
+from whoosh import scoring
+from whoosh.searching import Searcher
+
+
+class BlendedWeighting(scoring.WeightingModel):
+    """Weighting model that multiplies the text relevance score of each hit by
+    ``1 + weight * log(1 + value)`` for the value of each blended column, so that e.g. popular
+    recordings rank higher among equally relevant ones. The columns' values are read from the
+    index (the fields should be sortable), without touching stored fields or the database.
+    """
+    use_final = True
+
+    def __init__(self, blend: t.Mapping[str, float],
+                 base: t.Optional[scoring.WeightingModel] = None):
+        """
+        :param blend: weights of the blended columns, by field name
+        :param base: the text relevance weighting model (BM25F by default)
+        """
+        self.blend = dict(blend)
+        self.base = base or scoring.BM25F()
+        self._columns = {}  # column readers of the top searcher, by field name
+
+    def idf(self, searcher: Searcher, fieldname: str, text):
+        return self.base.idf(searcher, fieldname, text)
+
+    def scorer(self, searcher: Searcher, fieldname: str, text, qf=1):
+        return self.base.scorer(searcher, fieldname, text, qf=qf)
+
+    def final(self, searcher: Searcher, docnum: int, score: float) -> float:
+        factor = 1.0
+        for fieldname, weight in self.blend.items():
+            column = self._columns.get(fieldname)
+            if column is None:
+                column = self._columns[fieldname] = searcher.reader().column_reader(fieldname)
+            factor *= 1.0 + weight * math.log1p(max(column[docnum] or 0, 0))
+        return score * factor
@@ -1,20 +1,71 @@
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
 import typing as t
+import zlib
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from queue import Full
 
 import cachetools
 import whoosh
 import whoosh.qparser as qparser
+from django.apps import apps
 from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import transaction
 from django.db.models import Model
-from whoosh import fields
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.db.models.utils import make_model_tuple
+from django.utils import timezone
+from whoosh import fields, sorting
 from whoosh.fields import Schema
+from whoosh.idsets import BitSet
 from whoosh.index import Index
 from whoosh.qparser import QueryParser
-from whoosh.searching import Results
-from whoosh.writing import AsyncWriter
+from whoosh.query import Every, NumericRange, Or, Query, Term
+from whoosh.reading import IndexReader, MultiReader
+from whoosh.searching import Searcher
 
+from .indexing import IndexUpdateQueue, PendingUpdate, bulk_changed
+from .maintenance import IndexMaintenance, TieredMergePolicy
+from .ranking import BlendedWeighting
+from .spelling import SpellingCorrector
+from .suggest import Suggester
 from .utils import mkdir, pre_call
 
+CURSOR_SALT = 'lector-app.search.cursor'
+# query words that can be parsed without the query parser, and operators that aren't plain words
+PLAIN_WORD = re.compile(r'^\w+$')
+OPERATORS = frozenset({'AND', 'OR', 'NOT', 'ANDNOT', 'ANDMAYBE'})
+FUZZY_BOOST = 0.5  # weight of corrections of misspelt query terms, relative to the terms
 PK_FIELDTYPE = whoosh.fields.ID(stored=True, unique=True)
+MODIFIED_FIELDTYPE = whoosh.fields.DATETIME(stored=True, sortable=True)
+VERSION_FIELD = 'entry_version'  # stored hash of the version_fields of an entry
+VERSION_FIELDTYPE = whoosh.fields.STORED()
+
+logger = logging.getLogger('lector-app search')
+
+engines: t.Dict[str, 'AbstractSearchEngine'] = {}  # all search engines, by index name
+
+
+class Dependency(t.NamedTuple):
+    """Declares that the index entries of a model depend on the instances of another model"""
+    path: str  # lookup path from the indexed model to the other model, e.g. 'book__author'
+    # names of the other model's fields that the index entries depend on (None for all fields)
+    fields: t.Optional[t.AbstractSet[str]] = None
 
 
 class AbstractSearchEngine:
@@ -25,8 +76,33 @@ class AbstractSearchEngine:
     # fields (instance attributes):
     model: t.Type[Model]  # model whose instances are to be searched
     schema: Schema  # search field schema
-    index: Index  # search index
-    query_parser: QueryParser  # query parser
+    shards: t.List['IndexShard']  # the indexes that the entries are split across
+    query_parser: 'LectorQueryParser'  # query parser
+    suggester: Suggester  # type-ahead suggestions
+    spelling: SpellingCorrector  # corrections of misspelt query terms
+    maintenance: IndexMaintenance  # segment merging
+
+    # name of the model's modification timestamp field (if any), which is used to find the
+    # instances that changed since they were last indexed
+    modified_field: t.Optional[str] = None
+    # related fields used by extract_search_fields, which are fetched in the same query as the
+    # instances to index (see QuerySet.select_related)
+    select_related: t.Sequence[str] = ()
+    # aggregates used by extract_search_fields, which are computed in the same query as the
+    # instances to index, by annotation name (see QuerySet.annotate)
+    annotations: t.Mapping[str, t.Any] = {}
+    # facets whose hit counts can be requested when searching, by name (their maptype should be
+    # whoosh.sorting.Count)
+    facets: t.Mapping[str, sorting.FacetType] = {}
+    # models whose instances are denormalised into the index entries (see track_changes), or
+    # their 'app_label.ModelName' if they are defined after the indexed model
+    dependencies: t.Mapping[t.Union[t.Type[Model], str], Dependency] = {}
+    # many-to-many relations of the model (e.g. UserProfile.library) whose changes affect the
+    # index entries of the related instances, e.g. through counts (see track_changes)
+    m2m_dependencies: t.Sequence[t.Any] = ()
+    # index fields that data derived from the entries (e.g. rendered search hits) depends on: a
+    # hash of their values is stored with each entry as its version (see entry_versions)
+    version_fields: t.Sequence[str] = ()
 
     def __init__(self, model: t.Type[Model], schema: Schema, index_name: t.Optional[str] = None):
         """
@@ -37,13 +113,34 @@ class AbstractSearchEngine:
         """
         self.model = model
         self.schema = schema
+        self.index_name = index_name
         self.pk_name = model._meta.pk.name
         self.schema.add(self.pk_name, PK_FIELDTYPE)
-        self.index = self._init_index(index_name)
-        query_fields = set(schema.names()) - {self.pk_name}
+        if self.modified_field is not None:
+            self.schema.add(self.modified_field, MODIFIED_FIELDTYPE)
+        if self.version_fields:
+            self.schema.add(VERSION_FIELD, VERSION_FIELDTYPE)
+        num_shards = getattr(settings, 'SEARCH_INDEX_SHARDS', 1)
+        if num_shards == 1:
+            self.shards = [IndexShard(self, index_name)]
+        else:
+            self.shards = [IndexShard(self, f'{index_name}-{i}') for i in range(num_shards)]
+        self._executor: t.Optional[ThreadPoolExecutor] = None  # for searching shards in parallel
+        self._executor_pid: t.Optional[int] = None
+        query_fields = {name for name, field in schema.items() if isinstance(field, fields.TEXT)}
         self.query_parser = LectorQueryParser(query_fields, self.schema)
-
-        self._search_cache: t.MutableMapping[str, Results] = cachetools.TTLCache(64, 60.0)
+        suggest_fields = [name for name, field in schema.items()
+                          if getattr(field, 'spelling', False)]
+        self.suggester = Suggester(self, suggest_fields)
+        self.spelling = SpellingCorrector(suggest_fields)
+        self.maintenance = IndexMaintenance(
+            self,
+            TieredMergePolicy(
+                max_segments=getattr(settings, 'SEARCH_INDEX_MAX_SEGMENTS', 10),
+                max_deleted_ratio=getattr(settings, 'SEARCH_INDEX_MAX_DELETED_RATIO', 0.2)),
+            interval=getattr(settings, 'SEARCH_INDEX_MAINTENANCE_INTERVAL', 60.0),
+            optimize_hours=getattr(settings, 'SEARCH_INDEX_OPTIMIZE_HOURS', None))
+        engines[index_name] = self
 
     def _check_instance(self, instance: Model):
         if not isinstance(instance, self.model):
@@ -71,73 +168,1132 @@ class AbstractSearchEngine:
     @pre_call(_check_instance)
     def reindex(self, instance: Model):
         """Update an entry in the index. Non-blocking.
+        The update is queued once the current transaction commits, and written in a batch with
+        other updates (see :class:`lector_app.indexing.IndexUpdateQueue`).
         :param instance: instance of ``self.model`` that needs reindexing (because it changed or
         was added)
         """
-        """Update an entry in the index. Non-blocking."""
-        with AsyncWriter(self.index) as writer:
-            writer.update_document(**self._extract_search_fields(instance))
+        fields = self._extract_search_fields(instance)
+        pk = fields[self.pk_name]
+        self.shard_for(pk).updates.update(pk, fields, using=instance._state.db)
 
     @pre_call(_check_instance)
     def remove(self, instance: Model):
         """Remove an entry from the index. Non-blocking.
+        The removal is queued once the current transaction commits, like :method:`reindex`.
         :param instance: instance of ``self.model`` to be removed from the index
         """
-        with AsyncWriter(self.index) as writer:
-            writer.delete_by_term(self.pk_name, getattr(instance, self.pk_name))
+        pk = str(getattr(instance, self.pk_name))
+        self.shard_for(pk).updates.delete(pk, using=instance._state.db)
+
+    def reindex_pks(self, pks: t.Iterable[t.Any], using: t.Optional[str] = None):
+        """Update the entries of the instances with the given primary keys, as they are once the
+        current transaction commits. Non-blocking (except for fetching the instances).
+        :param pks: primary keys of instances of ``self.model``
+        :param using: alias of the database whose transaction the update is tied to
+        """
+        pks = [str(pk) for pk in pks]
+        if pks:
+            transaction.on_commit(lambda: self._reindex_now(pks), using=using)
+
+    def flush(self):
+        """Write all queued index updates now. Blocking operation."""
+        for shard in self.shards:
+            shard.flush()
+
+    def shard_for(self, pk: str) -> 'IndexShard':
+        """The shard that holds the entry of the instance with primary key ``pk``"""
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[zlib.crc32(pk.encode('utf-8')) % len(self.shards)]
+
+    def decode_fields(self, values: t.Mapping[str, t.Any]) -> t.Dict[str, t.Any]:
+        """Restore index field values that were sent as JSON (by
+        :class:`lector_app.index_writer.IndexWriterClient`), which turns datetimes into strings.
+        :param values: dictionary mapping index field names to decoded JSON values
+        """
+        values = dict(values)
+        for name, value in values.items():
+            if isinstance(self.schema[name], fields.DATETIME) and isinstance(value, str):
+                values[name] = datetime.fromisoformat(value)
+        return values
+
+    def track_changes(self):
+        """Keep the index up to date by connecting to the signals sent when instances of
+        ``self.model`` or of its dependencies (see ``self.dependencies``) are saved, deleted, or
+        changed in bulk through a :class:`lector_app.indexing.ChangeTrackingQuerySet`. A change
+        to a dependency reindexes the instances that refer to it, and adding or removing links of
+        a many-to-many dependency (see ``self.m2m_dependencies``) reindexes the linked instances.
+        Bulk updates of dependencies that don't use a ChangeTrackingQuerySet go unnoticed.
+        """
+        uid = f'{self.index_name}:'
+        post_save.connect(self._saved, sender=self.model, weak=False, dispatch_uid=uid)
+        post_delete.connect(self._deleted, sender=self.model, weak=False, dispatch_uid=uid)
+        bulk_changed.connect(self._bulk_changed, sender=self.model, weak=False, dispatch_uid=uid)
+        for model, dependency in self.dependencies.items():
+            if isinstance(model, str):  # connected once the model class is created
+                apps.lazy_model_operation(partial(self._track_dependency, dependency),
+                                          make_model_tuple(model))
+            else:
+                self._track_dependency(dependency, model)
+        for relation in self.m2m_dependencies:
+            field = relation.field
+            uid = f'{self.index_name}:{field.model._meta.label}.{field.name}'
+            m2m_changed.connect(partial(self._m2m_changed, field), sender=relation.through,
+                                weak=False, dispatch_uid=uid)
+            if field.model is not self.model:
+                # deleting an instance of the other model deletes its links without sending
+                # m2m_changed
+                pre_delete.connect(partial(self._m2m_owner_deleted, field), sender=field.model,
+                                   weak=False, dispatch_uid=uid)
+
+    def _track_dependency(self, dependency: Dependency, model: t.Type[Model]):
+        uid = f'{self.index_name}:{dependency.path}'
+        post_save.connect(partial(self._dependency_saved, dependency), sender=model,
+                          weak=False, dispatch_uid=uid)
+        pre_delete.connect(partial(self._dependency_deleted, dependency), sender=model,
+                           weak=False, dispatch_uid=uid)
+        bulk_changed.connect(partial(self._dependency_bulk_changed, dependency), sender=model,
+                             weak=False, dispatch_uid=uid)
+
+    def catch_up(self) -> int:
+        """Bring the index up to date with the database, without rebuilding it. Non-blocking.
+        Queues reindexing of the instances that were modified since the index's high-water mark
+        (the most recent modification timestamp written to it, or the greatest primary key if
+        ``self.modified_field`` is ``None``), which each shard keeps next to its index (see
+        :method:`IndexShard.high_water_mark`), so that only the changed instances are read.
+        If a shard has no high-water mark, or the number of entries doesn't add up with the
+        number of instances (e.g. because instances were deleted while no process was running),
+        the index is reconciled with the database entry by entry instead (see
+        :method:`_reconcile`).
+
+        :return: the number of queued index updates
+        """
+        marks = []
+        for shard in self.shards:
+            shard.refresh_index()
+            known, mark = shard.high_water_mark()
+            if not known:
+                return self._reconcile()
+            marks.append(mark)
+        to_reindex = self._changed_since(None if None in marks else min(marks))
+
+        indexed_count, missing = 0, set()
+        for shard in self.shards:
+            pks = [pk for pk in to_reindex if self.shard_for(pk) is shard]
+            with shard.index.searcher() as searcher:
+                indexed_count += searcher.doc_count()
+                missing.update(pk for pk in pks
+                               if searcher.document_number(**{self.pk_name: pk}) is None)
+        if indexed_count + len(missing) != self.model.objects.count():
+            return self._reconcile()
+
+        for instance in self._iter_instances(to_reindex):
+            self.reindex(instance)
+        logger.info(f"index {self.index_name}: queued {len(to_reindex)} updates to catch up "
+                    f"with the database")
+        return len(to_reindex)
+
+    def _reconcile(self) -> int:
+        """Bring the index up to date with the database by comparing all index entries with all
+        instances: queues reindexing of the instances that were modified since the most recently
+        modified indexed instance or that are missing from the index, and removal of the entries
+        whose instances no longer exist. Entries found in another shard than their own (after the
+        number of shards changed) are removed too. The shards' high-water marks are reset to the
+        index's.
+
+        :return: the number of queued index updates
+        """
+        indexed, misplaced = {}, []
+        for shard in self.shards:
+            for pk, modified in shard.indexed_entries().items():
+                if self.shard_for(pk) is shard:
+                    indexed[pk] = modified
+                else:
+                    misplaced.append((shard, pk))
+        existing = {str(pk) for pk in self.model.objects.values_list('pk', flat=True)}
+
+        if self.modified_field is not None:
+            mark = max((modified for modified in indexed.values() if modified), default=None)
+        else:
+            mark = max((int(pk) for pk in indexed), default=None)
+        to_reindex = self._changed_since(mark)
+        to_reindex |= existing - indexed.keys()
+        to_remove = indexed.keys() - existing
+
+        for shard in self.shards:  # raised as the queued updates are written
+            shard.set_high_water_mark(mark)
+        for instance in self._iter_instances(to_reindex):
+            self.reindex(instance)
+        for pk in to_remove:
+            self.shard_for(pk).updates.delete(pk)
+        for shard, pk in misplaced:
+            shard.updates.delete(pk)
+        logger.info(f"index {self.index_name}: queued {len(to_reindex)} updates and "
+                    f"{len(to_remove) + len(misplaced)} removals to catch up with the database")
+        return len(to_reindex) + len(to_remove) + len(misplaced)
+
+    def _changed_since(self, mark: t.Union[datetime, int, None]) -> t.Set[str]:
+        """Primary keys of the instances that may have changed since they were indexed, given the
+        index's high-water mark (all instances if there is none)"""
+        changed = self.model.objects.all()
+        if mark is not None and self.modified_field is not None:
+            # the slack covers updates that were committed to the database, but written to the
+            # index after more recent ones (e.g. by another process)
+            slack = timedelta(seconds=getattr(settings, 'SEARCH_INDEX_CATCH_UP_SLACK', 60.0))
+            changed = changed.filter(**{f'{self.modified_field}__gte': mark - slack})
+        elif mark is not None:
+            changed = changed.filter(pk__gt=mark)
+        return {str(pk) for pk in changed.values_list('pk', flat=True)}
 
-    def reindex_all(self, timeout=0.5):
-        """Reset the index and index all instances of ``self.model``. Blocking operation.
-        :param timeout: time in seconds to wait trying to acquire the index's write lock
+    def reindex_all(self, timeout=0.5, procs: t.Optional[int] = None, chunk_size=2000):
+        """Rebuild the index from all instances of ``self.model``. Blocking operation.
+        The new index is built on the side and then atomically swapped in for the current one,
+        which keeps serving searches (and receiving updates) in the meantime. Updates made during
+        the rebuild are caught up with afterwards. A single index is built with ``procs``
+        indexing processes; shards are built by one process each, which the instances are
+        distributed to.
+
+        :param timeout: time in seconds to wait trying to acquire the new index's write lock
+        :param procs: number of indexing processes for a single index (defaults to
+            ``SEARCH_INDEX_REBUILD_PROCS``)
+        :param chunk_size: number of instances fetched from the database at a time
         """
-        with self.index.writer(timeout=timeout) as writer:
-            for instance in self.model.objects.all():
-                writer.add_document(**self._extract_search_fields(instance))
-            writer.mergetype = whoosh.writing.CLEAR
+        suffix = int(time.time() * 1000)
+        names = [f"{shard.index_name}.{suffix}" for shard in self.shards]
+        for name in names:
+            whoosh.index.create_in(settings.SEARCH_INDEX_DIR, self.schema, indexname=name)
+        instances = self._indexing_queryset().iterator(chunk_size=chunk_size)
+        limitmb = getattr(settings, 'SEARCH_INDEX_REBUILD_LIMITMB', 128)
+        if len(self.shards) == 1:
+            if procs is None:
+                procs = getattr(settings, 'SEARCH_INDEX_REBUILD_PROCS', os.cpu_count() or 1)
+            index = whoosh.index.open_dir(settings.SEARCH_INDEX_DIR, indexname=names[0])
+            writer = index.writer(timeout=timeout, procs=procs, multisegment=procs > 1,
+                                  limitmb=limitmb)
+            try:
+                for instance in instances:
+                    writer.add_document(**self._extract_search_fields(instance))
+            except BaseException:
+                writer.cancel()
+                raise
+            writer.commit()
+        else:
+            self._build_shards(names, instances, limitmb)
+        for shard, name in zip(self.shards, names):
+            shard.swap_index(name)
+        self.catch_up()
+
+    def _build_shards(self, names: t.Sequence[str], instances: t.Iterable[Model], limitmb: int,
+                      chunk_size=500):
+        """Index instances into new shards called ``names``, with one process per shard"""
+        documents = [multiprocessing.Queue(maxsize=8) for _ in names]
+        builders = [multiprocessing.Process(target=_build_shard, name=f'index-builder-{name}',
+                                            args=(settings.SEARCH_INDEX_DIR, name, queue, limitmb))
+                    for name, queue in zip(names, documents)]
+        for builder in builders:
+            builder.start()
+        try:
+            chunks = [[] for _ in names]
+            for instance in instances:
+                doc_fields = self._extract_search_fields(instance)
+                i = self.shards.index(self.shard_for(doc_fields[self.pk_name]))
+                chunks[i].append(doc_fields)
+                if len(chunks[i]) >= chunk_size:
+                    _put_chunk(builders[i], documents[i], chunks[i])
+                    chunks[i] = []
+            for builder, queue, chunk in zip(builders, documents, chunks):
+                if chunk:
+                    _put_chunk(builder, queue, chunk)
+                _put_chunk(builder, queue, None)
+        except BaseException:
+            for builder in builders:
+                builder.terminate()
+            raise
+        finally:
+            for builder in builders:
+                builder.join()
+        failed = [builder.name for builder in builders if builder.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"failed to build index shards: {', '.join(failed)}")
+
+    def suggest(self, prefix: str, limit: int = 10) -> t.List[str]:
+        """Returns type-ahead suggestions: the most frequent terms of the fields with spelling
+        support that start with ``prefix``. Fast enough to call on every keystroke (see
+        :class:`lector_app.suggest.Suggester`).
 
-    def search(self, query: str, limit: int = 10, use_cache=True, **kwargs) -> Results:
+        :param prefix: the prefix of a term, as typed by a user
+        :param limit: maximum number of suggestions to return
+        """
+        return self.suggester.suggest(prefix, limit)
+
+    def index_written(self, shard: 'IndexShard', batch: t.Mapping[str, PendingUpdate],
+                      generation: int):
+        """Called after a batch of updates was written to a shard.
+
+        :param shard: the updated shard
+        :param batch: the written updates
+        :param generation: the shard's index generation produced by writing the batch
+        """
+        documents = [fields for fields in batch.values() if fields is not None]
+        self.maintenance.index_written()
+        if documents and self.modified_field is not None:
+            shard.advance_high_water_mark(
+                _make_aware(max(fields[self.modified_field] for fields in documents)))
+        elif documents:
+            shard.advance_high_water_mark(max(int(fields[self.pk_name]) for fields in documents))
+
+    @contextmanager
+    def shard_searchers(self) -> t.Iterator[t.List[Searcher]]:
+        """Context manager that provides up to date searchers of all shards (in the order of
+        ``self.shards``). The searchers should not be used after exiting the context."""
+        with ExitStack() as stack:
+            yield [stack.enter_context(shard.searchers.searcher()) for shard in self.shards]
+
+    def generation(self, searchers: t.Sequence[Searcher]) -> t.Tuple[t.Tuple[str, int], ...]:
+        """Identifier of the generation of the shards that ``searchers`` read"""
+        return tuple((shard.active_name, searcher.reader().generation())
+                     for shard, searcher in zip(self.shards, searchers))
+
+    def latest_generation(self) -> t.Tuple[t.Tuple[str, int], ...]:
+        """Identifier of the latest generation of the shards"""
+        return tuple((shard.active_name, shard.index.latest_generation())
+                     for shard in self.shards)
+
+    def entry_versions(self, pks: t.Iterable[str]) -> t.Dict[str, str]:
+        """The versions of the index entries of the instances with the given primary keys (see
+        ``self.version_fields``), for keying data derived from the instances (e.g. rendered
+        HTML): an entry's version only changes when the values of those fields do, so the
+        derived data is kept across unrelated writes to the index, e.g. of popularity counts.
+        Instances without an entry (or without a version) are left out.
+        """
+        by_shard = {}
+        for pk in pks:
+            by_shard.setdefault(self.shard_for(pk), []).append(pk)
+        versions = {}
+        for shard, shard_pks in by_shard.items():
+            with shard.searchers.searcher() as searcher:
+                for pk in shard_pks:
+                    stored = searcher.document(**{self.pk_name: pk})
+                    if stored and stored.get(VERSION_FIELD):
+                        versions[pk] = stored[VERSION_FIELD]
+        return versions
+
+    def lexicon_reader(self, searchers: t.Sequence[Searcher]) -> IndexReader:
+        """Reader of the terms of all shards, for the structures built from the lexicon (it
+        shouldn't be used to read documents, nor be closed)"""
+        if len(searchers) == 1:
+            return searchers[0].reader()
+        return MultiReader([searcher.reader() for searcher in searchers])
+
+    def search(self, query: str, limit: t.Optional[int] = 10, use_cache=True, fuzzy=True,
+               filters: t.Optional[t.Mapping[str, t.Any]] = None, facets: t.Iterable[str] = (),
+               blend: t.Optional[t.Mapping[str, float]] = None, **kwargs) -> 'SearchResults':
         """
         Parses a query with ``self.query_parser`` and returns the results of searching the index
-        with that query. If caching is enabled (i.e. ``use_cache`` is ``True``), caches query
-        results for 60 seconds.
+        with that query. If caching is enabled (i.e. ``use_cache`` is ``True``), results are
+        cached in the ``SEARCH_CACHE`` cache (shared by all processes, if its backend allows) for
+        ``SEARCH_CACHE_TIMEOUT`` seconds. Cache entries are keyed by the index generation, so
+        they become obsolete as soon as the index changes, and by the canonical form of the query
+        (see :method:`LectorQueryParser.canonical`), so e.g. "Animal Farm" and "farm animal"
+        share results.
 
         :param query: query string
-        :param limit: maximum number of results to return
+        :param limit: maximum number of results to return (``None`` for all results)
         :param use_cache: whether to used cached results
-        :param kwargs: other keyword arguments to pass to :method:`whoosh.searching.Searcher.search`
-        :return: a Results object corresponding to the parsed query
-        """
-        cached = self._search_cache.get(query, None)
-        if not use_cache or cached is None or cached.scored_length() < limit:
-            # update cache
-            self._search_cache[query] = self._search(query, limit, **kwargs)
-        results = self._search_cache[query].copy()
-        results.top_n = results.top_n[:limit]
+        :param fuzzy: whether to also match corrections of query terms that aren't in the index,
+            and suggest a corrected query string (see ``self.spelling``)
+        :param filters: mapping of field names to the values hits must have: for numeric fields,
+            a ``[start, end]`` range (either end may be ``None``), and for other fields a value or
+            a list of alternative values. With filters, an empty query matches all documents.
+        :param facets: names of the facets (see ``self.facets``) to count the hits of
+        :param blend: weights of sortable numeric fields to blend into the relevance scores of
+            the hits (see :class:`lector_app.ranking.BlendedWeighting`)
+        :param kwargs: other keyword arguments to pass to :method:`whoosh.searching.Searcher.search`,
+            e.g. ``sortedby`` (the name of a sortable numeric field) and ``reverse``
+        :return: the primary keys and scores (or sort keys) of the top results
+        """
+        with self.shard_searchers() as searchers:
+            return self._search_cached(searchers, query, limit, use_cache, fuzzy, filters,
+                                       facets, blend, **kwargs)
+
+    def _search_cached(self, searchers: t.Sequence[Searcher], query, limit, use_cache=True,
+                       fuzzy=True, filters=None, facets=(), blend=None, **kwargs
+                       ) -> 'SearchResults':
+        """See :method:`search`"""
+        cache = caches[getattr(settings, 'SEARCH_CACHE', 'default')]
+        filters, facets = filters or {}, sorted(facets)
+        generation = self.generation(searchers)
+        options = dict(kwargs, fuzzy=fuzzy, filters=filters, facets=facets, blend=blend)
+        key = self._cache_key(query, options, generation)
+        results = cache.get(key) if use_cache else None
+        if results is None or not results.covers(limit):
+            results = self._search(searchers, query, limit, fuzzy, filters, facets, blend,
+                                   **kwargs)
+            cache.set(key, results, getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300))
+        results = results.top(limit)
+        if fuzzy:
+            # corrections keep the wording of the query, so they are not cached with the
+            # results (the corrections of words are memoised anyway)
+            results.correction = self._correct(query, self.lexicon_reader(searchers),
+                                               generation)
         return results
 
-    def _init_index(self, name: str) -> Index:
-        """Initialise the empty index"""
-        mkdir(settings.SEARCH_INDEX_DIR)
-        self.index = whoosh.index.create_in(settings.SEARCH_INDEX_DIR, self.schema, indexname=name)
-        return self.index
+    def _pinned_results(self, query: str, generation: t.Hashable, limit: int, fuzzy=True,
+                        filters=None, facets=(), blend=None, **kwargs
+                        ) -> t.Optional['SearchResults']:
+        """The cached results of a search against an older generation of the shards, if they are
+        still cached and include the top ``limit`` hits (see :method:`search`)"""
+        cache = caches[getattr(settings, 'SEARCH_CACHE', 'default')]
+        options = dict(kwargs, fuzzy=fuzzy, filters=filters or {}, facets=sorted(facets),
+                       blend=blend)
+        results = cache.get(self._cache_key(query, options, generation))
+        if results is None or not results.covers(limit):
+            return None
+        return results.top(limit)
+
+    def search_page(self, query: str = '', cursor: t.Optional[str] = None, pagelen: int = 10,
+                    **kwargs) -> 'SearchPage':
+        """
+        Returns one page of the results of searching the index with a query, along with an opaque
+        cursor to pass back to get the next page.
+        Pages are cut from cached results (see :method:`search`), which are fetched with depths
+        that grow geometrically, so that browsing through ``n`` results costs ``O(n)`` rather
+        than ``O(n^2)``. The cursor pins the generation of the index that the first page was
+        cut from: if the index changed since, the following pages are cut from the results of
+        that generation (which are fetched deep enough for the next page), so that hits are
+        neither repeated nor skipped, for as long as these results are cached.
+
+        :param query: query string (ignored if ``cursor`` is given)
+        :param cursor: cursor returned with the previous page, or ``None`` for the first page
+        :param pagelen: number of results per page
+        :param kwargs: other keyword arguments to pass to :method:`search`
+        :return: the page of results
+        :raises django.core.signing.BadSignature: if the cursor is invalid
+        :raises StaleCursor: if the cursor's results are no longer cached
+        """
+        offset, pinned = 0, None
+        if cursor is not None:
+            query, offset, kwargs, pinned = signing.loads(cursor, salt=CURSOR_SALT)
+            pinned = tuple(tuple(shard) for shard in pinned)
+        end = offset + pagelen
+        # deep enough for the next page too, so that it can be cut from the same results
+        depth = max(pagelen, 1 << (end + pagelen - 1).bit_length())
+        with self.shard_searchers() as searchers:
+            generation = self.generation(searchers)
+            if pinned is None or pinned == generation:
+                results = self._search_cached(searchers, query, depth, **kwargs)
+            else:
+                results = self._pinned_results(query, pinned, end, **kwargs)
+                if results is None:
+                    raise StaleCursor("the results of the cursor are no longer cached")
+                generation = pinned
+        next_cursor = None
+        if end < results.total:
+            next_cursor = signing.dumps([query, end, kwargs, generation], salt=CURSOR_SALT,
+                                        compress=True)
+        return SearchPage(query, results.pks[offset:end], results.total, next_cursor,
+                          results.correction, results.facets)
+
+    def hydrate(self, pks: t.Iterable[str]) -> t.List[Model]:
+        """Fetch the instances corresponding to search hits with one query (joining in
+        ``self.select_related``), in the same order as the hits. Hits whose instances no longer
+        exist (because the index hasn't caught up with their deletion yet) are dropped.
+
+        :param pks: primary keys of the hits, e.g. ``SearchResults.pks``
+        :return: the instances of ``self.model`` corresponding to the hits
+        """
+        to_python = self.model._meta.pk.to_python
+        pks = [to_python(pk) for pk in pks]
+        instances = self.model.objects.select_related(*self.select_related).in_bulk(pks)
+        return [instances[pk] for pk in pks if pk in instances]
+
+    def _saved(self, sender, instance, raw=False, **kwargs):
+        if not raw:  # related objects of raw (fixture) instances may not be loaded yet
+            self.reindex(instance)
+
+    def _deleted(self, sender, instance, **kwargs):
+        self.remove(instance)
+
+    def _bulk_changed(self, sender, pks, using, **kwargs):
+        if pks is None:
+            transaction.on_commit(self.catch_up, using=using)
+        else:
+            self.reindex_pks(pks, using)
+
+    def _dependents(self, dependency: Dependency, instances) -> t.List[t.Any]:
+        """Primary keys of the instances of ``self.model`` that depend on the given instances"""
+        lookup = {f'{dependency.path}__in': instances}
+        return list(self.model.objects.filter(**lookup).values_list('pk', flat=True))
+
+    def _dependency_saved(self, dependency: Dependency, sender, instance, raw=False,
+                          update_fields=None, using=None, **kwargs):
+        if raw or (update_fields is not None and dependency.fields is not None
+                   and not dependency.fields & set(update_fields)):
+            return
+        self.reindex_pks(self._dependents(dependency, [instance]), using)
+
+    def _dependency_deleted(self, dependency: Dependency, sender, instance, using=None,
+                            **kwargs):
+        # dependents are looked up before the deletion, since it may unlink them (or delete
+        # them, in which case they are removed from the index by _deleted)
+        self.reindex_pks(self._dependents(dependency, [instance]), using)
+
+    def _dependency_bulk_changed(self, dependency: Dependency, sender, pks, fields, using,
+                                 **kwargs):
+        if pks is None or (fields is not None and dependency.fields is not None
+                           and not dependency.fields & fields):
+            return  # created instances have no dependents yet
+        for start in range(0, len(pks), 500):
+            self.reindex_pks(self._dependents(dependency, pks[start:start + 500]), using)
+
+    def _reindex_now(self, pks: t.Iterable[str]):
+        for instance in self._iter_instances(pks):
+            self.reindex(instance)
+
+    def _m2m_linked(self, field, instance: Model) -> t.List[t.Any]:
+        """Primary keys of the instances of ``self.model`` linked to ``instance`` by a
+        many-to-many field"""
+        lookup = field.name if field.model is self.model else field.related_query_name()
+        return list(self.model.objects.filter(**{lookup: instance}).values_list('pk', flat=True))
+
+    def _m2m_changed(self, field, sender, instance, action, pk_set, using, **kwargs):
+        if action not in ('post_add', 'post_remove', 'pre_clear'):
+            return
+        if isinstance(instance, self.model):
+            self.reindex_pks([instance.pk], using)
+        elif action == 'pre_clear':
+            # the links are looked up before they are cleared, but the instances are reindexed
+            # once the transaction commits
+            self.reindex_pks(self._m2m_linked(field, instance), using)
+        else:
+            self.reindex_pks(pk_set, using)
+
+    def _m2m_owner_deleted(self, field, sender, instance, using=None, **kwargs):
+        self.reindex_pks(self._m2m_linked(field, instance), using)
 
-    def _search(self, query, limit, **kwargs):
-        """Search without using cache"""
-        searcher = self.index.searcher()
-        return searcher.search(self.query_parser.parse(query), limit=limit, **kwargs)
+    def _indexing_queryset(self):
+        """Queryset of the instances to index, with ``self.select_related`` and
+        ``self.annotations``"""
+        return self.model.objects.select_related(*self.select_related).annotate(**self.annotations)
+
+    def _iter_instances(self, pks: t.Iterable[str], chunk_size=500) -> t.Iterator[Model]:
+        """Fetch the instances with the given primary keys, in chunks"""
+        pks = list(pks)
+        instances = self._indexing_queryset()
+        for start in range(0, len(pks), chunk_size):
+            yield from instances.filter(pk__in=pks[start:start + chunk_size])
+
+    def _search(self, searchers: t.Sequence[Searcher], query, limit, fuzzy, filters, facets,
+                blend, **kwargs) -> 'SearchResults':
+        """Search without using cache. Shards are searched in parallel, and their top hits
+        merged (by score, or by sort key if sorting)."""
+        parsed = self.query_parser.parse_cached(query)
+        if fuzzy:
+            parsed = self._expand_misspellings(parsed, self.lexicon_reader(searchers),
+                                               self.generation(searchers))
+        if filters and not query.strip():
+            parsed = Every()
+        if facets:
+            kwargs['groupedby'] = {name: self.facets[name] for name in facets}
+
+        def search_shard(shard: IndexShard, searcher: Searcher) -> SearchResults:
+            shard_kwargs = dict(kwargs)
+            if blend:
+                # the weighting is a property of searchers, so the pooled searcher's reader is
+                # wrapped in a new one
+                searcher = Searcher(searcher.reader(), weighting=BlendedWeighting(blend),
+                                    closereader=False)
+            if filters:
+                shard_kwargs['filter'] = self._filter_docs(shard, searcher, filters)
+                if not shard_kwargs['filter']:  # which whoosh would take for no filter
+                    return SearchResults([], [], 0, facets={name: {} for name in facets})
+            results = searcher.search(parsed, limit=limit, **shard_kwargs)
+            return SearchResults([hit[self.pk_name] for hit in results],
+                                 [hit.score for hit in results], len(results),
+                                 facets={name: results.groups(name) for name in facets})
+
+        if len(self.shards) == 1:
+            return search_shard(self.shards[0], searchers[0])
+        shard_results = list(self._get_executor().map(search_shard, self.shards, searchers))
+        descending = kwargs.get('reverse', False) if 'sortedby' in kwargs else True
+        return SearchResults.merge(shard_results, limit, descending)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """Thread pool for searching the shards (it doesn't survive forking)"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(len(self.shards),
+                                                thread_name_prefix=f'search-{self.index_name}')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _filter_docs(self, shard: 'IndexShard', searcher: Searcher,
+                     filters: t.Mapping[str, t.Any]) -> BitSet:
+        """The set of documents of a shard that pass all filters"""
+        generation = (shard.active_name, searcher.reader().generation())
+        docs = None
+        for fieldname, value in sorted(filters.items()):
+            query = self._filter_query(fieldname, value)
+            clause_docs = shard.filter_cache.docs(searcher, generation, query)
+            docs = clause_docs if docs is None else docs.intersection(clause_docs)
+        return docs
+
+    def _filter_query(self, fieldname: str, value: t.Any) -> Query:
+        """Query matching the documents that pass a filter"""
+        if isinstance(self.schema[fieldname], fields.NUMERIC):
+            start, end = value if isinstance(value, (list, tuple)) else (value, value)
+            return NumericRange(fieldname, start, end)
+        values = value if isinstance(value, (list, tuple)) else [value]
+        return Or([Term(fieldname, str(value)) for value in values])
+
+    def _expand_misspellings(self, query: Query, reader: IndexReader,
+                             generation: t.Hashable) -> Query:
+        """Make the terms of a parsed query that are in none of the spelling fields also match
+        their corrections (with a lower weight)"""
+        def expand(node: Query) -> Query:
+            if isinstance(node, Term) and node.fieldname in self.spelling.fieldnames \
+                    and isinstance(node.text, str) and not self.spelling.is_known(reader, node.text):
+                corrections = self.spelling.corrections(reader, generation, node.text)
+                if corrections:
+                    return Or([node] + [Term(node.fieldname, correction,
+                                             boost=node.boost * FUZZY_BOOST)
+                                        for correction in corrections])
+            return node
+
+        return query.accept(expand)
+
+    def _correct(self, query: str, reader: IndexReader,
+                 generation: t.Hashable) -> t.Optional[str]:
+        """Returns ``query`` with its misspelt words corrected, or ``None`` if no word needs
+        correcting"""
+        if not self.spelling.fieldnames:
+            return None
+        analyzer = self.schema[self.spelling.fieldnames[0]].analyzer
+        words = [(token.startchar, token.endchar, token.text)
+                 for token in analyzer(query, chars=True, mode='query')]
+        corrected = query
+        for start, end, word in reversed(words):
+            if query[end:end + 1] == ':' or self.spelling.is_known(reader, word):
+                continue  # field names aren't corrected
+            corrections = self.spelling.corrections(reader, generation, word)
+            if corrections:
+                corrected = corrected[:start] + corrections[0] + corrected[end:]
+        return corrected if corrected != query else None
+
+    def _cache_key(self, query: str, options: t.Mapping[str, t.Any],
+                   generation: t.Hashable) -> str:
+        """Cache key for the results of a query with the given search options against the
+        given generation of the shards"""
+        canonical = json.dumps([generation, self.query_parser.canonical(query), options],
+                               sort_keys=True, default=repr)
+        return f'search:{self.index_name}:{hashlib.sha1(canonical.encode()).hexdigest()}'
 
     def _extract_search_fields(self, instance: Model) -> t.Dict[str, str]:
         """Internal wrapper around abstract method :method:`extract_search_fields`"""
         field_values = self.extract_search_fields(instance)
         field_values.setdefault(self.pk_name, str(getattr(instance, self.pk_name)))
+        if self.modified_field is not None:
+            field_values.setdefault(self.modified_field,
+                                    _make_naive(getattr(instance, self.modified_field)))
+        if self.version_fields:
+            values = json.dumps([field_values.get(name) for name in self.version_fields],
+                                default=str)
+            field_values[VERSION_FIELD] = hashlib.sha1(values.encode()).hexdigest()[:16]
         return field_values
 
 
+class IndexShard:
+    """One of the indexes that a search engine's entries are split across (by primary key; see
+    :method:`AbstractSearchEngine.shard_for`), with its own update queue, searchers and filter
+    cache. An engine with a single shard uses an index named after the engine.
+    """
+    # fields (instance attributes):
+    engine: AbstractSearchEngine  # search engine that the shard belongs to
+    index_name: str  # name of the shard
+    index: Index  # current index of the shard
+    active_name: str  # name of the current index (which changes when the shard is rebuilt)
+    updates: IndexUpdateQueue  # buffer of index updates that are yet to be written
+    searchers: 'SearcherPool'  # shared searchers
+    filter_cache: 'FilterCache'  # document sets of filters
+
+    def __init__(self, engine: AbstractSearchEngine, index_name: str):
+        """
+        :param engine: search engine that the shard belongs to
+        :param index_name: name of the shard
+        """
+        self.engine = engine
+        self.index_name = index_name
+        self.index = self._init_index(index_name)
+        self.updates = IndexUpdateQueue(
+            self,
+            max_latency=getattr(settings, 'SEARCH_INDEX_MAX_LATENCY', 1.0),
+            max_batch_size=getattr(settings, 'SEARCH_INDEX_MAX_BATCH_SIZE', 256),
+            writer_socket=getattr(settings, 'SEARCH_INDEX_WRITER_SOCKET', None))
+        self.searchers = SearcherPool(self)
+        self.filter_cache = FilterCache()
+        self._high_water_mark_lock = threading.Lock()
+
+    @property
+    def pk_name(self) -> str:
+        return self.engine.pk_name
+
+    def flush(self):
+        """Write all queued updates of the shard now. Blocking operation."""
+        self.updates.flush()
+
+    def decode_fields(self, values: t.Mapping[str, t.Any]) -> t.Dict[str, t.Any]:
+        """See :method:`AbstractSearchEngine.decode_fields`"""
+        return self.engine.decode_fields(values)
+
+    def index_written(self, batch: t.Mapping[str, PendingUpdate], generation: int):
+        """Called by ``self.updates`` after it wrote a batch of updates to the index.
+
+        :param batch: the written updates
+        :param generation: the index generation produced by writing the batch
+        """
+        self.engine.index_written(self, batch, generation)
+
+    def refresh_index(self):
+        """Switch to the current index if another process swapped in a rebuilt one (see
+        :method:`AbstractSearchEngine.reindex_all`). Cheap enough to call before every search or
+        write."""
+        try:
+            mtime = os.stat(self._pointer_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._pointer_mtime:
+            self._pointer_mtime = mtime
+            name = self._read_pointer()
+            if name != self.active_name:
+                self.index = whoosh.index.open_dir(settings.SEARCH_INDEX_DIR, indexname=name)
+                self.active_name = name
+
+    def swap_index(self, name: str):
+        """Atomically make the index called ``name`` the current one, and delete the files of
+        older indexes. The previous index is kept, since other processes may still be using it
+        until they notice the swap."""
+        previous = self.active_name
+        tmp_path = f'{self._pointer_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as file:
+            file.write(name)
+        os.replace(tmp_path, self._pointer_path)
+        self.index = whoosh.index.open_dir(settings.SEARCH_INDEX_DIR, indexname=name)
+        self.active_name = name
+        self._pointer_mtime = os.stat(self._pointer_path).st_mtime_ns
+        logger.info(f"swapped in index {name} for {previous}")
+
+        # index files are named '_<index name>_<generation>.toc' and '<index name>_<suffix>',
+        # and high-water mark files '<index name>.hwm'
+        pattern = re.compile(rf'^_?({re.escape(self.index_name)}(\.\d+)?)(_|\.hwm$)')
+        for filename in os.listdir(settings.SEARCH_INDEX_DIR):
+            match = pattern.match(filename)
+            if match and match.group(1) not in (name, previous):
+                os.remove(os.path.join(settings.SEARCH_INDEX_DIR, filename))
+
+    def indexed_entries(self) -> t.Dict[str, t.Optional[datetime]]:
+        """Map the primary key of each instance in the shard to its indexed modification
+        timestamp"""
+        modified_field = self.engine.modified_field
+        with self.index.searcher() as searcher:
+            return {doc[self.pk_name]: _make_aware(doc.get(modified_field))
+                    for doc in searcher.all_stored_fields()}
+
+    def high_water_mark(self) -> t.Tuple[bool, t.Union[datetime, int, None]]:
+        """The most recent modification timestamp written to the current index (or the greatest
+        primary key, if the engine has no ``modified_field``), which is kept in a file next to
+        the index, so that :method:`AbstractSearchEngine.catch_up` needn't read all entries.
+
+        :return: whether the mark is known (it isn't for indexes that weren't reconciled with the
+            database since it was introduced, or after the number of shards changed), and the
+            mark (``None`` if nothing was indexed)
+        """
+        try:
+            with open(self._high_water_mark_path()) as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return False, None
+        if data.get('shards') != len(self.engine.shards):
+            return False, None
+        mark = data.get('mark')
+        if mark is not None and self.engine.modified_field is not None:
+            mark = _make_aware(datetime.fromisoformat(mark))
+        return True, mark
+
+    def set_high_water_mark(self, mark: t.Union[datetime, int, None]):
+        """Replace the high-water mark of the current index (see :method:`high_water_mark`)"""
+        if isinstance(mark, datetime):
+            mark = _make_naive(mark).isoformat()
+        path = self._high_water_mark_path()
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp_path, 'w') as file:
+            json.dump({'mark': mark, 'shards': len(self.engine.shards)}, file)
+        os.replace(tmp_path, path)
+
+    def advance_high_water_mark(self, mark: t.Union[datetime, int]):
+        """Raise the high-water mark of the current index to ``mark`` (if it is known and lower)
+        """
+        with self._high_water_mark_lock:
+            known, current = self.high_water_mark()
+            if known and (current is None or current < mark):
+                self.set_high_water_mark(mark)
+
+    def _high_water_mark_path(self) -> str:
+        return os.path.join(settings.SEARCH_INDEX_DIR, f'{self.active_name}.hwm')
+
+    def _init_index(self, name: str) -> Index:
+        """Open the current index if its schema matches the engine's, or initialise an empty
+        one otherwise.
+        The name of the current index is kept in a pointer file, since rebuilt indexes get new
+        names (see :method:`AbstractSearchEngine.reindex_all`)."""
+        schema = self.engine.schema
+        mkdir(settings.SEARCH_INDEX_DIR)
+        self._pointer_path = os.path.join(settings.SEARCH_INDEX_DIR, f'{name}.current')
+        self.active_name = self._read_pointer()
+        self._pointer_mtime = None
+        if whoosh.index.exists_in(settings.SEARCH_INDEX_DIR, indexname=self.active_name):
+            index = whoosh.index.open_dir(settings.SEARCH_INDEX_DIR, indexname=self.active_name)
+            if _schema_signature(index.schema) == _schema_signature(schema):
+                return index
+            logger.info(f"schema of index {name} changed; recreating it")
+        return whoosh.index.create_in(settings.SEARCH_INDEX_DIR, schema,
+                                      indexname=self.active_name)
+
+    def _read_pointer(self) -> str:
+        """Name of the current index"""
+        try:
+            with open(self._pointer_path) as file:
+                return file.read().strip() or self.index_name
+        except FileNotFoundError:
+            return self.index_name
+
+
+class SearcherPool:
+    """Shares long-lived searchers of an index shard between the threads of a process.
+    Before handing out the current searcher, the pool checks that it is up to date with the
+    index, and refreshes it if not (reusing the readers of unchanged segments). A searcher that
+    is still in use when it needs refreshing is retired instead, and closed once its last user
+    releases it.
+    """
+
+    def __init__(self, engine: IndexShard):
+        """
+        :param engine: shard whose index is searched
+        """
+        self.engine = engine
+        self.stats = Counter(opened=0, refreshed=0, closed=0)  # searcher life cycle events
+
+        self._lock = threading.Lock()
+        self._current: t.Optional[Searcher] = None
+        self._index: t.Optional[Index] = None  # index of the current searcher
+        self._users: t.Counter[Searcher] = Counter()  # number of users of each searcher
+        self._pid = os.getpid()
+
+    @contextmanager
+    def searcher(self) -> t.Iterator[Searcher]:
+        """Context manager that provides an up to date searcher. The searcher should not be used
+        after exiting the context."""
+        searcher = self._acquire()
+        try:
+            yield searcher
+        finally:
+            self._release(searcher)
+
+    def close(self):
+        """Close the current searcher (or retire it, if it is in use)"""
+        with self._lock:
+            if self._current is not None:
+                self._retire(self._current)
+                self._current = None
+
+    def _acquire(self) -> Searcher:
+        self.engine.refresh_index()
+        with self._lock:
+            if self._pid != os.getpid():
+                # searchers are not shared with forked processes
+                self._current, self._index, self._users = None, None, Counter()
+                self._pid = os.getpid()
+            if self._current is None or self._index is not self.engine.index:
+                self._replace(self.engine.index.searcher())
+            elif not self._current.up_to_date():
+                if self._users[self._current]:
+                    self._replace(self.engine.index.searcher())
+                else:
+                    # refreshing closes the readers of the segments that changed, so it is
+                    # only done when no one else is using the searcher
+                    del self._users[self._current]
+                    self._current = self._current.refresh()
+                    self.stats['refreshed'] += 1
+            self._users[self._current] += 1
+            return self._current
+
+    def _release(self, searcher: Searcher):
+        with self._lock:
+            self._users[searcher] -= 1
+            if searcher is not self._current and not self._users[searcher]:
+                self._close(searcher)
+
+    def _replace(self, searcher: Searcher):
+        self.stats['opened'] += 1
+        if self._current is not None:
+            self._retire(self._current)
+        self._current, self._index = searcher, self.engine.index
+
+    def _retire(self, searcher: Searcher):
+        if not self._users[searcher]:
+            self._close(searcher)
+
+    def _close(self, searcher: Searcher):
+        del self._users[searcher]
+        searcher.close()
+        self.stats['closed'] += 1
+
+
+class FilterCache:
+    """Caches the sets of documents matching filter queries, as bitsets of document numbers.
+    Document numbers are only valid for a particular index generation, so the cache is cleared
+    whenever the generation changes; within a generation, filters can be combined by
+    intersecting their cached bitsets.
+    """
+
+    def __init__(self, size: int = 256):
+        """
+        :param size: maximum number of cached bitsets
+        """
+        self._generation = None
+        self._bitsets: t.MutableMapping[Query, BitSet] = cachetools.LRUCache(size)
+        self._lock = threading.Lock()
+
+    def docs(self, searcher: Searcher, generation: t.Hashable, query: Query) -> BitSet:
+        """Returns the set of documents matching ``query``.
+
+        :param searcher: searcher of the current index generation
+        :param generation: identifier of the current index generation
+        :param query: filter query
+        """
+        with self._lock:
+            if generation != self._generation:
+                self._bitsets.clear()
+                self._generation = generation
+            bitset = self._bitsets.get(query)
+        if bitset is None:
+            bitset = BitSet(searcher.docs_for_query(query), size=searcher.doc_count_all())
+            with self._lock:
+                if generation == self._generation:
+                    self._bitsets[query] = bitset
+        return bitset
+
+
+class StaleCursor(Exception):
+    """The index changed since a search results cursor was made, and the results that it pins
+    are no longer available (see :method:`AbstractSearchEngine.search_page`)"""
+
+
+class SearchResults:
+    """Compact search results: the primary keys and scores of the top hits (best first), the
+    total number of hits, the corrected query string, if any, and the hit counts of the
+    requested facets. Unlike whoosh Results objects, these don't hold on to a searcher and are
+    cheap to pickle, so that they can be cached."""
+    __slots__ = ('pks', 'scores', 'total', 'correction', 'facets')
+
+    def __init__(self, pks: t.Sequence[str], scores: t.Iterable[float], total: int,
+                 correction: t.Optional[str] = None,
+                 facets: t.Optional[t.Dict[str, t.Dict[t.Any, int]]] = None):
+        self.pks = tuple(pks)
+        self.scores = array('d', scores)
+        self.total = total
+        self.correction = correction
+        self.facets = facets or {}  # hit counts of each facet value, by facet name
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __iter__(self) -> t.Iterator[t.Tuple[str, float]]:
+        return zip(self.pks, self.scores)
+
+    @property
+    def has_more(self) -> bool:
+        """Whether there are more hits than the top ones"""
+        return len(self.pks) < self.total
+
+    def covers(self, limit: t.Optional[int]) -> bool:
+        """Whether these results include the top ``limit`` hits"""
+        return not self.has_more or (limit is not None and len(self.pks) >= limit)
+
+    def top(self, limit: t.Optional[int]) -> 'SearchResults':
+        """The top ``limit`` hits of these results"""
+        return SearchResults(self.pks[:limit], self.scores[:limit], self.total, self.correction,
+                             self.facets)
+
+    @classmethod
+    def merge(cls, results: t.Sequence['SearchResults'], limit: t.Optional[int],
+              descending=True) -> 'SearchResults':
+        """Merge the results of searching disjoint sets of documents (e.g. index shards).
+
+        :param results: results to merge
+        :param limit: maximum number of top hits to keep
+        :param descending: whether the hits are sorted by descending score or sort key (rather
+            than ascending)
+        """
+        hits = list(itertools.islice(
+            heapq.merge(*results, key=lambda hit: hit[1], reverse=descending), limit))
+        facets = {}
+        for shard_results in results:
+            for name, counts in shard_results.facets.items():
+                facets.setdefault(name, Counter()).update(counts)
+        return cls([pk for pk, _ in hits], [score for _, score in hits],
+                   sum(shard_results.total for shard_results in results),
+                   facets={name: dict(counts) for name, counts in facets.items()})
+
+
+class SearchPage(t.NamedTuple):
+    """A page of search results (see :method:`AbstractSearchEngine.search_page`)"""
+    query: str  # query string
+    pks: t.Sequence[str]  # primary keys of the hits on this page, best first
+    total: int  # total number of hits
+    cursor: t.Optional[str]  # cursor for the next page, or None if this is the last page
+    correction: t.Optional[str] = None  # corrected query string ("did you mean"), if any
+    facets: t.Mapping[str, t.Mapping[t.Any, int]] = {}  # hit counts of the requested facets
+
+
+def search_engines(searches: t.Mapping[str, t.Tuple['AbstractSearchEngine', t.Mapping[str, t.Any]]]
+                   ) -> t.Dict[str, SearchResults]:
+    """Search several engines concurrently (e.g. for a page that shows matching recordings,
+    books and authors), so that the time taken is that of the slowest search rather than the sum.
+    Exceptions raised by any search propagate.
+
+    :param searches: mapping of names to an engine and the keyword arguments of its
+        :method:`AbstractSearchEngine.search` method
+    :return: the results of each search, by name
+    """
+    names = list(searches)
+    if not names:
+        return {}
+    # the first search runs in this thread while the pool runs the others
+    executor = _get_executor()
+    futures = {name: executor.submit(partial(engine.search, **kwargs))
+               for name, (engine, kwargs) in searches.items() if name != names[0]}
+    engine, kwargs = searches[names[0]]
+    results = {names[0]: engine.search(**kwargs)}
+    results.update((name, future.result()) for name, future in futures.items())
+    return results
+
+
+_executor: t.Optional[ThreadPoolExecutor] = None  # for search_engines
+_executor_pid: t.Optional[int] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Thread pool for searching several engines (it doesn't survive forking)"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max(len(engines), 1), thread_name_prefix='search')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _build_shard(directory: str, name: str, documents: multiprocessing.Queue, limitmb: int):
+    """Index builder process of :method:`AbstractSearchEngine.reindex_all`: writes the chunks of
+    documents it receives to an index, until it receives ``None``"""
+    writer = whoosh.index.open_dir(directory, indexname=name).writer(limitmb=limitmb)
+    try:
+        for chunk in iter(documents.get, None):
+            for doc_fields in chunk:
+                writer.add_document(**doc_fields)
+    except BaseException:
+        writer.cancel()
+        raise
+    writer.commit()
+
+
+def _put_chunk(builder: multiprocessing.Process, documents: multiprocessing.Queue,
+               chunk: t.Optional[t.List[t.Dict]]):
+    """Send a chunk of documents to an index builder process, unless it died"""
+    while True:
+        try:
+            return documents.put(chunk, timeout=1.0)
+        except Full:
+            if not builder.is_alive():
+                raise RuntimeError(f"index builder {builder.name} died")
+
+
+def _schema_signature(schema: Schema) -> t.Dict[str, tuple]:
+    """Summarise a schema for comparison (whoosh field types don't compare equal across
+    processes)"""
+    return {name: (type(field).__name__, field.stored, field.unique, field.scorable,
+                   field.column_type is not None, getattr(field, 'spelling', False))
+            for name, field in schema.items()}
+
+
+def _make_naive(value: datetime) -> datetime:
+    """Convert a datetime to naive UTC, as whoosh DATETIME fields expect"""
+    if value is not None and timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.utc)
+    return value
+
+
+def _make_aware(value: t.Optional[datetime]) -> t.Optional[datetime]:
+    """Inverse of :func:`_make_naive`, if time zone support is enabled"""
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value, timezone.utc)
+    return value
+
+
 class LectorQueryParser(QueryParser):
-    """The search query parser for the Lector app"""
+    """The search query parser for the Lector app.
+
+    :method:`parse_cached` canonicalises query strings and keeps the parsed queries in an LRU
+    cache. Plain queries (words without any operator syntax) are canonicalised by case, word
+    order and repeated words, since they match any of their words, and their queries are built
+    directly instead of going through the parser's plugins.
+    """
 
-    def __init__(self, fieldnames: t.Iterable[str], schema: Schema):
+    def __init__(self, fieldnames: t.Iterable[str], schema: Schema, cache_size: int = 1024):
+        """
+        :param fieldnames: names of the fields that query words are matched against
+        :param schema: field schema for the search index
+        :param cache_size: maximum number of cached parsed queries
+        """
         from whoosh.qparser.plugins import MultifieldPlugin
 
         super(LectorQueryParser, self).__init__(None, schema, group=qparser.OrGroup)
-        self.add_plugin(MultifieldPlugin(fieldnames))
+        self.fieldnames = tuple(fieldnames)
+        self.add_plugin(MultifieldPlugin(self.fieldnames))
+        self._parsed: t.MutableMapping[str, Query] = cachetools.LRUCache(cache_size)
+        self._lock = threading.Lock()
+
+    def canonical(self, text: str) -> str:
+        """Canonical form of a query string: queries with the same canonical form match the same
+        documents with the same scores. The words of plain queries are lowercased, sorted and
+        deduplicated: a repeated word doesn't weigh more, since the parser normalises the
+        repeated terms of a query away (see :method:`whoosh.query.Query.normalize`)."""
+        words = text.split()
+        if self._is_plain(words):
+            return ' '.join(sorted({word.lower() for word in words}))
+        return ' '.join(words)
+
+    def parse_cached(self, text: str) -> Query:
+        """Like :method:`parse`, but the parsed query may be shared with other callers, so it
+        shouldn't be modified (:method:`whoosh.query.Query.accept` copies queries as needed)"""
+        canonical = self.canonical(text)
+        with self._lock:
+            query = self._parsed.get(canonical)
+        if query is None:
+            words = canonical.split()
+            query = self._parse_plain(words) if self._is_plain(words) else self.parse(canonical)
+            with self._lock:
+                self._parsed[canonical] = query
+        return query
+
+    def _is_plain(self, words: t.Sequence[str]) -> bool:
+        return all(PLAIN_WORD.match(word) and word not in OPERATORS for word in words)
+
+    def _parse_plain(self, words: t.Sequence[str]) -> Query:
+        """Build the query that :method:`parse` would for words without operator syntax: any of
+        the words in any of the fields"""
+        return Or([Term(fieldname, token)
+                   for word in words
+                   for fieldname in self.fieldnames
+                   for token in self.schema[fieldname].process_text(word, mode='query')]
+                  ).normalize()
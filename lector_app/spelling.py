@@ -0,0 +1,144 @@
+"""
+Spelling correction from in-memory n-gram lexicons of search index fields
+"""
+import threading
+import typing as t
+from collections import defaultdict
+
+import cachetools
+from whoosh.reading import IndexReader
+
+
+class NgramLexicon:
+    """In-memory lexicon of terms indexed by their character n-grams, for finding the terms
+    within a small edit distance of a (misspelt) word without scanning all terms."""
+
+    def __init__(self, frequencies: t.Mapping[str, int], n: int = 3):
+        """
+        :param frequencies: mapping of terms to their frequencies
+        :param n: length of the n-grams
+        """
+        self.n = n
+        self.frequencies = dict(frequencies)
+        self._postings: t.Dict[str, t.List[str]] = defaultdict(list)
+        for term in self.frequencies:
+            for gram in set(self._ngrams(term)):
+                self._postings[gram].append(term)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.frequencies
+
+    def suggest(self, word: str, maxdist: int = 2, limit: int = 5) -> t.List[t.Tuple[str, int]]:
+        """Returns the terms within ``maxdist`` edits of ``word``, closest and most frequent
+        first.
+
+        :param word: (misspelt) word
+        :param maxdist: maximum edit distance (insertions, deletions, substitutions and
+            transpositions)
+        :param limit: maximum number of terms to return
+        :return: list of (term, edit distance) tuples
+        """
+        grams = self._ngrams(word)
+        # each edit changes at most n + 1 of the word's n-grams (n for insertions, deletions and
+        # substitutions, n + 1 for transpositions)
+        min_shared = max(1, len(grams) - (self.n + 1) * maxdist)
+        shared = defaultdict(int)
+        for gram in set(grams):
+            for term in self._postings.get(gram, ()):
+                shared[term] += 1
+
+        suggestions = []
+        for term, count in shared.items():
+            if count < min_shared or abs(len(term) - len(word)) > maxdist or term == word:
+                continue
+            distance = edit_distance(word, term, maxdist)
+            if distance <= maxdist:
+                suggestions.append((distance, -self.frequencies[term], term))
+        suggestions.sort()
+        return [(term, distance) for distance, _, term in suggestions[:limit]]
+
+    def _ngrams(self, word: str) -> t.List[str]:
+        padded = f'^{word}$'
+        return [padded[i:i + self.n] for i in range(max(1, len(padded) - self.n + 1))]
+
+
+def edit_distance(a: str, b: str, maxdist: int) -> int:
+    """Optimal string alignment distance between two strings (Levenshtein distance, counting
+    transpositions of adjacent characters as one edit). Returns ``maxdist + 1`` as soon as the
+    distance is known to exceed ``maxdist``."""
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > maxdist:
+            return maxdist + 1
+    return current[-1]
+
+
+class SpellingCorrector:
+    """Corrects misspelt words against the terms of some fields of a search engine's index.
+
+    The n-gram lexicons of the fields are built from the index lexicon once per index
+    generation (when a correction is first needed), and corrections are memoised per
+    generation, so correcting a word doesn't rescan the term dictionary.
+    """
+
+    def __init__(self, fieldnames: t.Iterable[str], min_length: int = 4, memo_size: int = 4096):
+        """
+        :param fieldnames: names of the fields whose terms are used for corrections
+        :param min_length: minimum length of the words to correct (shorter words have too many
+            plausible corrections)
+        :param memo_size: maximum number of memoised corrections
+        """
+        self.fieldnames = tuple(fieldnames)
+        self.min_length = min_length
+        self.memo_size = memo_size
+
+        self._generation = None
+        self._lexicons: t.Dict[str, NgramLexicon] = {}
+        self._memo: t.MutableMapping[str, t.List[str]] = cachetools.LRUCache(memo_size)
+        self._lock = threading.RLock()
+
+    def is_known(self, reader: IndexReader, word: str) -> bool:
+        """Whether ``word`` is a term of any of the fields"""
+        return any((fieldname, word) in reader for fieldname in self.fieldnames)
+
+    def corrections(self, reader: IndexReader, generation: t.Hashable, word: str,
+                    limit: int = 3) -> t.List[str]:
+        """Returns the best corrections of ``word`` across all fields, best first (or no
+        corrections if the word is too short).
+
+        :param reader: reader of the current index generation
+        :param generation: identifier of the current index generation
+        :param word: (misspelt) word
+        :param limit: maximum number of corrections to return
+        """
+        if len(word) < self.min_length:
+            return []
+        with self._lock:
+            self._check_generation(reader, generation)
+            if word not in self._memo:
+                maxdist = 1 if len(word) < 7 else 2
+                suggestions = {}
+                for lexicon in self._lexicons.values():
+                    for term, distance in lexicon.suggest(word, maxdist, limit):
+                        frequency = sum(other.frequencies.get(term, 0)
+                                        for other in self._lexicons.values())
+                        suggestions[term] = (distance, -frequency, term)
+                self._memo[word] = [term for *_, term in sorted(suggestions.values())]
+            return self._memo[word][:limit]
+
+    def _check_generation(self, reader: IndexReader, generation: t.Hashable):
+        if generation == self._generation:
+            return
+        self._lexicons = {}
+        for fieldname in self.fieldnames:
+            frequencies = {term.decode('utf-8'): info.doc_frequency()
+                           for term, info in reader.iter_field(fieldname)}
+            self._lexicons[fieldname] = NgramLexicon(frequencies)
+        self._memo.clear()
+        self._generation = generation
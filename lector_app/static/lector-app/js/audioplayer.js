@@ -59,7 +59,65 @@ function setup() {
     }
 }
 
+// Waveform scrubber, drawn from the peaks computed by the server at the resolution that
+// matches its width (rounded up, so that the responses of similar widths are shared by caches)
+var peaks = null;
+
+function loadWaveform() {
+    var canvas = document.getElementById("waveform");
+    if (!canvas || !window.fetch) {
+        return;
+    }
+    $(canvas).removeClass('d-none');
+    var width = Math.ceil(canvas.clientWidth * (window.devicePixelRatio || 1) / 128) * 128;
+    fetch(canvas.getAttribute('data-url') + '?width=' + width)
+        .then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.arrayBuffer();
+        })
+        .then(function (buffer) {
+            peaks = new Int8Array(buffer);
+            canvas.width = width;
+            canvas.height = canvas.clientHeight * (window.devicePixelRatio || 1);
+            drawWaveform();
+        })
+        .catch(function () {
+            $(canvas).addClass('d-none');  // the slider is enough
+        });
+
+    canvas.addEventListener('click', function (event) {
+        var audio = document.getElementById("audioplayer");
+        if (audio.duration) {
+            audio.currentTime = audio.duration * event.offsetX / canvas.clientWidth;
+        }
+    });
+    document.getElementById("audioplayer").addEventListener('timeupdate', drawWaveform);
+}
+
+function drawWaveform() {
+    var canvas = document.getElementById("waveform");
+    if (!peaks || !peaks.length) {
+        return;
+    }
+    var audio = document.getElementById("audioplayer");
+    var context = canvas.getContext('2d');
+    var count = peaks.length / 2;
+    var middle = canvas.height / 2;
+    var played = audio.duration ? audio.currentTime / audio.duration * canvas.width : 0;
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    for (var x = 0; x < canvas.width; x++) {
+        var peak = Math.floor(x * count / canvas.width);
+        var low = peaks[2 * peak] / 128 * middle;
+        var high = peaks[2 * peak + 1] / 128 * middle;
+        context.fillStyle = x < played ? '#6ACB9A' : '#d3d3d3';
+        context.fillRect(x, middle - high, 1, Math.max(high - low, 1));
+    }
+}
+
 $(window).on('load', function () {
     $('#audioplayer').on('loadedmetadata', setup);
     setup();
+    loadWaveform();
 });
@@ -0,0 +1,38 @@
+// Type-ahead suggestions for search fields.
+// Search fields with a data-suggest-url attribute get their last word completed from the
+// suggestions returned by that URL, through the datalist their list attribute refers to.
+$(document).ready(function () {
+
+    $('input[data-suggest-url]').each(function () {
+        const input = $(this);
+        const datalist = $('#' + input.attr('list'));
+        let pending = null;
+
+        input.on('input', function () {
+            const words = input.val().split(/\s+/);
+            const prefix = words.pop();
+            const head = words.length ? words.join(' ') + ' ' : '';
+            if (pending !== null) {
+                pending.abort();
+            }
+            if (!prefix) {
+                datalist.empty();
+                return;
+            }
+            pending = $.ajax({
+                url: input.attr('data-suggest-url'),
+                type: "GET",
+                data: {'q': prefix},
+                success: function (json) {
+                    datalist.empty();
+                    json['suggestions'].forEach(function (suggestion) {
+                        datalist.append($('<option>').attr('value', head + suggestion));
+                    });
+                },
+                complete: function () {
+                    pending = null;
+                }
+            });
+        });
+    });
+});
@@ -0,0 +1,138 @@
+"""
+Serving (audio) files with support for byte range requests, conditional requests and offloading
+the transfer to the front proxy
+"""
+import os
+import re
+import typing as t
+
+from django.conf import settings
+from django.http import FileResponse, HttpRequest, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+
+BLOCK_SIZE = 64 * 1024  # bytes read at a time, unless the WSGI server sends the file itself
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')  # a single byte range (other requests are ignored)
+
+
+class FileRange:
+    """Read-only file-like object for the bytes of a file from ``start`` to ``start + length``,
+    for :class:`django.http.FileResponse`.
+    The file descriptor, positioned at ``start``, is exposed through ``fileno`` so that WSGI
+    servers whose ``wsgi.file_wrapper`` sends files with ``os.sendfile`` (e.g. gunicorn, which
+    stops after Content-Length bytes) transfer the range without copying it through Python.
+    """
+
+    def __init__(self, file: t.BinaryIO, start: int, length: int):
+        """
+        :param file: the file, opened in binary mode (it is closed with this object)
+        :param start: offset of the first byte
+        :param length: number of bytes
+        """
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def serve_file(request: HttpRequest, path: str, content_type: str,
+               offload_name: t.Optional[str] = None) -> HttpResponse:
+    """Response to a GET request for a file, honouring ``Range`` and ``If-Range`` headers (a
+    single byte range; others get the whole file), and conditional request headers against the
+    file's ETag and Last-Modified date.
+
+    If ``AUDIO_OFFLOAD`` is ``'x-accel-redirect'`` (nginx) or ``'x-sendfile'`` (Apache
+    mod_xsendfile, lighttpd), the front proxy is told to send the file instead, which it does
+    with the same support for ranges and conditional requests. With X-Accel-Redirect, the file
+    is looked up at ``AUDIO_OFFLOAD_PREFIX + offload_name``, which should be an internal location
+    of the proxy that maps to ``MEDIA_ROOT``.
+
+    :param request: the request
+    :param path: absolute path of the file
+    :param content_type: media type of the file
+    :param offload_name: path of the file relative to ``MEDIA_ROOT``
+    :raises FileNotFoundError: if the file doesn't exist
+    """
+    offload = getattr(settings, 'AUDIO_OFFLOAD', None)
+    if offload == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        prefix = getattr(settings, 'AUDIO_OFFLOAD_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix + (offload_name or os.path.basename(path))
+        return response
+    if offload == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:  # 304 Not Modified or 412 Precondition Failed
+        response['ETag'] = etag
+        return response
+
+    start, end = 0, size - 1
+    partial = False
+    byte_range = _requested_range(request, etag, last_modified)
+    if byte_range is not None:
+        first, last = byte_range
+        if size == 0 or (first is not None and first >= size):
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if first is None:  # the last bytes
+            start = max(size - last, 0)
+        else:
+            start, end = first, end if last is None else min(last, end)
+        partial = True
+
+    length = end - start + 1
+    response = FileResponse(FileRange(open(path, 'rb'), start, length),
+                            status=206 if partial else 200, content_type=content_type)
+    response.block_size = BLOCK_SIZE
+    response['Content-Length'] = length
+    if partial:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _requested_range(request: HttpRequest, etag: str, last_modified: int
+                     ) -> t.Optional[t.Tuple[t.Optional[int], t.Optional[int]]]:
+    """The ``(first, last)`` byte positions of the range requested by the ``Range`` header, if
+    any (``first`` is ``None`` for the last ``last`` bytes; ``last`` is ``None`` for all bytes
+    from ``first``), or ``None`` if the whole file should be sent, e.g. because the
+    ``If-Range`` header doesn't match the current version of the file"""
+    match = RANGE.match(request.META.get('HTTP_RANGE', '').strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None:
+        if if_range.startswith(('"', 'W/')):
+            if if_range != etag:  # weak validators never match
+                return None
+        elif parse_http_date_safe(if_range) != last_modified:
+            return None
+    first, last = (int(position) if position else None for position in match.groups())
+    if first is None and not last:
+        return None  # an empty suffix
+    if first is not None and last is not None and last < first:
+        return None  # invalid, so ignored
+    return first, last
@@ -0,0 +1,135 @@
+"""
+Type-ahead suggestions from in-memory prefix structures built from search index lexicons
+"""
+import heapq
+import logging
+import threading
+import time
+import typing as t
+from bisect import bisect_left
+from collections import Counter
+
+import cachetools
+
+
+logger = logging.getLogger('lector-app suggest')
+
+
+class PrefixIndex:
+    """Immutable sorted array of terms supporting weighted prefix completion.
+    The heaviest ``top_size`` completions of the prefixes that were completed recently are
+    kept, so that completing a short prefix (which thousands of terms may start with) only
+    scans its terms the first time."""
+
+    def __init__(self, weights: t.Mapping[str, int] = (), top_size: int = 32,
+                 max_prefixes: int = 4096):
+        """
+        :param weights: mapping of terms to their weights (e.g. document frequencies)
+        :param top_size: number of completions kept per prefix
+        :param max_prefixes: maximum number of prefixes whose completions are kept (the least
+            recently completed ones are dropped first)
+        """
+        self.weights = Counter(weights)
+        self.terms = sorted(self.weights)
+        self.top_size = top_size
+        self._tops = cachetools.LRUCache(max_prefixes)  # heaviest completions, by prefix
+
+    def __len__(self):
+        return len(self.terms)
+
+    def complete(self, prefix: str, limit: int = 10) -> t.List[str]:
+        """Returns the heaviest terms starting with ``prefix``, heaviest first (and shortest
+        first among terms of the same weight).
+
+        :param prefix: prefix to complete
+        :param limit: maximum number of completions to return
+        """
+        if limit > self.top_size:
+            return self._heaviest(prefix, limit)
+        top = self._tops.get(prefix)
+        if top is None:
+            top = self._tops[prefix] = self._heaviest(prefix, self.top_size)
+        return top[:limit]
+
+    def _heaviest(self, prefix: str, limit: int) -> t.List[str]:
+        start = bisect_left(self.terms, prefix)
+        end = bisect_left(self.terms, prefix + '\U0010ffff', start)
+        return heapq.nsmallest(limit, self.terms[start:end], key=self._key)
+
+    def _key(self, term: str) -> t.Tuple[int, int, str]:
+        return -self.weights[term], len(term), term
+
+
+class Suggester:
+    """Provides type-ahead suggestions for a search engine from the lexicons of some of its
+    index's fields.
+
+    The prefix structure is rebuilt from the index lexicon in a background thread whenever the
+    index generation changes (which is checked at most every ``check_interval`` seconds), so
+    that the terms of updated and deleted documents are dropped too. Answering a suggestion
+    request never touches the index, its searchers or the database.
+    """
+
+    def __init__(self, engine, fieldnames: t.Iterable[str], check_interval: float = 5.0):
+        """
+        :param engine: the :class:`lector_app.search.AbstractSearchEngine` whose index is used
+        :param fieldnames: names of the fields whose terms are suggested
+        :param check_interval: minimum time in seconds between checks of the index generation
+        """
+        self.engine = engine
+        self.fieldnames = tuple(fieldnames)
+        self.check_interval = check_interval
+
+        self._prefixes = PrefixIndex()
+        self._generation: t.Optional[t.Hashable] = None  # index generation of self._prefixes
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+
+    def suggest(self, prefix: str, limit: int = 10) -> t.List[str]:
+        """Returns the most frequent terms that start with ``prefix``
+
+        :param prefix: the prefix of a term, as typed by a user
+        :param limit: maximum number of suggestions to return
+        """
+        self._check_generation()
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        return self._prefixes.complete(prefix, limit)
+
+    def rebuild(self):
+        """Rebuild the prefix structure from the index lexicon. Blocking operation."""
+        with self.engine.shard_searchers() as searchers:
+            reader = self.engine.lexicon_reader(searchers)
+            generation = self.engine.generation(searchers)
+            weights = Counter()
+            for fieldname in self.fieldnames:
+                for term, info in reader.iter_field(fieldname):
+                    weights[term] += info.doc_frequency()
+        prefixes = PrefixIndex({term.decode('utf-8'): weight for term, weight in weights.items()})
+        with self._lock:
+            self._prefixes, self._generation = prefixes, generation
+        logger.debug(f"rebuilt suggestions for index {self.engine.index_name} "
+                     f"({len(prefixes)} terms)")
+
+    def _check_generation(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        generation = self.engine.latest_generation()
+        with self._lock:
+            if generation == self._generation or self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, daemon=True,
+                         name=f'suggestions-{self.engine.index_name}').start()
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception(f"failed to rebuild suggestions for index {self.engine.index_name}")
+        finally:
+            self._rebuilding = False
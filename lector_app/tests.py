@@ -1,13 +1,42 @@
+import hashlib
+import importlib.util
+import io
+import os
 import random
+import re
+import shutil
 import string
+import tempfile
+import threading
 import unittest
+import wave
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
 from django.contrib.auth.models import User
-from django.test import TestCase
-from django.test.client import Client
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.client import Client, RequestFactory
 from django.urls import reverse
+from django.utils import timezone
+from whoosh import fields
+from whoosh.filedb.filestore import RamStorage
+from whoosh.query import Term
 
-from . import models
+from . import covers, models, mp3, search, uploads, views, waveforms
+from .index_writer import IndexWriterServer
+from .indexing import IndexUpdateQueue
+from .maintenance import TieredMergePolicy
+from .middleware import UserStateMiddleware
+from .ranking import BlendedWeighting
+from .search import FilterCache, LectorQueryParser, SearcherPool, SearchResults
+from .spelling import NgramLexicon, edit_distance
+from .streaming import serve_file
+from .suggest import PrefixIndex
 
 
 # # models test
@@ -54,3 +83,864 @@ class LoginTestCase(unittest.TestCase):
         self.logout_url = reverse('lector-app:logout')
         response = self.client.post(self.logout_url, follow=True)
         self.assertEqual(response.status_code, 200)
+
+
+class IndexUpdateQueueTests(unittest.TestCase):
+    def setUp(self):
+        schema = fields.Schema(id=fields.ID(stored=True, unique=True), title=fields.TEXT)
+        self.engine = SimpleNamespace(index=RamStorage().create_index(schema), pk_name='id',
+                                      index_name='test', refresh_index=lambda: None,
+                                      index_written=lambda batch, generation: None)
+        self.queue = IndexUpdateQueue(self.engine, max_latency=60.0)
+
+    def stored_documents(self):
+        with self.engine.index.searcher() as searcher:
+            return sorted(doc['id'] for doc in searcher.all_stored_fields())
+
+    def testCoalescesUpdatesIntoOneCommit(self):
+        for title in ("Animal Farm", "Animal Farm (abridged)"):
+            self.queue.update('1', {'id': '1', 'title': title})
+        self.queue.update('2', {'id': '2', 'title': "Pride and Prejudice"})
+        self.queue.delete('2')
+        self.assertEqual(len(self.queue), 2)
+
+        generation = self.engine.index.latest_generation()
+        self.queue.flush()
+        self.assertEqual(self.engine.index.latest_generation(), generation + 1)
+        self.assertEqual(self.stored_documents(), ['1'])
+
+    def testDropsUpdatesOnRollback(self):
+        try:
+            with transaction.atomic():
+                self.queue.update('1', {'id': '1', 'title': "Animal Farm"})
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(len(self.queue), 0)
+
+    def testSendsBatchesToWriterService(self):
+        self.engine.updates, self.engine.flush = self.queue, self.queue.flush
+        self.engine.decode_fields = dict
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'writer.sock')
+            with IndexWriterServer(path, [self.engine]) as server:
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                worker_queue = IndexUpdateQueue(self.engine, writer_socket=path)
+                worker_queue.put({'1': {'id': '1', 'title': "Animal Farm"}})
+                worker_queue.flush()
+                server.shutdown()
+        self.assertEqual(self.stored_documents(), ['1'])
+
+
+class SearcherPoolTests(unittest.TestCase):
+    def setUp(self):
+        schema = fields.Schema(id=fields.ID(stored=True, unique=True))
+        self.engine = SimpleNamespace(index=RamStorage().create_index(schema),
+                                      refresh_index=lambda: None)
+        self.pool = SearcherPool(self.engine)
+
+    def add_document(self, pk):
+        with self.engine.index.writer() as writer:
+            writer.add_document(id=pk)
+
+    def testRefreshesIdleSearcher(self):
+        self.add_document('1')
+        with self.pool.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 1)
+        with self.pool.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 1)
+        self.add_document('2')
+        with self.pool.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 2)
+        self.assertEqual(self.pool.stats, Counter(opened=1, refreshed=1, closed=0))
+
+    def testRetiresSearcherInUse(self):
+        self.add_document('1')
+        with self.pool.searcher() as old:
+            self.add_document('2')
+            with self.pool.searcher() as new:
+                self.assertIsNot(new, old)
+                self.assertEqual((old.doc_count(), new.doc_count()), (1, 2))
+            self.assertEqual(self.pool.stats['closed'], 0)
+        self.assertEqual(self.pool.stats['closed'], 1)  # by its last user
+
+        with self.pool.searcher() as searcher:
+            self.pool.close()
+            self.assertEqual(self.pool.stats['closed'], 1)
+            self.assertEqual(searcher.doc_count(), 2)
+        self.assertEqual(self.pool.stats, Counter(opened=2, refreshed=0, closed=2))
+
+
+# the tests use caches of their own process rather than the file-based caches that are shared
+LOCAL_CACHES = {name: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                       'LOCATION': f'tests-{name}'}
+                for name in ('default', 'search', 'users')}
+
+
+@override_settings(CACHES=LOCAL_CACHES, LIBRARY_CACHE='default')
+class SearchEngineTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        orwell = models.Author.objects.create(first_name="George", last_name="Orwell")
+        user = User.objects.create_user('reader0', 'reader0@example.com', 'readerpassword')
+        reader = models.UserProfile.objects.create(user=user, voice_type="scots voice")
+        self.recordings = [
+            models.Recording.objects.create(
+                book=models.Book.objects.create(title=title, author=orwell), reader=reader,
+                duration=timedelta(minutes=90), audio_file='sample.mp3')
+            for title in ("Animal Farm", "Nineteen Eighty-Four")]
+
+    def fresh_engine(self, model, shards=1):
+        """A new search engine of ``model``, with its own index (of ``shards`` shards) in a
+        temporary directory, which indexes instances right away when asked to reindex them"""
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        index_settings = override_settings(SEARCH_INDEX_DIR=index_dir.name,
+                                           SEARCH_INDEX_CATCH_UP_SLACK=0,
+                                           SEARCH_INDEX_SHARDS=shards)
+        index_settings.enable()
+        self.addCleanup(index_settings.disable)
+        registered = search.engines[model.search_engine.index_name]
+        self.addCleanup(search.engines.__setitem__, registered.index_name, registered)
+        engine = type(model.search_engine)()
+        installed = mock.patch.object(model, 'search_engine', engine)
+        installed.start()
+        self.addCleanup(installed.stop)
+
+        def index_now(instance):
+            fields = engine._extract_search_fields(instance)
+            engine.shard_for(fields[engine.pk_name]).updates.put({fields[engine.pk_name]: fields})
+            engine.flush()
+        reindex = mock.patch.object(engine, 'reindex', side_effect=index_now)
+        reindex.start()
+        self.addCleanup(reindex.stop)
+        return engine
+
+    def test_catch_up_after_offline_change(self):
+        engine = self.fresh_engine(models.Recording)
+        farm, nineteen = self.recordings
+        homage = models.Recording.objects.create(
+            book=models.Book.objects.create(title="Homage to Catalonia", author=farm.book.author),
+            reader=farm.reader, duration=timedelta(minutes=60), audio_file='sample.mp3')
+        now = timezone.now()
+        for recording, hours in ((homage, 3), (farm, 2), (nineteen, 1)):
+            models.Recording.objects.filter(pk=recording.pk) \
+                .update(modified=now - timedelta(hours=hours))
+        self.assertEqual(engine.catch_up(), 3)  # no high-water mark yet: reconciled
+        self.assertEqual(engine.shards[0].high_water_mark(), (True, now - timedelta(hours=1)))
+
+        models.Recording.objects.filter(pk=farm.pk).update(modified=now)
+        engine.reindex.reset_mock()
+        self.assertEqual(engine.catch_up(), 2)  # and the one at the high-water mark
+        self.assertEqual({call[0][0] for call in engine.reindex.call_args_list}, {farm, nineteen})
+        self.assertEqual(engine.shards[0].high_water_mark(), (True, now))
+
+        # deleted while not tracking changes: the entry count gives it away
+        models.Recording.objects.filter(pk=nineteen.pk).delete()
+        with mock.patch.object(engine.shards[0].updates, 'delete') as delete:
+            engine.catch_up()
+            delete.assert_called_once_with(str(nineteen.pk))
+
+    def test_rebuild_swaps_in_the_new_index(self):
+        engine = self.fresh_engine(models.Recording)
+        shard = engine.shards[0]
+        index_dir = os.path.dirname(shard._pointer_path)
+        names = []
+        for _ in range(3):
+            engine.reindex_all(procs=1)
+            names.append(shard.active_name)
+            with open(shard._pointer_path) as file:
+                self.assertEqual(file.read(), shard.active_name)
+            with shard.searchers.searcher() as searcher:
+                self.assertEqual(searcher.doc_count(), len(self.recordings))
+        self.assertEqual(len(set(names)), 3)
+        # the previous index is kept for the processes that haven't noticed the swap yet
+        indexes = {re.match(r'^_?(.+?)(_|\.hwm$|\.current$)', filename).group(1)
+                   for filename in os.listdir(index_dir)}
+        self.assertEqual(indexes, {engine.index_name, names[1], names[2]})
+        self.assertFalse(any(names[0] in filename for filename in os.listdir(index_dir)))
+
+    def test_sharded_index(self):
+        farm, _ = self.recordings
+        recordings = self.recordings + [
+            models.Recording.objects.create(book=farm.book, reader=farm.reader,
+                                            duration=timedelta(minutes=minutes),
+                                            audio_file='sample.mp3')
+            for minutes in (30, 60, 120, 150)]
+        engine = self.fresh_engine(models.Recording, shards=2)
+        self.assertEqual({engine.shard_for(str(r.pk)) for r in recordings}, set(engine.shards))
+
+        engine.reindex_all()
+        for shard in engine.shards:
+            self.assertEqual(set(shard.indexed_entries()),
+                             {str(r.pk) for r in recordings
+                              if engine.shard_for(str(r.pk)) is shard})
+        by_duration = sorted(recordings, key=lambda recording: recording.duration)
+        results = engine.search("orwell", sortedby='duration_seconds', facets=['voice_type'])
+        self.assertEqual(results.pks, tuple(str(r.pk) for r in by_duration))
+        self.assertEqual(results.facets, {'voice_type': {'scots voice': 6}})
+        self.assertEqual(engine.search("orwell", limit=2, sortedby='duration_seconds',
+                                       reverse=True).pks,
+                         tuple(str(r.pk) for r in by_duration[:-3:-1]))
+
+        # an entry in the other shard (as after a change of the number of shards) is removed
+        pk = str(farm.pk)
+        other = next(shard for shard in engine.shards if shard is not engine.shard_for(pk))
+        other.updates.put({pk: engine._extract_search_fields(farm)})
+        engine.flush()
+        self.assertEqual(engine.search("orwell").total, 7)
+        with mock.patch.object(other.updates, 'delete') as delete:
+            engine.catch_up()
+            delete.assert_called_once_with(pk)
+
+    def test_index_maintenance_merges_segments(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.maintenance.policy = TieredMergePolicy(max_segments=2)
+        shard = engine.shards[0]
+        farm, nineteen = self.recordings
+        for recording in (farm, nineteen, farm, nineteen):  # a segment per write
+            engine.reindex(recording)
+        (stats,) = engine.maintenance.stats()
+        self.assertEqual((stats.name, stats.segments, stats.doc_count, stats.deleted),
+                         (shard.active_name, 4, 2, 2))
+
+        self.assertTrue(engine.maintenance.compact(shard))
+        (stats,) = engine.maintenance.stats()
+        self.assertLessEqual(stats.segments, 2)
+        self.assertEqual(stats.doc_count, 2)
+        self.assertTrue(engine.maintenance.compact(shard, optimize=True))
+        self.assertFalse(engine.maintenance.compact(shard, optimize=True))
+        (stats,) = engine.maintenance.stats()
+        self.assertEqual((stats.segments, stats.doc_count, stats.deleted), (1, 2, 0))
+
+        output = io.StringIO()
+        call_command('index_maintenance', stdout=output)
+        self.assertIn(f"{shard.active_name} (generation {stats.generation}): 1 segments, "
+                      f"2 documents, 0 deleted", output.getvalue())
+
+    def test_search_results_are_cached_by_generation(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.catch_up()
+        farm, _ = self.recordings
+        with mock.patch.object(engine, '_search', wraps=engine._search) as search_now:
+            self.assertEqual(engine.search("animal farm").pks, (str(farm.pk),))
+            self.assertEqual(engine.search("Farm  animal").pks, (str(farm.pk),))
+            self.assertEqual(search_now.call_count, 1)
+
+            engine._reindex_now([str(farm.pk)])  # a new generation of the index
+            self.assertEqual(engine.search("animal farm").pks, (str(farm.pk),))
+            self.assertEqual(search_now.call_count, 2)
+
+    def test_search_pages_are_cut_from_the_pinned_generation(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.catch_up()
+        first = engine.search_page("orwell", pagelen=1)
+        self.assertEqual(first.total, 2)
+        # the index changes between pages: the hit of the first page is removed
+        engine.shard_for(first.pks[0]).updates.put({first.pks[0]: None})
+        engine.flush()
+        second = engine.search_page(cursor=first.cursor, pagelen=1)
+        self.assertEqual({first.pks[0], second.pks[0]}, {str(r.pk) for r in self.recordings})
+
+        caches['search'].clear()
+        with self.assertRaises(search.StaleCursor):
+            engine.search_page(cursor=first.cursor, pagelen=1)
+
+    def test_search_filters_and_facets(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.catch_up()
+        farm, nineteen = self.recordings
+        models.Recording.objects.filter(pk=nineteen.pk).update(duration=timedelta(hours=3))
+        engine._reindex_now([str(nineteen.pk)])
+        results = engine.search("orwell", filters={'duration_seconds': [7200, None]},
+                                facets=['duration', 'voice_type'])
+        self.assertEqual(results.pks, (str(nineteen.pk),))
+        self.assertEqual(results.facets, {'duration': {(7200, 14400): 1},
+                                          'voice_type': {'scots voice': 1}})
+        results = engine.search("", filters={'voice_type': 'scots voice',
+                                             'duration_seconds': [None, 7200]})
+        self.assertEqual(results.pks, (str(farm.pk),))
+
+    def test_search_filters_matching_nothing(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.catch_up()
+        for filters in ({'voice_type': 'nobody'},
+                        {'voice_type': 'scots voice', 'duration_seconds': [7200, None]}):
+            results = engine.search("orwell", filters=filters, facets=['voice_type'])
+            self.assertEqual((results.pks, results.total, results.facets),
+                             ((), 0, {'voice_type': {}}))
+
+    def test_hydrate_keeps_order_and_drops_stale_hits(self):
+        engine = models.Recording.search_engine
+        farm, nineteen = self.recordings
+        with self.assertNumQueries(1):
+            hydrated = engine.hydrate([str(nineteen.pk), '999999', str(farm.pk)])
+            self.assertEqual(hydrated, [nineteen, farm])
+            self.assertEqual([str(recording.book.author) for recording in hydrated],
+                             ["George Orwell"] * 2)
+
+    def test_library_changes_reindex_recordings(self):
+        engine = models.Recording.search_engine
+        farm, nineteen = self.recordings
+        profile = farm.reader
+        with mock.patch.object(engine, 'reindex_pks') as reindex_pks:
+            profile.library.add(farm, nineteen)
+            reindex_pks.assert_called_once_with({farm.pk, nineteen.pk}, 'default')
+
+            reindex_pks.reset_mock()
+            profile.library.clear()
+            reindex_pks.assert_called_once_with([farm.pk, nineteen.pk], 'default')
+
+    def test_dependency_changes_reindex_dependent_recordings(self):
+        engine = models.Recording.search_engine
+        farm, nineteen = self.recordings
+        with mock.patch.object(engine, 'reindex_pks') as reindex_pks:
+            farm.book.title = "Animal Farm: A Fairy Story"
+            farm.book.save()
+            reindex_pks.assert_called_once_with([farm.pk], 'default')
+
+            reindex_pks.reset_mock()
+            models.Author.objects.filter(last_name="Orwell").update(first_name="Eric")
+            reindex_pks.assert_called_once_with([farm.pk, nineteen.pk], 'default')
+
+            reindex_pks.reset_mock()
+            farm.reader.user.save(update_fields=['last_login'])
+            reindex_pks.assert_not_called()
+
+    def test_recording_changes_reindex_books(self):
+        engine = models.Book.search_engine
+        farm, _ = self.recordings
+        with mock.patch.object(engine, 'reindex_pks') as reindex_pks:
+            farm.save()
+            reindex_pks.assert_called_once_with([farm.book.pk], 'default')
+
+            reindex_pks.reset_mock()
+            farm.save(update_fields=['duration'])
+            reindex_pks.assert_not_called()
+
+    def test_queryset_delete_removes_recordings_from_index(self):
+        engine = models.Recording.search_engine
+        farm, _ = self.recordings
+        with mock.patch.object(engine.shard_for(str(farm.pk)).updates, 'delete') as delete:
+            models.Recording.objects.filter(pk=farm.pk).delete()
+            delete.assert_called_once_with(str(farm.pk), using='default')
+
+    def test_search_results_rejects_invalid_cursor(self):
+        response = self.client.get(reverse('lector-app:search_results'), {'cursor': 'forged'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_hits_are_cached_without_library_state(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.catch_up()
+        farm, nineteen = self.recordings
+        farm.reader.library.add(farm)
+        engine._reindex_now([str(farm.pk)])  # its popularity changed
+        request = RequestFactory().get(reverse('lector-app:search'))
+        request.user = farm.reader.user
+        UserStateMiddleware(lambda request: None)(request)
+        pks = [str(nineteen.pk), str(farm.pk)]
+        views._search_hits(request, pks)
+        with self.assertNumQueries(0):
+            hits = views._search_hits(request, pks)
+        self.assertEqual([(hit['pk'], hit['in_library']) for hit in hits],
+                         [(str(nineteen.pk), False), (str(farm.pk), True)])
+        self.assertIn("Nineteen Eighty-Four", hits[0]['head'])
+
+    def test_search_hits_are_cached_by_entry_version(self):
+        engine = self.fresh_engine(models.Recording)
+        engine.catch_up()
+        farm, nineteen = self.recordings
+        request = RequestFactory().get(reverse('lector-app:search'))
+        request.user = farm.reader.user
+        UserStateMiddleware(lambda request: None)(request)
+        pks = [str(nineteen.pk), str(farm.pk)]
+        views._search_hits(request, pks)
+
+        farm.reader.library.add(nineteen)
+        engine._reindex_now(pks)  # a new generation of the shard, but the same versions
+        with self.assertNumQueries(0):
+            views._search_hits(request, pks)
+
+        models.Book.objects.filter(pk=farm.book.pk).update(title="Animal Farm: A Fairy Story")
+        engine._reindex_now([str(farm.pk)])
+        with self.assertNumQueries(1):  # fetching the changed hit
+            hits = views._search_hits(request, pks)
+        self.assertIn("A Fairy Story", hits[1]['head'])
+
+    def test_library_changes_invalidate_cached_libraries(self):
+        farm, nineteen = self.recordings
+        profile = farm.reader
+        self.assertEqual(profile.library_pks(), frozenset())
+        profile.library.add(farm, nineteen)
+        self.assertEqual(profile.library_pks(), {farm.pk, nineteen.pk})
+        farm.userprofile_set.clear()
+        self.assertEqual(profile.library_pks(), {nineteen.pk})
+        nineteen.delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(profile.library_pks(), frozenset())
+            self.assertEqual(profile.library_pks(), frozenset())
+
+    def test_counters_follow_recordings_and_libraries(self):
+        farm, nineteen = self.recordings
+        profile = farm.reader
+        profile.library.add(farm, nineteen)
+        nineteen.userprofile_set.remove(profile)
+        farm.duration = timedelta(minutes=30)
+        farm.save()
+        profile.refresh_from_db()
+        self.assertEqual((profile.upload_count, profile.library_count, profile.narrated_duration),
+                         (2, 1, timedelta(minutes=120)))
+
+        farm.delete()
+        profile.refresh_from_db()
+        self.assertEqual((profile.upload_count, profile.library_count, profile.narrated_duration),
+                         (1, 0, timedelta(minutes=90)))
+
+        models.UserProfile.objects.update(upload_count=0, library_count=5)
+        models.UserProfile.objects.recount()
+        profile.refresh_from_db()
+        self.assertEqual((profile.upload_count, profile.library_count, profile.narrated_duration),
+                         (1, 0, timedelta(minutes=90)))
+
+    def test_suggest_falls_back_to_the_default_limit(self):
+        for limit in ('many', '-3', '100'):
+            response = self.client.get(reverse('lector-app:suggest'), {'q': "or", 'limit': limit})
+            self.assertEqual(response.status_code, 200)
+
+    def test_counters_dont_go_negative(self):
+        farm, _ = self.recordings
+        farm.reader.library.add(farm)
+        models.UserProfile.objects.update(upload_count=0, library_count=0, narrated_seconds=0)
+        farm.delete()
+        profile = models.UserProfile.objects.get()
+        self.assertEqual((profile.upload_count, profile.library_count, profile.narrated_seconds),
+                         (0, 0, 0))
+
+    def test_search_all_groups_results_by_model(self):
+        for model in (models.Recording, models.Book, models.Author):
+            self.fresh_engine(model).catch_up()
+        farm, nineteen = self.recordings
+        response = self.client.get(reverse('lector-app:search_all'), {'query': "orwell"})
+        self.assertEqual(response.status_code, 200)
+        groups = {group: (response.json()[group]['total'],
+                          {hit['id'] for hit in response.json()[group]['hits']})
+                  for group in ('recordings', 'books', 'authors')}
+        self.assertEqual(groups, {'recordings': (2, {farm.pk, nineteen.pk}),
+                                  'books': (2, {farm.book.pk, nineteen.book.pk}),
+                                  'authors': (1, {farm.book.author.pk})})
+
+        response = self.client.get(reverse('lector-app:search_all'), {'query': "farm"})
+        self.assertEqual([hit['title'] for hit in response.json()['books']['hits']],
+                         ["Animal Farm"])
+
+    def test_book_search_rejects_invalid_books(self):
+        response = self.client.get(reverse('lector-app:book_search'), {'book': "farm"})
+        self.assertEqual(response.status_code, 404)
+
+
+def mp3_frames(count):
+    """A constant bitrate MP3 file of ``count`` (silent) frames of 417 bytes"""
+    return (bytes([0xFF, 0xFB, 0x90, 0x00]) + bytes(413)) * count
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class UploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings = override_settings(MEDIA_ROOT=media_root.name, UPLOAD_CHUNK_SIZE=2000)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        user = User.objects.create_user('reader0', 'reader0@example.com', 'readerpassword')
+        models.UserProfile.objects.create(user=user, voice_type="scots voice")
+        self.client.login(username='reader0', password='readerpassword')
+
+    def send_chunk(self, upload_id, offset, chunk, checksum=None):
+        return self.client.post(
+            f"{reverse('lector-app:upload_chunk', args=[upload_id])}?offset={offset}", chunk,
+            content_type='application/octet-stream',
+            HTTP_X_CHUNK_SHA256=checksum or hashlib.sha256(chunk).hexdigest())
+
+    def upload(self, data, title="Animal Farm"):
+        response = self.client.post(reverse('lector-app:upload_start'), {
+            'title': title, 'author': "george orwell", 'size': len(data),
+            'filename': 'farm.mp3'})
+        upload_id = response.json()['id']
+        for offset in range(0, len(data), 2000):
+            self.send_chunk(upload_id, offset, data[offset:offset + 2000])
+        response = self.client.post(reverse('lector-app:upload_finish', args=[upload_id]))
+        return models.Recording.objects.get(pk=response.json()['id'])
+
+    def test_resumable_upload(self):
+        data = mp3_frames(8)
+        response = self.client.post(reverse('lector-app:upload_start'), {
+            'title': "Animal Farm", 'author': "george orwell", 'size': len(data),
+            'filename': 'farm.mp3'})
+        upload_id = response.json()['id']
+
+        self.assertEqual(self.send_chunk(upload_id, 0, data[:2000], checksum='0' * 64)
+                         .status_code, 400)
+        self.assertEqual(self.send_chunk(upload_id, 0, data[:1000]).status_code, 400)
+        self.assertEqual(self.send_chunk(upload_id, 1000, data[1000:2000]).status_code, 409)
+        self.assertEqual(self.send_chunk(upload_id, 0, data[:2000]).json()['offset'], 2000)
+        finish_url = reverse('lector-app:upload_finish', args=[upload_id])
+        self.assertEqual(self.client.post(finish_url).status_code, 409)
+        self.assertEqual(models.Recording.objects.count(), 0)
+
+        self.send_chunk(upload_id, 2000, data[2000:])
+        recording = models.Recording.objects.get(pk=self.client.post(finish_url).json()['id'])
+        self.assertEqual(str(recording.book), "Animal Farm, by George Orwell")
+        self.assertEqual(recording.duration, timedelta(seconds=8 * 1152 / 44100))
+        with recording.audio_file.open('rb') as file:
+            self.assertEqual(file.read(), data)
+        self.assertFalse(models.Upload.objects.exists())
+
+    def test_interrupted_chunk_and_retry(self):
+        data = mp3_frames(8)
+        upload_id = self.client.post(reverse('lector-app:upload_start'), {
+            'title': "Animal Farm", 'author': "george orwell", 'size': len(data)}).json()['id']
+        upload = models.Upload.objects.get(pk=upload_id)
+        checksum = hashlib.sha256(data[:2000]).hexdigest()
+        with self.assertRaises(uploads.UploadError):
+            uploads.append_chunk(upload, 0, io.BytesIO(data[:1500]), 2000, checksum)
+        self.assertEqual(os.path.getsize(uploads.part_path(upload)), 0)
+
+        # the interrupted request is still being received when its retry is appended
+        interrupted = models.Upload.objects.get(pk=upload_id)
+        self.assertEqual(uploads.append_chunk(upload, 0, io.BytesIO(data[:2000]), 2000, checksum),
+                         2000)
+        other = bytes(2000)
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.append_chunk(interrupted, 0, io.BytesIO(other), 2000,
+                                 hashlib.sha256(other).hexdigest())
+        self.assertEqual((raised.exception.status, interrupted.received), (409, 2000))
+        with open(uploads.part_path(upload), 'rb') as part:
+            self.assertEqual(part.read(), data[:2000])
+        self.assertEqual(self.send_chunk(upload_id, 'next', data[2000:4000]).json(),
+                         {'error': "invalid offset", 'offset': 2000})
+        self.assertEqual(os.listdir(os.path.dirname(uploads.part_path(upload))),
+                         [os.path.basename(uploads.part_path(upload))])
+
+    def test_duplicates_share_a_file(self):
+        data = mp3_frames(12)
+        first, second = self.upload(data), self.upload(data, title="1984")
+        self.assertEqual(first.audio_file.name, second.audio_file.name)
+        audio_file = models.AudioFile.objects.get()
+        self.assertEqual(audio_file.references, 2)
+        self.assertEqual(audio_file.sha256, uploads.file_address(first.audio_file.path))
+        self.assertEqual(len(os.listdir(os.path.dirname(first.audio_file.path))), 1)
+
+        second.delete()
+        self.assertEqual(models.AudioFile.objects.get().references, 1)
+
+    def test_rejects_other_files(self):
+        data = os.urandom(3000)
+        response = self.client.post(reverse('lector-app:upload_start'), {
+            'title': "Animal Farm", 'author': "george orwell", 'size': len(data)})
+        upload_id = response.json()['id']
+        self.send_chunk(upload_id, 0, data[:2000])
+        self.send_chunk(upload_id, 2000, data[2000:])
+        response = self.client.post(reverse('lector-app:upload_finish', args=[upload_id]))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.Recording.objects.exists() or models.Upload.objects.exists())
+
+
+@override_settings(CACHES=LOCAL_CACHES, WAVEFORM_WORKERS=0, COVER_WORKERS=0)
+class SharedAudioFileTests(TransactionTestCase):
+    """Deleting recordings, whose transactions commit (so that their on_commit hooks run)"""
+    send_chunk, upload = UploadTests.send_chunk, UploadTests.upload
+
+    def setUp(self):
+        UploadTests.setUp(self)
+        indexing = mock.patch.object(IndexUpdateQueue, 'put')  # rather than the search index's
+        indexing.start()
+        self.addCleanup(indexing.stop)
+
+    def test_file_is_deleted_with_its_last_recording(self):
+        data = mp3_frames(12)
+        first, second = self.upload(data), self.upload(data, title="1984")
+        path = first.audio_file.path
+        second.delete()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(models.AudioFile.objects.get().references, 1)
+
+        first.delete()
+        self.assertFalse(os.path.exists(path) or models.AudioFile.objects.exists())
+
+
+class StreamingTests(unittest.TestCase):
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile(suffix='.mp3', delete=False)
+        file.write(bytes(range(100)))
+        file.close()
+        self.path = file.name
+        self.addCleanup(os.remove, self.path)
+
+    def serve(self, **headers):
+        response = serve_file(RequestFactory().get('/', **headers), self.path, 'audio/mpeg')
+        self.addCleanup(response.close)
+        return response
+
+    def test_range_requests(self):
+        response = self.serve(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+        response = self.serve(HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(95, 100)))
+
+        response = self.serve(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_validators(self):
+        etag = self.serve()['ETag']
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+        response = self.serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '100')
+
+    @override_settings(AUDIO_OFFLOAD='x-accel-redirect', AUDIO_OFFLOAD_PREFIX='/protected/')
+    def test_offloads_to_the_front_proxy(self):
+        recording = models.Recording(pk=1, audio_file='audio_files/ab/farm.mp3')
+        with mock.patch.object(views, 'get_object_or_404', return_value=recording):
+            response = views.audio_stream(RequestFactory().get('/', HTTP_RANGE='bytes=10-19'), 1)
+        self.assertEqual((response.status_code, response.content), (200, b''))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/audio_files/ab/farm.mp3')
+        self.assertEqual(response['Content-Type'], 'audio/mpeg')
+
+        with override_settings(AUDIO_OFFLOAD='x-sendfile'):
+            response = self.serve(HTTP_RANGE='bytes=10-19')
+        self.assertEqual((response.status_code, response['X-Sendfile']), (200, self.path))
+        self.assertNotIn('X-Accel-Redirect', response)
+
+
+def jpeg_encoding():
+    """Whether Pillow is installed and can encode JPEG images"""
+    try:
+        from PIL import Image
+        Image.new('RGB', (1, 1)).save(io.BytesIO(), 'JPEG')
+    except Exception:
+        return False
+    return True
+
+
+class CoverTests(unittest.TestCase):
+    def test_reads_the_front_cover(self):
+        def picture(picture_type, data):
+            body = b'\x00image/png\x00' + bytes([picture_type]) + b'cover\x00' + data
+            return b'APIC' + len(body).to_bytes(4, 'big') + b'\x00\x00' + body
+
+        frames = picture(0, b'other picture') + picture(3, b'front cover') + bytes(32)
+        size = bytes((len(frames) >> shift) & 0x7F for shift in (21, 14, 7, 0))
+        data = b'ID3\x03\x00\x00' + size + frames + mp3_frames(4)
+        self.assertEqual(mp3.cover_art(io.BytesIO(data)), b'front cover')
+        self.assertEqual(mp3.duration(io.BytesIO(data)), timedelta(seconds=4 * 1152 / 44100))
+        self.assertIsNone(mp3.cover_art(io.BytesIO(mp3_frames(4))))
+
+    def test_thumbnails(self):
+        cover = hashlib.sha256(b'front cover').hexdigest()
+        thumbnails = models.Recording(cover=cover).thumbnails
+        self.assertEqual(set(thumbnails), set(covers.SIZES))
+        self.assertTrue(thumbnails['small'].endswith(f'/covers/{cover[:2]}/{cover}-64.jpg'))
+        self.assertEqual(models.Recording().thumbnails, {})
+
+    @unittest.skipUnless(jpeg_encoding(), "needs Pillow with JPEG support")
+    def test_builds_the_thumbnails(self):
+        from PIL import Image
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        image = io.BytesIO()
+        Image.new('RGB', (400, 200), 'red').save(image, 'JPEG')
+        body = b'\x00image/jpeg\x00\x03\x00' + image.getvalue()
+        frame = b'APIC' + len(body).to_bytes(4, 'big') + b'\x00\x00' + body
+        size = bytes((len(frame) >> shift) & 0x7F for shift in (21, 14, 7, 0))
+        audio_path = os.path.join(media_root.name, 'farm.mp3')
+        with open(audio_path, 'wb') as file:
+            file.write(b'ID3\x03\x00\x00' + size + frame + mp3_frames(4))
+
+        cover = covers.build_thumbnails(audio_path, media_root.name)
+        self.assertEqual(cover, hashlib.sha256(image.getvalue()).hexdigest())
+        for size in covers.SIZES.values():
+            with Image.open(os.path.join(media_root.name,
+                                         covers.thumbnail_name(cover, size))) as thumbnail:
+                self.assertEqual((thumbnail.format, thumbnail.size), ('JPEG', (size, size // 2)))
+        with open(audio_path, 'wb') as file:
+            file.write(mp3_frames(4))
+        self.assertEqual(covers.build_thumbnails(audio_path, media_root.name), '')
+
+    @override_settings(COVER_WORKERS=1)
+    def test_submits_a_file_once_at_a_time(self):
+        executor = mock.Mock()
+        with mock.patch.object(covers, '_get_executor', return_value=executor), \
+                mock.patch.object(covers, '_executor_pid', os.getpid()):
+            future = covers.submit('audio_files/ab/farm.mp3')
+            self.assertIsNone(covers.submit('audio_files/ab/farm.mp3'))
+            future.add_done_callback.call_args[0][0](mock.Mock(**{'exception.return_value': None,
+                                                                  'result.return_value': ''}))
+            self.assertIsNotNone(covers.submit('audio_files/ab/farm.mp3'))
+        self.assertEqual(executor.submit.call_count, 2)
+
+
+class WaveformTests(unittest.TestCase):
+    def test_reads_the_level_for_the_width(self):
+        file = tempfile.NamedTemporaryFile(suffix='.peaks', delete=False)
+        self.addCleanup(os.remove, file.name)
+        levels = [(256, bytes(range(16))), (512, bytes(range(8))), (1024, bytes(range(4)))]
+        file.write(waveforms.HEADER.pack(waveforms.MAGIC, len(levels)))
+        for samples_per_peak, peaks in levels:
+            file.write(waveforms.LEVEL.pack(samples_per_peak, len(peaks) // 2))
+        file.write(b''.join(peaks for _, peaks in levels))
+        file.close()
+
+        self.assertEqual(waveforms.read_level(file.name, 4), levels[1])
+        self.assertEqual(waveforms.read_level(file.name, 3), levels[1])
+        self.assertEqual(waveforms.read_level(file.name, 1), levels[2])
+        self.assertEqual(waveforms.read_level(file.name, 100), levels[0])
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy') and shutil.which('ffmpeg'),
+                         "needs NumPy and ffmpeg")
+    def test_builds_the_peaks_of_a_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        audio_path = os.path.join(directory.name, 'square.wav')
+        with wave.open(audio_path, 'wb') as audio:  # 20 s of a square wave, a period per peak
+            audio.setnchannels(1)
+            audio.setsampwidth(2)
+            audio.setframerate(waveforms.SAMPLE_RATE)
+            period = (-12800).to_bytes(2, 'little', signed=True) * 128 \
+                + (12800).to_bytes(2, 'little', signed=True) * 128
+            audio.writeframes(period * (20 * waveforms.SAMPLE_RATE // 256))
+        peaks_path = os.path.join(directory.name, 'waveforms', 'square.peaks')
+
+        self.assertEqual(waveforms.build_peaks(audio_path, peaks_path), 625)
+        self.assertEqual(waveforms.read_level(peaks_path, 600),
+                         (256, bytes([256 - 50, 50]) * 625))
+        self.assertEqual(waveforms.read_level(peaks_path, 300),
+                         (512, bytes([256 - 50, 50]) * 313))
+        self.assertEqual(waveforms.read_level(peaks_path, 1)[0], 1024)
+        with self.assertRaises(RuntimeError):
+            waveforms.build_peaks(peaks_path, peaks_path)
+
+
+class PrefixIndexTests(unittest.TestCase):
+    def testCompletesHeaviestTermsFirst(self):
+        prefixes = PrefixIndex({'orwell': 4, 'orlando': 6, 'ore': 1, 'farm': 4})
+        self.assertEqual(prefixes.complete('or'), ['orlando', 'orwell', 'ore'])
+        self.assertEqual(prefixes.complete('or', limit=1), ['orlando'])
+        self.assertEqual(prefixes.complete('x'), [])
+
+    def testCompletesFromAllTermsOfThePrefix(self):
+        prefixes = PrefixIndex(dict({f'or{i:04}': 1 for i in range(600)}, orz=2, or0599=3),
+                               top_size=4)
+        self.assertEqual(prefixes.complete('or', limit=2), ['or0599', 'orz'])
+        self.assertEqual(prefixes.complete('or', limit=8)[2:4], ['or0000', 'or0001'])
+        self.assertEqual(prefixes.complete('or0', limit=10)[0], 'or0599')
+
+
+class SpellingTests(unittest.TestCase):
+    def testEditDistance(self):
+        self.assertEqual(edit_distance("orwel", "orwell", 2), 1)
+        self.assertEqual(edit_distance("dostoevski", "dostoevsky", 2), 1)
+        self.assertEqual(edit_distance("farm", "fram", 2), 1)  # transposition
+        self.assertEqual(edit_distance("farm", "prejudice", 2), 3)
+
+    def testSuggestsClosestThenMostFrequentTerms(self):
+        lexicon = NgramLexicon({'orwell': 3, 'orwells': 1, 'farm': 9, 'powell': 5})
+        self.assertEqual(lexicon.suggest("orwel", maxdist=1), [('orwell', 1)])
+        self.assertEqual(lexicon.suggest("orwell", maxdist=2),
+                         [('orwells', 1), ('powell', 2)])
+        self.assertEqual(lexicon.suggest("orwlel", maxdist=1), [('orwell', 1)])
+
+
+class QueryParserTests(unittest.TestCase):
+    def setUp(self):
+        schema = fields.Schema(title=fields.TEXT, author=fields.TEXT)
+        self.parser = LectorQueryParser(['title', 'author'], schema)
+
+    def testCanonicalisesPlainQueries(self):
+        self.assertEqual(self.parser.canonical("Animal  Farm"), self.parser.canonical("farm animal"))
+        self.assertEqual(self.parser.canonical("farm farm"), "farm")
+        # repeated words aren't scored twice by the parsed query either
+        self.assertEqual(self.parser.parse("farm Farm"), self.parser.parse("farm"))
+        self.assertNotEqual(self.parser.canonical("animal AND farm"),
+                            self.parser.canonical("animal and farm"))
+
+    def testPlainQueriesMatchParsedQueries(self):
+        for text in ("Animal Farm", "the farm", "a"):
+            plain, parsed = self.parser.parse_cached(text), self.parser.parse(text)
+            self.assertEqual(set(plain.leaves()), set(parsed.leaves()))
+        self.assertIs(self.parser.parse_cached("farm animal"),
+                      self.parser.parse_cached("Animal Farm"))
+
+
+class SearchResultsTests(unittest.TestCase):
+    def testMergesShardResultsByScore(self):
+        shards = [SearchResults(['1', '4'], [3.0, 1.0], 2, facets={'voice': {'scots': 2}}),
+                  SearchResults(['2', '3'], [2.5, 2.0], 5,
+                                facets={'voice': {'scots': 1, 'irish': 4}})]
+        merged = SearchResults.merge(shards, limit=3)
+        self.assertEqual(merged.pks, ('1', '2', '3'))
+        self.assertEqual(merged.total, 7)
+        self.assertEqual(merged.facets, {'voice': {'scots': 3, 'irish': 4}})
+
+
+class TieredMergePolicyTests(unittest.TestCase):
+    def testBoundsSegmentsAndDeletions(self):
+        schema = fields.Schema(id=fields.ID(stored=True, unique=True))
+        index = RamStorage().create_index(schema)
+        for pk in range(6):
+            writer = index.writer()
+            writer.add_document(id=str(pk))
+            writer.commit(merge=False)
+        writer = index.writer()
+        writer.delete_by_term('id', '0')
+        writer.commit(merge=False)
+        self.assertEqual(len(index._segments()), 6)
+        policy = TieredMergePolicy(max_segments=3)
+        self.assertTrue(policy.select(index._segments()))
+
+        index.writer().commit(mergetype=policy)
+        segments = index._segments()
+        self.assertLessEqual(len(segments), 3)
+        self.assertEqual(sum(segment.deleted_count() for segment in segments), 0)
+        self.assertEqual(sum(segment.doc_count() for segment in segments), 5)
+        self.assertFalse(policy.select(segments))
+
+
+class BlendedWeightingTests(unittest.TestCase):
+    def testBoostsPopularHits(self):
+        schema = fields.Schema(id=fields.ID(stored=True), title=fields.TEXT,
+                               popularity=fields.NUMERIC(sortable=True))
+        index = RamStorage().create_index(schema)
+        with index.writer() as writer:
+            writer.add_document(id='1', title="animal farm", popularity=0)
+            writer.add_document(id='2', title="animal farm", popularity=30)
+        query = Term('title', 'farm')
+        with index.searcher() as searcher:
+            plain = searcher.search(query)
+            self.assertEqual(plain.score(0), plain.score(1))
+        with index.searcher(weighting=BlendedWeighting({'popularity': 0.5})) as searcher:
+            blended = searcher.search(query)
+            self.assertEqual(blended[0]['id'], '2')
+            self.assertGreater(blended.score(0), blended.score(1))
+
+
+class FilterCacheTests(unittest.TestCase):
+    def setUp(self):
+        schema = fields.Schema(id=fields.ID(stored=True, unique=True), voice=fields.ID)
+        self.index = RamStorage().create_index(schema)
+        with self.index.writer() as writer:
+            for pk, voice in enumerate(["scots", "french", "scots"]):
+                writer.add_document(id=str(pk), voice=voice)
+
+    def testCachesBitsetsPerGeneration(self):
+        cache, query = FilterCache(), Term('voice', "scots")
+        with self.index.searcher() as searcher:
+            docs = cache.docs(searcher, 1, query)
+            self.assertEqual(sorted(docs), [0, 2])
+            self.assertIs(cache.docs(searcher, 1, query), docs)
+            self.assertIsNot(cache.docs(searcher, 2, query), docs)
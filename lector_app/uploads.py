@@ -0,0 +1,163 @@
+"""
+Resumable uploads of audio files, received in chunks.
+
+An upload is started with the metadata of the recording and the size of its file (see
+:class:`lector_app.models.Upload`), which allocates a part file under ``MEDIA_ROOT``. The file's
+chunks are then appended in order, each at the offset the server has received up to and with its
+SHA-256 checksum, and spliced into the part file once they are received and verified (see
+:func:`append_chunk`). A client whose connection drops asks for the received offset and carries
+on from there.
+
+The chunks' checksums are kept as they are verified, so that once the whole file is received,
+its content address (see :func:`content_address`) is known without reading the file again. The
+file is then stored as a :class:`lector_app.models.AudioFile`: it is moved to its
+content-addressed storage location (on the same filesystem, so without copying it), unless a
+file with the same content is already stored, which the recording then shares.
+"""
+import glob
+import hashlib
+import os
+import shutil
+import typing as t
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Concat
+
+from .utils import mkdir
+
+
+BLOCK_SIZE = 64 * 1024  # bytes of a chunk read from the request at a time
+
+
+class UploadError(Exception):
+    """A chunk was rejected"""
+
+    def __init__(self, message: str, status: int = 400):
+        """
+        :param message: the reason
+        :param status: HTTP status of the response that reports the error
+        """
+        super().__init__(message)
+        self.status = status
+
+
+def part_path(upload) -> str:
+    """Path of the file that holds the chunks received so far"""
+    return os.path.join(settings.MEDIA_ROOT, 'uploads', f'{upload.pk}.part')
+
+
+def create_part(upload):
+    """Create the (empty) part file of a new upload"""
+    mkdir(settings.MEDIA_ROOT)
+    mkdir(os.path.dirname(part_path(upload)))
+    open(part_path(upload), 'wb').close()
+
+
+def append_chunk(upload, offset: int, stream: t.BinaryIO, length: int,
+                 checksum: t.Optional[str]) -> int:
+    """Write a chunk of an upload to its part file, and record that it was received.
+    The chunk is read from the stream (e.g. the request) a block at a time into a file of its
+    own, and only spliced into the part file once it is verified, while holding the lock of the
+    upload's row, and after checking that nothing was appended at its offset meanwhile (e.g. by
+    the retry of an interrupted request that is still being received).
+
+    :param upload: the :class:`lector_app.models.Upload`
+    :param offset: position of the chunk in the file, which should be the number of bytes
+        received so far
+    :param stream: stream of the chunk's bytes
+    :param length: number of bytes of the chunk, which should be the upload's ``chunk_size``
+        (or what remains of the file, for the last chunk)
+    :param checksum: hexadecimal SHA-256 digest of the chunk
+    :return: the number of bytes received so far
+    :raises UploadError: if the chunk is out of order, of the wrong length, or corrupted (it is
+        discarded)
+    """
+    if offset != upload.received:
+        raise UploadError(f"expected the chunk at offset {upload.received}", status=409)
+    if not checksum:
+        raise UploadError("missing chunk checksum")
+    if length != min(upload.chunk_size, upload.size - offset):
+        raise UploadError(f"chunks should be {upload.chunk_size} bytes long")
+
+    chunk_path = f'{part_path(upload)}.{uuid.uuid4().hex}'
+    try:
+        digest = hashlib.sha256()
+        with open(chunk_path, 'wb') as chunk:
+            remaining = length
+            while remaining:
+                block = stream.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                chunk.write(block)
+                digest.update(block)
+                remaining -= len(block)
+        if remaining or digest.hexdigest() != checksum.lower():
+            raise UploadError("chunk incomplete or corrupted")
+
+        checksum = digest.hexdigest()
+        with transaction.atomic():
+            # updating the row locks it until the chunk is spliced in (and, unlike a SELECT ...
+            # FOR UPDATE, also serialises the appends on SQLite, which ignores row locks)
+            updated = type(upload).objects.filter(pk=upload.pk, received=offset) \
+                .update(received=offset + length, digests=Concat(F('digests'), Value(checksum)))
+            if not updated:
+                upload.refresh_from_db(fields=['received', 'digests'])
+                raise UploadError(f"expected the chunk at offset {upload.received}", status=409)
+            with open(chunk_path, 'rb') as chunk, open(part_path(upload), 'r+b') as part:
+                part.seek(offset)
+                shutil.copyfileobj(chunk, part, BLOCK_SIZE)
+                part.truncate()
+    finally:
+        os.remove(chunk_path)
+    upload.received = offset + length
+    upload.digests += checksum
+    return upload.received
+
+
+def content_address(digests: str) -> str:
+    """The address of a file's content: the hexadecimal SHA-256 digest of the SHA-256 digests of
+    its chunks (a hash list, since the state of a hash can't be kept between the requests that
+    send the chunks)
+
+    :param digests: the concatenated hexadecimal digests of the chunks
+    """
+    return hashlib.sha256(bytes.fromhex(digests)).hexdigest()
+
+
+def file_address(path: str, chunk_size: t.Optional[int] = None) -> str:
+    """The content address of a file that wasn't uploaded (see :func:`content_address`)
+
+    :param path: path of the file
+    :param chunk_size: size of the hashed chunks (``UPLOAD_CHUNK_SIZE`` by default, as for
+        uploads)
+    """
+    chunk_size = chunk_size or getattr(settings, 'UPLOAD_CHUNK_SIZE', 4 * 2 ** 20)
+    digests = []
+    with open(path, 'rb') as file:
+        while True:
+            digest, remaining = hashlib.sha256(), chunk_size
+            while remaining:
+                block = file.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+            if remaining == chunk_size:  # nothing left
+                break
+            digests.append(digest.hexdigest())
+            if remaining:
+                break
+    return content_address(''.join(digests))
+
+
+def discard(upload):
+    """Delete the part file of an upload (which is about to be deleted), and the files of the
+    chunks that were being received when their process died, if any"""
+    for path in [part_path(upload)] + glob.glob(f'{glob.escape(part_path(upload))}.*'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
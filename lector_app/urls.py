@@ -14,11 +14,18 @@ urlpatterns = [
     path('login/', views.login_view, name='login'),
     path('logout/', views.user_logout, name='logout'),
     path('search/', views.search_view, name='search'),
+    path('search/results/', views.search_results_view, name='search_results'),
+    path('search/suggest/', views.suggest_view, name='suggest'),
+    path('search/all/', views.search_all_view, name='search_all'),
     path('book_search/', views.book_search_view, name='book_search'),
     path('audio_player/<int:recording_id>', views.audio_player, name='audio_player'),
+    path('audio/<int:recording_id>', views.audio_stream, name='audio_stream'),
+    path('audio/<int:recording_id>/waveform', views.audio_waveform, name='audio_waveform'),
     path('validate_login/', views.validate_login, name='validate_login'),
     path('validate_signup/', views.validate_signup, name='validate_signup'),
-    path('validate_upload/', views.validate_upload, name='validate_upload'),
+    path('upload/', views.upload_start, name='upload_start'),
+    path('upload/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('upload/<uuid:upload_id>/finish/', views.upload_finish, name='upload_finish'),
     path('validate_upload_form/', views.validate_upload_form, name='validate_upload_form'),
     path('remove_recording/', views.remove_recording, name='remove_recording'),
     path('add_library/', views.add_library, name='add_library'),
@@ -1,14 +1,101 @@
-import math
-from datetime import timedelta
+import os
 
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.core.signing import BadSignature
 from django.core.validators import ValidationError, validate_email
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import Count
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
-
-from .models import Author, Book, Recording, UserProfile
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+
+from . import mp3, search, streaming, uploads, waveforms
+from .models import AudioFile, Author, Book, Recording, Upload, UserProfile
+
+
+SEARCH_PAGE_LENGTH = 5  # number of search results shown at a time
+SEARCH_GROUP_LENGTH = 5  # number of hits of each model returned by the unified search
+SEARCH_FACETS = ('voice_type', 'duration')  # facets whose hit counts are shown with results
+SEARCH_HIT_TEMPLATE = 'lector-app/partials/_search_hit.html'
+SEARCH_HIT_BUTTON = '<!-- library button -->'  # where the hit templates are split
+# orderings of search results (besides relevance), by name: labels and search options
+SEARCH_ORDERS = {
+    'popular': ("Popular", {'blend': {'popularity': 0.5}}),
+    'most-saved': ("Most saved", {'sortedby': 'popularity', 'reverse': True}),
+    'shortest': ("Shortest", {'sortedby': 'duration_seconds'}),
+    'longest': ("Longest", {'sortedby': 'duration_seconds', 'reverse': True}),
+}
+
+
+# Helpers
+
+def _search_hits(request, pks):
+    """The recordings that are the search hits with the given primary keys, as HTML fragments for
+    partials/_search_hits.html.
+    The HTML of each hit, which is the same for all users, is cached in the ``SEARCH_CACHE``
+    cache for ``SEARCH_HIT_CACHE_TIMEOUT`` seconds, keyed by the version of the hit's index entry
+    (see :method:`lector_app.search.AbstractSearchEngine.entry_versions`), so that it's rendered
+    again once the fields it shows are reindexed, but not when only the recording's popularity
+    is. Only the hits that aren't cached are fetched from the database; the library buttons,
+    which depend on the user, are rendered separately (see
+    :class:`lector_app.middleware.UserState`).
+    """
+    se = Recording.search_engine
+    cache = caches[getattr(settings, 'SEARCH_CACHE', 'default')]
+    keys = {pk: f'lector-app.search-hit:{pk}:{version}'
+            for pk, version in se.entry_versions(pks).items()}
+    cached = cache.get_many(keys.values())
+    fragments = {pk: cached[key] for pk, key in keys.items() if key in cached}
+    missing = [pk for pk in pks if pk not in fragments]
+    if missing:
+        for recording in se.hydrate(missing):
+            html = render_to_string(SEARCH_HIT_TEMPLATE, {'hit': recording})
+            fragments[str(recording.pk)] = tuple(html.split(SEARCH_HIT_BUTTON, 1))
+        # hits without a version (e.g. removed from the index meanwhile) aren't cached
+        cache.set_many({keys[pk]: fragments[pk] for pk in missing
+                        if pk in keys and pk in fragments},
+                       getattr(settings, 'SEARCH_HIT_CACHE_TIMEOUT', 3600))
+
+    library = request.user_state.library
+    # hits whose recordings no longer exist (see hydrate) are dropped
+    return [{'pk': pk, 'head': mark_safe(fragments[pk][0]), 'tail': mark_safe(fragments[pk][1]),
+             'in_library': int(pk) in library}
+            for pk in pks if pk in fragments]
+
+
+def _search_filters(request):
+    """Search filters selected by the query parameters of a request"""
+    filters = {}
+    if request.GET.get('voice_type'):
+        filters['voice_type'] = request.GET['voice_type']
+    if request.GET.get('author'):
+        filters['author_id'] = request.GET['author']
+    try:
+        start, end = (int(bound) for bound in request.GET.get('duration', '').split('-'))
+        filters['duration_seconds'] = [start, end - 1]  # facet ranges exclude their end
+    except ValueError:
+        pass
+    return filters
+
+
+def _facet_link(request, param, value, label, count):
+    """A link that toggles the filter ``param=value`` on the current search"""
+    params = request.GET.copy()
+    active = params.get(param) == value
+    if active:
+        del params[param]
+    else:
+        params[param] = value
+    return {'label': label, 'count': count, 'active': active, 'url': f'?{params.urlencode()}'}
 
 
 # Views
@@ -19,15 +106,13 @@ def index_view(request):
 
 @login_required
 def details(request):
-    user = request.user
-    user_profile = UserProfile.objects.get(user=user)
-    uploads = Recording.objects.filter(reader=user_profile).count()
-    library = user_profile.library.all().count()
+    user_profile = request.user_state.profile
 
     context = {
         'user_profile': user_profile,
-        'uploads': uploads,
-        'library': library
+        'uploads': user_profile.upload_count,
+        'library': user_profile.library_count,
+        'narrated_duration': user_profile.narrated_duration
     }
 
     return render(request, 'lector-app/details.html', context)
@@ -35,18 +120,15 @@ def details(request):
 
 @login_required
 def library_view(request):
-    user = request.user
-    user_profile = UserProfile.objects.get(user=user)
-    library = user_profile.library.all()
+    library = request.user_state.profile.library.select_related('book__author')
 
     return render(request, 'lector-app/library.html', {'library': library})
 
 
 @login_required
 def uploads_view(request):
-    user = request.user
-    user_profile = UserProfile.objects.get(user=user)
-    recordings = Recording.objects.filter(reader=user_profile)
+    recordings = Recording.objects.filter(reader=request.user_state.profile) \
+        .select_related('book__author')
 
     return render(request, 'lector-app/uploads.html', {'recordings': recordings})
 
@@ -66,39 +148,171 @@ def signup_view(request):
 
 
 def book_search_view(request):
-    return render(request, 'lector-app/book_search.html')
+    """Shows a book and its recordings, most saved first: the book with the primary key in the
+    ``book`` query parameter, or the best match for the ``query`` parameter"""
+    if request.GET.get('book'):
+        try:
+            book = get_object_or_404(Book.objects.select_related('author'), pk=request.GET['book'])
+        except (ValueError, ValidationError):
+            raise Http404("invalid book")
+    else:
+        results = Book.search_engine.search(request.GET.get('query', ''), limit=1,
+                                            blend={'recording_count': 0.5})
+        books = Book.search_engine.hydrate(results.pks)
+        if not books:
+            raise Http404("no book matches the query")
+        book = books[0]
+    recordings = book.recording_set.select_related('reader__user') \
+        .annotate(library_count=Count('userprofile')).order_by('-library_count', 'pk')
+    context = {'book': book,
+               'recordings': recordings,
+               'user_library': request.user_state.library}
+    return render(request, 'lector-app/book_search.html', context)
 
 
 def search_view(request):
-    from .models import Recording
-
     se = Recording.search_engine
     query = request.GET.get('query', '')
-    nresults = int(request.GET.get('nresults', 5))
-
-    results = se.search(query, limit=nresults)
-
-    if request.user.is_authenticated:
-        user = request.user
-        userprofile = UserProfile.objects.get(user=user)
-        user_library = userprofile.library.all()
-    else:
-        user_library = None
+    _, order_options = SEARCH_ORDERS.get(request.GET.get('order'), (None, {}))
+    page = se.search_page(query, pagelen=SEARCH_PAGE_LENGTH, filters=_search_filters(request),
+                          facets=SEARCH_FACETS, **order_options)
 
+    voice_types = sorted(page.facets['voice_type'].items(), key=lambda item: -item[1])
+    # recordings outside the duration facet's ranges are counted under None
+    durations = sorted(item for item in page.facets['duration'].items() if item[0] is not None)
     context = {'query': query,
-               'hits': [Recording.objects.get(pk=hit[se.pk_name]) for hit in results],
-               'has_more': results.scored_length() < len(results),
-               'show_more_nresults': nresults + 5,
-               'user_library': user_library}
+               'hits': _search_hits(request, page.pks),
+               'cursor': page.cursor,
+               'correction': page.correction,
+               'facets': {
+                   'voice_type': [_facet_link(request, 'voice_type', voice_type, voice_type, count)
+                                  for voice_type, count in voice_types],
+                   'duration': [_facet_link(request, 'duration', f'{start}-{end}',
+                                            f'{start // 60}–{end // 60} min', count)
+                                for (start, end), count in durations],
+               },
+               'orders': [_facet_link(request, 'order', name, label, None)
+                          for name, (label, _) in SEARCH_ORDERS.items()]}
     return render(request, 'lector-app/search.html', context)
 
 
+def search_results_view(request):
+    """Returns the next page of search results for the cursor in the request as JSON, with the
+    hits rendered as HTML"""
+    se = Recording.search_engine
+    try:
+        page = se.search_page(cursor=request.GET['cursor'], pagelen=SEARCH_PAGE_LENGTH)
+    except (KeyError, BadSignature):
+        return JsonResponse({'error': "invalid cursor"}, status=400)
+    except search.StaleCursor:
+        return JsonResponse({'error': "the results changed"}, status=409)
+
+    context = {'hits': _search_hits(request, page.pks)}
+    return JsonResponse({
+        'html': render_to_string('lector-app/partials/_search_hits.html', context, request),
+        'cursor': page.cursor,
+        'total': page.total
+    })
+
+
+def search_all_view(request):
+    """Returns the top recordings, books and authors matching the query in the request as JSON,
+    searching their indexes concurrently"""
+    query = request.GET.get('query', '')
+    results = search.search_engines({
+        'recordings': (Recording.search_engine,
+                       {'query': query, 'limit': SEARCH_GROUP_LENGTH, 'blend': {'popularity': 0.5}}),
+        'books': (Book.search_engine,
+                  {'query': query, 'limit': SEARCH_GROUP_LENGTH,
+                   'blend': {'recording_count': 0.5}}),
+        'authors': (Author.search_engine, {'query': query, 'limit': SEARCH_GROUP_LENGTH}),
+    })
+    recordings = [{'id': recording.pk,
+                   'title': recording.book.title,
+                   'author': recording.book.author.full_name,
+                   'reader': recording.reader.user.username,
+                   'voice_type': recording.reader.voice_type,
+                   'duration': int(recording.duration.total_seconds()),
+                   'url': reverse('lector-app:audio_player', args=[recording.pk])}
+                  for recording in Recording.search_engine.hydrate(results['recordings'].pks)]
+    books = [{'id': book.pk,
+              'title': book.title,
+              'author': book.author.full_name,
+              'url': f"{reverse('lector-app:book_search')}?book={book.pk}"}
+             for book in Book.search_engine.hydrate(results['books'].pks)]
+    authors = [{'id': author.pk,
+                'name': author.full_name,
+                'url': f"{reverse('lector-app:search')}?author={author.pk}"}
+               for author in Author.search_engine.hydrate(results['authors'].pks)]
+    return JsonResponse({
+        'query': query,
+        'correction': results['recordings'].correction,
+        'recordings': {'total': results['recordings'].total, 'hits': recordings},
+        'books': {'total': results['books'].total, 'hits': books},
+        'authors': {'total': results['authors'].total, 'hits': authors},
+    })
+
+
+def suggest_view(request):
+    """Returns type-ahead suggestions for the prefix in the request as JSON"""
+    prefix = request.GET.get('q', '')
+    try:
+        limit = min(max(int(request.GET['limit']), 1), 20)
+    except (KeyError, ValueError):
+        limit = 8
+    return JsonResponse({'suggestions': Recording.search_engine.suggest(prefix, limit)})
+
+
 def audio_player(request, recording_id):
     recording = get_object_or_404(Recording, pk=recording_id)
     context = {'recording': recording}
     return render(request, 'lector-app/audio_player.html', context)
 
 
+def audio_stream(request, recording_id):
+    """Streams the audio file of a recording, with support for seeking (byte range requests)"""
+    recording = get_object_or_404(Recording, pk=recording_id)
+    try:
+        path = recording.audio_file.path
+    except NotImplementedError:  # the storage isn't the local filesystem
+        return redirect(recording.audio_file.url)
+    try:
+        return streaming.serve_file(request, path, 'audio/mpeg',
+                                    offload_name=recording.audio_file.name)
+    except FileNotFoundError:
+        raise Http404("the recording's audio file is missing")
+
+
+def audio_waveform(request, recording_id):
+    """The waveform peaks of a recording, at the resolution for a player ``width`` peaks wide
+    (see :func:`lector_app.waveforms.read_level`), as (minimum, maximum) pairs of signed bytes.
+    The number of samples per peak, at ``waveforms.SAMPLE_RATE`` Hz, is in the
+    X-Samples-Per-Peak header."""
+    recording = get_object_or_404(Recording, pk=recording_id)
+    try:
+        width = min(max(int(request.GET['width']), 1), 2 ** 16)
+    except (KeyError, ValueError):
+        width = waveforms.MIN_PEAKS
+    path = default_storage.path(waveforms.peaks_name(recording.audio_file.name))
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:  # the build_waveforms command computes missing peaks
+        raise Http404("the recording's waveform isn't computed yet")
+
+    etag = f'"{stat.st_mtime_ns:x}-{width:x}"'
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        samples_per_peak, peaks = waveforms.read_level(path, width)
+        response = HttpResponse(peaks, content_type='application/octet-stream')
+        response['X-Samples-Per-Peak'] = samples_per_peak
+        response['Last-Modified'] = http_date(last_modified)
+    response['ETag'] = etag
+    patch_cache_control(response, public=True,
+                        max_age=getattr(settings, 'WAVEFORM_CACHE_SECONDS', 24 * 3600))
+    return response
+
+
 def validate_signup(request):
     errors = []
     validated = False
@@ -172,14 +386,9 @@ def user_logout(request):
     return redirect('lector-app:index')
 
 
-@login_required
-def validate_upload_form(request):
+def _upload_errors(title, author):
+    """Errors in the metadata of a recording to upload"""
     errors = []
-    validated = False
-    title = request.POST['title']
-    author = request.POST['author']
-    file_boolean = request.POST['file']
-
     # Empty fields
     if not title:
         errors.append("title_empty")
@@ -188,7 +397,17 @@ def validate_upload_form(request):
         errors.append("author_empty")
     elif len(author.split(" ")) < 2:
         errors.append("author_invalid")
+    return errors
+
 
+@login_required
+def validate_upload_form(request):
+    validated = False
+    title = request.POST['title']
+    author = request.POST['author']
+    file_boolean = request.POST['file']
+
+    errors = _upload_errors(title, author)
     if file_boolean == 'false':
         errors.append("file_invalid")
 
@@ -202,48 +421,80 @@ def validate_upload_form(request):
 
 
 @login_required
-def validate_upload(request):
-    errors = []
-    validated = False
+def upload_start(request):
+    """Starts a resumable upload of a new recording's audio file (see
+    :mod:`lector_app.uploads`), given the recording's metadata and the size of the file"""
     title = request.POST['title']
     author = request.POST['author']
-    duration = timedelta(seconds=int(math.floor(float(request.POST['duration']))))
-    custom_file = request.FILES['file']
-
-    # Empty fields
-    if not title:
-        errors.append("title_empty")
-
-    if not author:
-        errors.append("author_empty")
-    elif len(author.split(" ")) < 2:
-        errors.append("author_invalid")
+    errors = _upload_errors(title, author)
+    try:
+        size = int(request.POST['size'])
+    except (KeyError, ValueError):
+        size = 0
+    if size <= 0 or size > getattr(settings, 'UPLOAD_MAX_SIZE', 2 ** 31):
+        errors.append("file_invalid")
+    if errors:
+        return JsonResponse({'errors': errors, 'success': False})
+
+    first, last = author.split(" ", 1)
+    upload = Upload.objects.create(
+        reader=request.user_state.profile, title=title, author_first_name=first.capitalize(),
+        author_last_name=last.capitalize(),
+        filename=os.path.basename(request.POST.get('filename', '')) or 'recording.mp3', size=size,
+        chunk_size=getattr(settings, 'UPLOAD_CHUNK_SIZE', 4 * 2 ** 20))
+    uploads.create_part(upload)
+    return JsonResponse({'success': True,
+                         'id': str(upload.pk),
+                         'offset': 0,
+                         'chunk_size': upload.chunk_size})
 
-    if not custom_file:
-        errors.append("file_empty")
 
-    if not duration:
-        errors.append("duration_empty")
+@login_required
+def upload_chunk(request, upload_id):
+    """Returns the number of bytes received so far of an upload (GET), or appends the chunk in
+    the body of the request, which should be at the ``offset`` query parameter and have the
+    SHA-256 checksum in the X-Chunk-SHA256 header (POST)"""
+    upload = get_object_or_404(Upload, pk=upload_id, reader=request.user_state.profile)
+    if request.method == 'POST':
+        try:
+            offset = int(request.GET['offset'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error': "invalid offset", 'offset': upload.received},
+                                status=400)
+        try:
+            uploads.append_chunk(upload, offset, request,
+                                 int(request.META.get('CONTENT_LENGTH') or 0),
+                                 request.META.get('HTTP_X_CHUNK_SHA256'))
+        except uploads.UploadError as error:
+            return JsonResponse({'error': str(error), 'offset': upload.received},
+                                status=error.status)
+    return JsonResponse({'offset': upload.received, 'size': upload.size})
 
-    if not errors:
-        # Manipluate Data
-        names = author.split(" ", 1)
-        first = names[0]
-        last = names[1]
-        first = first.capitalize()
-        last = last.capitalize()
-        author = Author.objects.get_or_create(first_name=first, last_name=last)
-        book = Book.objects.get_or_create(title=title, author=author[0])
-        user = request.user
-        user_profile = UserProfile.objects.get(user=user)
-        Recording.objects.get_or_create(book=book[0], reader=user_profile, audio_file=custom_file,
-                                        duration=duration)
-        validated = True
 
-    return JsonResponse({
-        'errors': errors,
-        'success': validated
-    })
+@login_required
+def upload_finish(request, upload_id):
+    """Creates the recording of a complete upload, whose file is stored unless the same file
+    already is, and whose duration is read from the file"""
+    upload = get_object_or_404(Upload, pk=upload_id, reader=request.user_state.profile)
+    if upload.received != upload.size:
+        return JsonResponse({'error': "the upload is incomplete", 'offset': upload.received},
+                            status=409)
+    try:
+        # in one transaction with the reference to the file, so that it can't be deleted meanwhile
+        with transaction.atomic():
+            audio_file = AudioFile.store(uploads.part_path(upload),
+                                         uploads.content_address(upload.digests), move=True)
+            author, _ = Author.objects.get_or_create(first_name=upload.author_first_name,
+                                                     last_name=upload.author_last_name)
+            book, _ = Book.objects.get_or_create(title=upload.title, author=author)
+            recording = Recording(book=book, reader=upload.reader, duration=audio_file.duration)
+            recording.audio_file.name = audio_file.name
+            recording.save()
+            upload.delete()
+    except mp3.Mp3Error:
+        upload.delete()
+        return JsonResponse({'error': "the file isn't an MP3 file"}, status=400)
+    return JsonResponse({'success': True, 'id': recording.pk})
 
 
 @login_required
@@ -270,16 +521,12 @@ def add_library(request):
     if state == "add":
         recording_id = request.POST['recording_id']
         recording = Recording.objects.get(pk=recording_id)
-        user = request.user
-        userprofile = UserProfile.objects.get(user=user)
-        userprofile.library.add(recording)
+        request.user_state.profile.library.add(recording)
         json['state'] = "added"
     elif state == "remove":
         recording_id = request.POST['recording_id']
         recording = Recording.objects.get(pk=recording_id)
-        user = request.user
-        userprofile = UserProfile.objects.get(user=user)
-        userprofile.library.remove(recording)
+        request.user_state.profile.library.remove(recording)
         json['state'] = "removed"
 
     return JsonResponse(json)
@@ -292,9 +539,7 @@ def remove_library(request):
     try:
         recording_id = request.POST['recording_id']
         recording = Recording.objects.get(pk=recording_id)
-        user = request.user
-        user_profile = UserProfile.objects.get(user=user)
-        user_profile.library.remove(recording)
+        request.user_state.profile.library.remove(recording)
         json['status'] = "success"
     except:
         json['status'] = "failure"
@@ -0,0 +1,188 @@
+"""
+Waveform peaks of the recordings' audio files, for the audio player's scrubber.
+
+The peaks of new audio files are computed in the background, in a pool of worker processes:
+each file is decoded by ffmpeg to mono 16-bit PCM at ``SAMPLE_RATE`` Hz, streamed through the
+worker (which never holds the whole file), and reduced with NumPy to the minimum and maximum of
+every ``SAMPLES_PER_PEAK`` samples. Coarser levels halve the resolution of the level before,
+down to ``MIN_PEAKS`` peaks, so that a player of any width gets peaks at most twice as fine as
+it can draw.
+
+The levels are stored together, as a binary file next to the audio file (under
+``MEDIA_ROOT/waveforms``), with the format::
+
+    b'LWP1', number of levels: uint32
+    for each level, from the finest: samples per peak: uint32, number of peaks: uint32
+    for each level, from the finest: (minimum, maximum) pairs of int8 peaks
+
+(integers are little-endian). Since audio files are content-addressed (see
+:class:`lector_app.models.AudioFile`), recordings of the same file share its peaks.
+
+NumPy is only needed by the worker processes, which import it.
+"""
+import logging
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import typing as t
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+
+logger = logging.getLogger('lector-app waveforms')
+
+SAMPLE_RATE = 8000  # Hz of the decoded audio
+SAMPLES_PER_PEAK = 256  # of the finest level (32 ms)
+MIN_PEAKS = 256  # of the coarsest level (or fewer, for short recordings)
+READ_SIZE = 2 * SAMPLES_PER_PEAK * 4096  # bytes of decoded audio read at a time
+
+MAGIC = b'LWP1'
+HEADER = struct.Struct('<4sI')
+LEVEL = struct.Struct('<II')
+
+
+def peaks_name(audio_name: str) -> str:
+    """Name of the peaks file of an audio file, relative to ``MEDIA_ROOT``
+
+    :param audio_name: name of the audio file, relative to ``MEDIA_ROOT``
+    """
+    return os.path.join('waveforms', os.path.splitext(audio_name)[0] + '.peaks')
+
+
+def submit(audio_name: str) -> t.Optional[Future]:
+    """Compute the peaks of an audio file in the background, unless they already are (or are
+    being computed by this process, or ``WAVEFORM_WORKERS`` is 0)
+
+    :param audio_name: name of the audio file, relative to ``MEDIA_ROOT``
+    :return: the future of the number of peaks of the finest level, if they are computed
+    """
+    if not audio_name or not getattr(settings, 'WAVEFORM_WORKERS', 2):
+        return None
+    name = peaks_name(audio_name)
+    with _pending_lock:
+        if _executor_pid != os.getpid():
+            _pending.clear()  # inherited from the parent process
+        if name in _pending or default_storage.exists(name):
+            return None
+        _pending.add(name)
+    future = _get_executor().submit(
+        build_peaks, default_storage.path(audio_name), default_storage.path(name),
+        getattr(settings, 'WAVEFORM_FFMPEG', 'ffmpeg'))
+    future.add_done_callback(lambda done: _built(name, done))
+    return future
+
+
+def read_level(path: str, width: int) -> t.Tuple[int, bytes]:
+    """The coarsest level of a peaks file with at least ``width`` peaks (or the finest, if none
+    has), read without loading the other levels
+
+    :param path: path of the peaks file
+    :param width: the number of peaks wanted
+    :return: the number of decoded samples per peak and the (minimum, maximum) pairs of peaks
+    :raises FileNotFoundError: if the peaks file doesn't exist
+    :raises ValueError: if the file isn't a peaks file
+    """
+    with open(path, 'rb') as file:
+        magic, count = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a peaks file")
+        levels = [LEVEL.unpack(file.read(LEVEL.size)) for _ in range(count)]
+        offset = HEADER.size + count * LEVEL.size
+        chosen = 0
+        for index, (samples_per_peak, peaks) in enumerate(levels):
+            if peaks < width:
+                break
+            chosen = index
+        offset += sum(2 * peaks for _, peaks in levels[:chosen])
+        samples_per_peak, peaks = levels[chosen]
+        file.seek(offset)
+        return samples_per_peak, file.read(2 * peaks)
+
+
+def build_peaks(audio_path: str, peaks_path: str, ffmpeg: str = 'ffmpeg') -> int:
+    """Decode an audio file and write its peaks file (in a worker process).
+
+    :param audio_path: path of the audio file
+    :param peaks_path: path of the peaks file, which is replaced atomically
+    :param ffmpeg: the ffmpeg executable
+    :return: the number of peaks of the finest level
+    :raises RuntimeError: if ffmpeg fails to decode the file
+    """
+    import numpy as np
+
+    command = [ffmpeg, '-nostdin', '-v', 'error', '-i', audio_path,
+               '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-']
+    minima, maxima = [], []
+    rest = np.empty(0, dtype='<i2')
+    with tempfile.TemporaryFile() as errors, \
+            subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors) as process:
+        while True:
+            data = process.stdout.read(READ_SIZE)
+            if not data:
+                break
+            samples = np.concatenate((rest, np.frombuffer(data, dtype='<i2',
+                                                          count=len(data) // 2)))
+            whole = len(samples) - len(samples) % SAMPLES_PER_PEAK
+            blocks = samples[:whole].reshape(-1, SAMPLES_PER_PEAK)
+            minima.append(blocks.min(axis=1))
+            maxima.append(blocks.max(axis=1))
+            rest = samples[whole:]
+        if process.wait():
+            errors.seek(0)
+            raise RuntimeError(f"ffmpeg failed to decode {audio_path}: "
+                               f"{errors.read().decode(errors='replace').strip()}")
+    if len(rest):
+        minima.append(rest.min(keepdims=True))
+        maxima.append(rest.max(keepdims=True))
+    if not minima:
+        raise RuntimeError(f"no audio decoded from {audio_path}")
+
+    # 16-bit samples to 8-bit peaks
+    low = (np.concatenate(minima) >> 8).astype(np.int8)
+    high = (np.concatenate(maxima) >> 8).astype(np.int8)
+    levels = [(SAMPLES_PER_PEAK, low, high)]
+    while len(low) > MIN_PEAKS:
+        if len(low) % 2:
+            low, high = np.append(low, low[-1]), np.append(high, high[-1])
+        low, high = low.reshape(-1, 2).min(axis=1), high.reshape(-1, 2).max(axis=1)
+        levels.append((levels[-1][0] * 2, low, high))
+
+    os.makedirs(os.path.dirname(peaks_path), exist_ok=True)
+    tmp_path = f'{peaks_path}.{os.getpid()}'
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(levels)))
+        for samples_per_peak, low, _ in levels:
+            file.write(LEVEL.pack(samples_per_peak, len(low)))
+        for _, low, high in levels:
+            file.write(np.column_stack((low, high)).tobytes())
+    os.replace(tmp_path, peaks_path)
+    return len(levels[0][1])
+
+
+def _built(name: str, future: Future):
+    with _pending_lock:
+        _pending.discard(name)
+    if future.exception() is not None:
+        logger.error(f"failed to compute the peaks {name}: {future.exception()}")
+    else:
+        logger.debug(f"computed the peaks {name} ({future.result()} peaks)")
+
+
+_executor: t.Optional[ProcessPoolExecutor] = None
+_executor_pid: t.Optional[int] = None
+_pending: t.Set[str] = set()  # names of the peaks files being computed by this process
+_pending_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Process pool for computing peaks (it doesn't survive forking)"""
+    global _executor, _executor_pid
+    with _pending_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(getattr(settings, 'WAVEFORM_WORKERS', 2))
+            _executor_pid = os.getpid()
+        return _executor
@@ -10,7 +10,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lector.settings')
 django.setup()
 
 from django.db.models import Model
-from lector_app.models import Book, Author, User, UserProfile, Recording
+from lector_app.models import AudioFile, Book, Author, User, UserProfile, Recording
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'lector_app', 'static', 'lector-app', 'audio', 'sample.mp3')
 
 
 def populate():
@@ -52,12 +55,14 @@ def populate():
 
     rand = random.Random(42)
 
-    recordings = [{'book': book, 'reader': reader, 'audio_file': 'sample.mp3',
+    # stored once, and shared by all recordings
+    sample = AudioFile.store(SAMPLE).name
+    recordings = [{'book': book, 'reader': reader, 'audio_file': sample,
                    'duration': timedelta(seconds=rand.randint(60 * 30, 60 * 150))}
                   for book, reader in itt.product(books[:-1], profiles[:-1])]
     recordings.extend([
         {'book': books[-1], 'reader': profiles[-1], 'duration': timedelta(hours=3, minutes=55),
-         'audio_file': 'sample.mp3'}
+         'audio_file': sample}
     ])
 
     for book in books: